@@ -0,0 +1,232 @@
+# admission.py
+# Admission control per route class.
+#
+# Every /api request is classified as a point read, write, analytics query or
+# bulk read. Each class has its own concurrency limit and a bounded wait
+# queue; when the queue is full (or the wait times out) the request is
+# rejected at once with 503 and Retry-After instead of piling up on the
+# database pool. The non-point classes together may never claim more than
+# pool size minus RESERVED_POINT_READS connections, so cheap CRM lookups
+# always have a slice of the pool. Limits can be changed at runtime.
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+from db import DB_POOL_MAX_SIZE
+from metrics import metrics
+
+POINT_READS = "point_reads"
+WRITES = "writes"
+ANALYTICS = "analytics"
+BULK_READS = "bulk_reads"
+
+RESERVED_POINT_READS = int(os.environ.get("ADMISSION_RESERVED_POINT_READS", "3"))
+
+# class -> (limit, max queued, max wait seconds)
+DEFAULTS = {
+    POINT_READS: (DB_POOL_MAX_SIZE, 200, 2.0),
+    WRITES: (4, 100, 2.0),
+    ANALYTICS: (2, 20, 5.0),
+    BULK_READS: (1, 10, 5.0),
+}
+
+# GET paths that read whole tables
+_BULK_PATHS = {
+    "/api/clients", "/api/clients/search", "/api/follow-ups", "/api/tasks",
+    "/api/interactions", "/api/analytics/sales", "/api/analytics/inventory",
+    "/api/stats", "/api/changes",
+}
+# Long-lived streams hold no pool connection, so they take no slot
+_EXEMPT_PREFIXES = ("/api/metrics", "/api/admin/", "/api/stream/")
+
+
+class Rejected(Exception):
+    def __init__(self, route_class: str, retry_after: int):
+        self.route_class = route_class
+        self.retry_after = retry_after
+
+
+class ClassLimiter:
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters: deque = deque()
+
+    def retry_after(self) -> int:
+        return max(1, int(self.max_wait))
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            metrics.incr(f"admission.{self.name}.rejected")
+            raise Rejected(self.name, self.retry_after())
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                # Granted a slot just as we gave up: hand it on
+                self.release()
+            else:
+                fut.cancel()
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            metrics.incr(f"admission.{self.name}.timed_out")
+            raise Rejected(self.name, self.retry_after())
+        metrics.observe(f"admission.{self.name}.wait_ms", (time.perf_counter() - t0) * 1000)
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.active < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.active += 1
+                fut.set_result(None)
+
+    def configure(self, limit: Optional[int] = None, max_queue: Optional[int] = None,
+                  max_wait: Optional[float] = None):
+        if limit is not None:
+            self.limit = limit
+        if max_queue is not None:
+            self.max_queue = max_queue
+        if max_wait is not None:
+            self.max_wait = max_wait
+        self._wake()
+
+    def as_dict(self) -> Dict:
+        return {
+            "limit": self.limit, "max_queue": self.max_queue, "max_wait": self.max_wait,
+            "active": self.active, "queued": len(self._waiters),
+        }
+
+
+def _validate(name: str, settings: Dict):
+    if not isinstance(settings, dict):
+        raise ValueError(f"{name}: expected an object of limit/max_queue/max_wait")
+    # (minimum, accepted types); bool is an int subclass, so it is rejected by hand
+    for key, (minimum, types) in {"limit": (1, int), "max_queue": (0, int),
+                                  "max_wait": (0, (int, float))}.items():
+        value = settings.get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, types) or value < minimum:
+            kind = "an integer" if types is int else "a number"
+            raise ValueError(f"{name}.{key} must be {kind} >= {minimum}, got {value!r}")
+
+
+class AdmissionController:
+    def __init__(self, pool_size: int = DB_POOL_MAX_SIZE, reserved_point_reads: int = RESERVED_POINT_READS):
+        self.pool_size = pool_size
+        self.reserved_point_reads = reserved_point_reads
+        self.limiters: Dict[str, ClassLimiter] = {}
+        for name, (limit, max_queue, max_wait) in DEFAULTS.items():
+            env = os.environ.get(f"ADMISSION_{name.upper()}_LIMIT")
+            self.limiters[name] = ClassLimiter(name, int(env) if env else limit, max_queue, max_wait)
+        self._fit_to_pool()
+
+    def _fit_to_pool(self):
+        # Small per-worker pools (see serve.py): shrink the reserve and scale the
+        # shared classes down proportionally, keeping at least one slot each.
+        self.reserved_point_reads = min(self.reserved_point_reads, max(0, self.pool_size - 3))
+        budget = self.pool_size - self.reserved_point_reads
+        shared = [l for n, l in self.limiters.items() if n != POINT_READS]
+        total = sum(l.limit for l in shared)
+        if total > budget:
+            for l in shared:
+                l.limit = max(1, l.limit * budget // total)
+        self.limiters[POINT_READS].limit = min(self.limiters[POINT_READS].limit, self.pool_size)
+
+    def _check_budget(self, overrides: Optional[Dict[str, int]] = None):
+        limits = {n: l.limit for n, l in self.limiters.items()}
+        limits.update(overrides or {})
+        shared = sum(v for n, v in limits.items() if n != POINT_READS)
+        budget = self.pool_size - self.reserved_point_reads
+        if shared > budget:
+            raise ValueError(
+                f"writes+analytics+bulk_reads limits ({shared}) exceed the "
+                f"{budget} connections left after reserving {self.reserved_point_reads} for point reads")
+
+    def configure(self, settings: Dict[str, Dict]):
+        unknown = set(settings) - set(self.limiters)
+        if unknown:
+            raise ValueError(f"Unknown route classes: {', '.join(sorted(unknown))}")
+        for name, s in settings.items():
+            _validate(name, s)
+        self._check_budget({n: s["limit"] for n, s in settings.items() if s.get("limit") is not None})
+        for name, s in settings.items():
+            self.limiters[name].configure(s.get("limit"), s.get("max_queue"), s.get("max_wait"))
+
+    def snapshot(self) -> Dict:
+        return {
+            "pool_size": self.pool_size,
+            "reserved_point_reads": self.reserved_point_reads,
+            "classes": {n: l.as_dict() for n, l in self.limiters.items()},
+        }
+
+
+def classify(method: str, path: str) -> Optional[str]:
+    if not path.startswith("/api/") or path.startswith(_EXEMPT_PREFIXES):
+        return None
+    if method not in ("GET", "HEAD"):
+        return WRITES
+    if path in _BULK_PATHS or path.startswith("/api/export/"):
+        return BULK_READS
+    if path.startswith("/api/analytics/"):
+        return ANALYTICS
+    return POINT_READS
+
+
+class AdmissionMiddleware:
+    """ASGI middleware: the slot is held until the response body has been sent."""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route_class = classify(scope["method"], scope["path"])
+        if route_class is None:
+            return await self.app(scope, receive, send)
+        limiter = self.controller.limiters[route_class]
+        try:
+            await limiter.acquire()
+        except Rejected as r:
+            body = json.dumps({"detail": f"Server busy ({r.route_class}), retry later"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"retry-after", str(r.retry_after).encode()),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        metrics.set_gauge(f"admission.{route_class}.active", limiter.active)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+            metrics.set_gauge(f"admission.{route_class}.active", limiter.active)
+
+
+admission = AdmissionController()
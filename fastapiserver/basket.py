@@ -0,0 +1,340 @@
+# basket.py
+# Top products per store and period, and "what sells together" rules.
+#
+# State is kept per day for the last BASKET_WINDOW_DAYS:
+#   - for sales, a heavy-hitter sketch (TopK) of products per store, by
+#     quantity and by revenue;
+#   - for each basket source, the number of baskets, per-item basket counts
+#     and a TopK of item pairs. A sales basket is one store's rows at one
+#     timestamp; an orders basket is one order's order_items.
+# A week or month is answered by merging its days' sketches, so memory per
+# store-day is bounded by BASKET_TOPK_CAPACITY whatever the product count.
+#
+# Updates are incremental: basket_refresh_loop runs a refresh every
+# BASKET_REFRESH_SECONDS, which reads a cheap per-day fingerprint (row count
+# and sums, on the date indexes) and rescans only the days whose fingerprint
+# moved, which in steady state is today plus any day that received late rows.
+# The first refresh scans the whole window, so requests never wait on it: they
+# get BasketsUnavailable (503) until it finishes. Endpoint results are cached
+# per state version. Days are naive UTC, like the date columns.
+import asyncio
+import os
+import time
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+from db import get_conn
+from storage import naive_utc
+from metrics import metrics
+from shards import router
+
+WINDOW_DAYS = int(os.environ.get("BASKET_WINDOW_DAYS", "90"))
+REFRESH_SECONDS = float(os.environ.get("BASKET_REFRESH_SECONDS", "60"))
+TOPK_CAPACITY = int(os.environ.get("BASKET_TOPK_CAPACITY", "100"))
+PAIR_CAPACITY = int(os.environ.get("BASKET_PAIR_CAPACITY", "5000"))
+CACHE_SIZE = 256
+
+SOURCES = ("sales", "orders")
+PERIODS = ("day", "week", "month")
+METRICS = ("quantity", "revenue")
+
+
+# --- Heavy hitters ---
+class TopK:
+    """Mergeable SpaceSaving summary of weighted counts.
+
+    Keeps at most `capacity` items. `floor` bounds the count of any item not
+    kept, so an item's true count lies in [count, count + error].
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[Hashable, float] = {}
+        self.errors: Dict[Hashable, float] = {}
+        self.floor = 0.0
+
+    @classmethod
+    def from_counts(cls, counts: Dict[Hashable, float], capacity: int) -> "TopK":
+        sketch = cls(capacity)
+        ranked = sorted(counts.items(), key=lambda kv: kv[1], reverse=True)
+        sketch.counts = dict(ranked[:capacity])
+        sketch.errors = dict.fromkeys(sketch.counts, 0.0)
+        sketch.floor = ranked[capacity][1] if len(ranked) > capacity else 0.0
+        return sketch
+
+    @classmethod
+    def merge(cls, sketches: Iterable["TopK"], capacity: int) -> "TopK":
+        sketches = list(sketches)
+        out = cls(capacity)
+        keys = set().union(*(s.counts for s in sketches)) if sketches else set()
+        counts, errors = {}, {}
+        for key in keys:
+            # A sketch that dropped the key may still have seen up to its floor
+            counts[key] = sum(s.counts.get(key, 0.0) for s in sketches)
+            errors[key] = sum(s.errors[key] if key in s.counts else s.floor for s in sketches)
+        ranked = sorted(keys, key=lambda k: counts[k] + errors[k], reverse=True)
+        out.counts = {k: counts[k] for k in ranked[:capacity]}
+        out.errors = {k: errors[k] for k in ranked[:capacity]}
+        dropped = max((counts[k] + errors[k] for k in ranked[capacity:]), default=0.0)
+        out.floor = max(sum(s.floor for s in sketches), dropped)
+        return out
+
+    def top(self, k: int) -> List[Dict]:
+        ranked = sorted(self.counts, key=lambda i: (self.counts[i], -self.errors[i]), reverse=True)
+        rows = ranked[:k]
+        # Upper bound of anything ranked below the cut, kept or not
+        below = max([self.counts[i] + self.errors[i] for i in ranked[k:]] + [self.floor])
+        return [{"item": i, "count": self.counts[i], "error": self.errors[i],
+                 "guaranteed": self.counts[i] >= below} for i in rows]
+
+
+class BasketsUnavailable(Exception):
+    pass
+
+
+class Baskets:
+    def __init__(self, n: int = 0, items: Optional[Counter] = None, pairs: Optional[TopK] = None):
+        self.n = n
+        self.items = items if items is not None else Counter()
+        self.pairs = pairs if pairs is not None else TopK(PAIR_CAPACITY)
+
+
+# --- Queries ---
+FINGERPRINT_SQL = {
+    "sales": """
+        SELECT date_trunc('day', date) AS day, COUNT(*) AS n,
+               COALESCE(SUM(quantity), 0) AS q, COALESCE(SUM(total_amount), 0) AS t
+        FROM sales WHERE date >= $1 AND date < $2 GROUP BY 1
+    """,
+    "orders": """
+        SELECT date_trunc('day', o.created_at) AS day, COUNT(*) AS n,
+               COALESCE(SUM(i.quantity), 0) AS q, COALESCE(SUM(o.total_amount), 0) AS t
+        FROM order_items i JOIN orders o ON o.id = i.order_id
+        WHERE o.created_at >= $1 AND o.created_at < $2 GROUP BY 1
+    """,
+}
+
+# Distinct (day, basket, item) rows for the days being rescanned
+BASKET_ITEMS_CTE = {
+    "sales": """
+        WITH b AS (
+          SELECT DISTINCT date_trunc('day', date) AS day, supermarket_id || '|' || date AS basket, product AS item
+          FROM sales WHERE date >= $1 AND date < $2 AND date_trunc('day', date) = ANY($3::timestamp[])
+        )
+    """,
+    "orders": """
+        WITH b AS (
+          SELECT DISTINCT date_trunc('day', o.created_at) AS day, o.id AS basket, i.product_name AS item
+          FROM order_items i JOIN orders o ON o.id = i.order_id
+          WHERE o.created_at >= $1 AND o.created_at < $2 AND date_trunc('day', o.created_at) = ANY($3::timestamp[])
+        )
+    """,
+}
+
+BASKET_COUNTS_SQL = """
+    SELECT day, COUNT(DISTINCT basket) AS baskets FROM b GROUP BY day
+"""
+ITEM_COUNTS_SQL = """
+    SELECT day, item, COUNT(*) AS n FROM b GROUP BY day, item
+"""
+PAIR_COUNTS_SQL = """
+    SELECT x.day, x.item AS a, y.item AS b, COUNT(*) AS n
+    FROM b x JOIN b y ON x.basket = y.basket AND x.item < y.item
+    GROUP BY x.day, x.item, y.item
+"""
+
+STORE_PRODUCTS_SQL = """
+    SELECT date_trunc('day', date) AS day, supermarket_id, product,
+           SUM(quantity) AS quantity, SUM(total_amount) AS revenue
+    FROM sales WHERE date >= $1 AND date < $2 AND date_trunc('day', date) = ANY($3::timestamp[])
+    GROUP BY 1, 2, 3
+"""
+
+
+def _day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def period_bounds(period: str, anchor: datetime) -> Tuple[datetime, datetime]:
+    start = _day(anchor)
+    if period == "week":
+        start -= timedelta(days=start.weekday())
+        return start, start + timedelta(days=7)
+    if period == "month":
+        start = start.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    return start, start + timedelta(days=1)
+
+
+class BasketAnalytics:
+    def __init__(self):
+        self.version = 0
+        self.fingerprints: Dict[str, Dict[datetime, Tuple]] = {s: {} for s in SOURCES}
+        self.baskets: Dict[str, Dict[datetime, Baskets]] = {s: {} for s in SOURCES}
+        # day -> store -> metric -> TopK
+        self.top: Dict[datetime, Dict[str, Dict[str, TopK]]] = {}
+        self._available: Dict[str, bool] = {}
+        self._refreshed_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._cache: "OrderedDict[Tuple, object]" = OrderedDict()
+
+    # --- Refresh ---
+    async def _source_available(self, source: str) -> bool:
+        if source not in self._available:
+            tables = ("sales",) if source == "sales" else ("orders", "order_items")
+            async with get_conn() as conn:
+                self._available[source] = all([await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", t)
+                                               for t in tables])
+        return self._available[source]
+
+    async def _fetch(self, source: str, query: str, *args):
+        if source == "sales":
+            return await router.fetch_all(query, *args)
+        async with get_conn() as conn:  # orders live on the home database
+            return await conn.fetch(query, *args)
+
+    def _check_loaded(self):
+        if self._refreshed_at is None:
+            raise BasketsUnavailable("Basket analytics are still loading; retry shortly")
+
+    async def refresh(self):
+        async with self._lock:
+            with metrics.timer("basket.refresh_seconds"):
+                end = _day(datetime.utcnow()) + timedelta(days=1)
+                start = end - timedelta(days=WINDOW_DAYS)
+                changed = False
+                for source in SOURCES:
+                    if await self._source_available(source):
+                        changed |= await self._refresh_source(source, start, end)
+            if changed:
+                self.version += 1
+                self._cache.clear()
+            self._refreshed_at = time.monotonic()
+
+    async def _refresh_source(self, source: str, start: datetime, end: datetime) -> bool:
+        totals: Dict[datetime, List] = defaultdict(lambda: [0, 0, 0])
+        for r in await self._fetch(source, FINGERPRINT_SQL[source], start, end):
+            t = totals[r["day"]]
+            t[0] += r["n"]
+            t[1] += r["q"]
+            t[2] += r["t"]
+        seen = {day: tuple(t) for day, t in totals.items()}
+        old = self.fingerprints[source]
+        stale = sorted(day for day, fp in seen.items() if old.get(day) != fp)
+        gone = [day for day in old if day not in seen]
+        for day in gone:  # emptied, or slid out of the window
+            self.baskets[source].pop(day, None)
+            if source == "sales":
+                self.top.pop(day, None)
+        if stale:
+            metrics.incr("basket.days_rescanned", len(stale))
+            lo, hi = stale[0], stale[-1] + timedelta(days=1)
+            await self._rescan_baskets(source, lo, hi, stale)
+            if source == "sales":
+                await self._rescan_top(lo, hi, stale)
+        self.fingerprints[source] = seen
+        return bool(stale or gone)
+
+    async def _rescan_baskets(self, source: str, lo: datetime, hi: datetime, days: List[datetime]):
+        cte = BASKET_ITEMS_CTE[source]
+        fresh = {day: Baskets() for day in days}
+        pairs: Dict[datetime, Counter] = defaultdict(Counter)
+        # Baskets never span shards (a sales basket is one store), so shard results add up
+        for r in await self._fetch(source, cte + BASKET_COUNTS_SQL, lo, hi, days):
+            fresh[r["day"]].n += r["baskets"]
+        for r in await self._fetch(source, cte + ITEM_COUNTS_SQL, lo, hi, days):
+            fresh[r["day"]].items[r["item"]] += r["n"]
+        for r in await self._fetch(source, cte + PAIR_COUNTS_SQL, lo, hi, days):
+            pairs[r["day"]][(r["a"], r["b"])] += r["n"]
+        for day, b in fresh.items():
+            b.pairs = TopK.from_counts(pairs[day], PAIR_CAPACITY)
+            self.baskets[source][day] = b
+
+    async def _rescan_top(self, lo: datetime, hi: datetime, days: List[datetime]):
+        counts: Dict[datetime, Dict[str, Dict[str, Counter]]] = defaultdict(
+            lambda: defaultdict(lambda: {m: Counter() for m in METRICS}))
+        for r in await router.fetch_all(STORE_PRODUCTS_SQL, lo, hi, days):
+            by_metric = counts[r["day"]][r["supermarket_id"]]
+            for m in METRICS:
+                by_metric[m][r["product"]] += r[m]
+        for day in days:
+            self.top[day] = {store: {m: TopK.from_counts(c, TOPK_CAPACITY) for m, c in by_metric.items()}
+                             for store, by_metric in counts.get(day, {}).items()}
+
+    # --- Cached results ---
+    def _cached(self, key: Tuple, compute):
+        key = (self.version,) + key
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            metrics.incr("basket.cache_hits")
+            return self._cache[key]
+        value = self._cache[key] = compute()
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return value
+
+    async def top_products(self, period: str = "week", anchor: Optional[datetime] = None, k: int = 10,
+                           metric: str = "quantity", store: Optional[str] = None) -> Dict:
+        if period not in PERIODS or metric not in METRICS:
+            raise ValueError(f"period must be one of {PERIODS} and metric one of {METRICS}")
+        self._check_loaded()
+        start, end = period_bounds(period, naive_utc(anchor) or datetime.utcnow())
+
+        def compute():
+            per_store: Dict[str, List[TopK]] = defaultdict(list)
+            for day, stores in self.top.items():
+                if start <= day < end:
+                    for s, sketches in stores.items():
+                        if store is None or s == store:
+                            per_store[s].append(sketches[metric])
+            return {"period": period, "start": start, "end": end, "metric": metric,
+                    "stores": {s: [{"product": r.pop("item"), **r} for r in TopK.merge(sk, TOPK_CAPACITY).top(k)]
+                               for s, sk in sorted(per_store.items())}}
+
+        return self._cached(("top", period, start, k, metric, store), compute)
+
+    async def rules(self, source: str = "sales", start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    min_support: float = 0.01, min_confidence: float = 0.1, product: Optional[str] = None,
+                    limit: int = 50) -> Dict:
+        if source not in SOURCES:
+            raise ValueError(f"source must be one of {SOURCES}")
+        self._check_loaded()
+        end = naive_utc(end) or _day(datetime.utcnow()) + timedelta(days=1)
+        start = naive_utc(start) or end - timedelta(days=30)
+
+        def compute():
+            days = [b for day, b in self.baskets[source].items() if start <= day < end]
+            n = sum(b.n for b in days)
+            items = sum((b.items for b in days), Counter())
+            pairs = TopK.merge((b.pairs for b in days), PAIR_CAPACITY)
+            rules = []
+            if n:
+                for (a, b), together in pairs.counts.items():
+                    support = together / n
+                    if support < min_support:
+                        continue
+                    for x, y in ((a, b), (b, a)):
+                        if product is not None and x != product:
+                            continue
+                        confidence = together / items[x]
+                        if confidence >= min_confidence:
+                            rules.append({"antecedent": x, "consequent": y, "count": together,
+                                          "support": round(support, 6), "confidence": round(confidence, 6),
+                                          "lift": round(confidence / (items[y] / n), 6)})
+            rules.sort(key=lambda r: (r["lift"], r["confidence"], r["count"]), reverse=True)
+            return {"source": source, "start": start, "end": end, "baskets": n,
+                    "approximate": pairs.floor > 0, "rules": rules[:limit]}
+
+        return self._cached(("rules", source, start, end, min_support, min_confidence, product, limit), compute)
+
+
+async def basket_refresh_loop(interval: float = REFRESH_SECONDS):
+    while True:
+        try:
+            await baskets.refresh()
+        except Exception as e:  # keep the loop alive; the previous state keeps serving
+            print(f"basket refresh failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+baskets = BasketAnalytics()
@@ -0,0 +1,160 @@
+# bench/checkout_contention.py
+# Concurrent checkouts competing for a few popular products.
+#
+#   python bench/checkout_contention.py [--checkouts 500] [--concurrency 200]
+#                                       [--hot 3] [--stock 400] [--duplicates 0.1]
+#
+# Seeds tagged products (a few "hot" ones every cart contains, plus a long
+# tail), one cart per checkout with its lines in random order, then runs the
+# checkouts through checkout.checkout() with the given concurrency. A
+# fraction of them is submitted twice at once with the same idempotency key.
+# Prints throughput, latency percentiles and outcome counts, then checks the
+# invariants: no deadlocks, no negative stock, stock sold == quantities in
+# the created orders, and at most one order per key. Exit status is non-zero
+# if any check fails. Uses DATABASE_URL (size the pool with
+# DB_POOL_MAX_SIZE) and deletes its rows afterwards.
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import asyncpg  # noqa: E402
+import checkout  # noqa: E402
+from db import init_db_pool, close_db_pool, get_conn  # noqa: E402
+
+CUSTOMER = {"name": "Bench Customer", "email": "bench@example.com", "phone": "0000000000"}
+ADDRESS = {"street": "1 Bench Road", "city": "Hyderabad", "state": "Telangana", "zip": "500001"}
+
+
+async def seed(tag: str, args):
+    rng = random.Random(7)
+    async with get_conn() as conn:
+        hot = [r["id"] for r in await conn.fetch("""
+            INSERT INTO products (name, description, price, category, in_stock, colors)
+            SELECT $1 || ' hot ' || n, 'bench', 999.00, $1, $2, ARRAY['black']
+            FROM generate_series(1, $3) n RETURNING id
+        """, tag, args.stock, args.hot)]
+        tail = [r["id"] for r in await conn.fetch("""
+            INSERT INTO products (name, description, price, category, in_stock, colors)
+            SELECT $1 || ' tail ' || n, 'bench', 199.00, $1, 100000, ARRAY['white']
+            FROM generate_series(1, 50) n RETURNING id
+        """, tag)]
+        lines = []
+        for i in range(args.checkouts):
+            products = hot + rng.sample(tail, 3)
+            rng.shuffle(products)  # carts list popular items in any order
+            lines += [(f"{tag}:{i}", p, rng.randint(1, 2)) for p in products]
+        await conn.copy_records_to_table("cart_items", records=lines,
+                                         columns=["session_id", "product_id", "quantity"])
+    return hot + tail
+
+
+async def run(tag: str, args):
+    sem = asyncio.Semaphore(args.concurrency)
+    latencies, outcomes = [], Counter()
+    rng = random.Random(11)
+
+    async def one(i: int):
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                order = await checkout.checkout(f"{tag}:{i}", CUSTOMER, ADDRESS, idempotency_key=f"{tag}:{i}")
+                outcomes["replayed" if order["replayed"] else "created"] += 1
+            except checkout.CheckoutConflict:
+                outcomes["out_of_stock"] += 1
+            except checkout.EmptyCart:
+                outcomes["empty_cart"] += 1
+            except asyncpg.exceptions.DeadlockDetectedError:
+                outcomes["deadlock"] += 1
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+    jobs = [one(i) for i in range(args.checkouts)]
+    jobs += [one(i) for i in range(args.checkouts) if rng.random() < args.duplicates]
+    rng.shuffle(jobs)
+    t0 = time.perf_counter()
+    await asyncio.gather(*jobs)
+    return time.perf_counter() - t0, latencies, outcomes
+
+
+async def verify(tag: str, products, stock_before) -> list:
+    failures = []
+    async with get_conn() as conn:
+        after = {r["id"]: r["in_stock"] for r in await conn.fetch(
+            "SELECT id, in_stock FROM products WHERE id = ANY($1::int[])", products)}
+        sold = {r["product_id"]: r["sold"] for r in await conn.fetch("""
+            SELECT i.product_id, SUM(i.quantity) AS sold
+            FROM order_items i JOIN orders o ON o.id = i.order_id
+            WHERE o.idempotency_key LIKE $1 || ':%' GROUP BY i.product_id
+        """, tag)}
+        dup_orders = await conn.fetchval("""
+            SELECT COUNT(*) FROM (SELECT session_id FROM orders WHERE idempotency_key LIKE $1 || ':%'
+                                  GROUP BY session_id HAVING COUNT(*) > 1) d
+        """, tag)
+    for p in products:
+        if after[p] < 0:
+            failures.append(f"product {p}: negative stock {after[p]}")
+        if stock_before[p] - after[p] != sold.get(p, 0):
+            failures.append(f"product {p}: stock moved {stock_before[p] - after[p]}, orders hold {sold.get(p, 0)}")
+    if dup_orders:
+        failures.append(f"{dup_orders} carts produced more than one order")
+    return failures
+
+
+async def cleanup(tag: str, products):
+    async with get_conn() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                DELETE FROM order_items WHERE order_id IN
+                  (SELECT id FROM orders WHERE idempotency_key LIKE $1 || ':%')
+            """, tag)
+            await conn.execute("DELETE FROM orders WHERE idempotency_key LIKE $1 || ':%'", tag)
+            await conn.execute("DELETE FROM cart_items WHERE session_id LIKE $1 || ':%'", tag)
+            await conn.execute("DELETE FROM products WHERE id = ANY($1::int[])", products)
+
+
+async def main(args):
+    await init_db_pool()
+    await checkout.install_checkout()
+    tag = f"bench-{uuid.uuid4().hex[:8]}"
+    products = []
+    try:
+        products = await seed(tag, args)
+        async with get_conn() as conn:
+            stock_before = {r["id"]: r["in_stock"] for r in await conn.fetch(
+                "SELECT id, in_stock FROM products WHERE id = ANY($1::int[])", products)}
+        elapsed, latencies, outcomes = await run(tag, args)
+        failures = await verify(tag, products, stock_before)
+        if outcomes["deadlock"]:
+            failures.append(f"{outcomes['deadlock']} deadlocks")
+    finally:
+        if products:
+            await cleanup(tag, products)
+        await close_db_pool()
+
+    latencies.sort()
+    pct = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))]  # noqa: E731
+    print(f"{len(latencies)} checkouts in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s), "
+          f"concurrency {args.concurrency}")
+    print(f"latency ms  p50 {statistics.median(latencies):.1f}  p95 {pct(0.95):.1f}  p99 {pct(0.99):.1f}")
+    print("outcomes    " + "  ".join(f"{k} {v}" for k, v in sorted(outcomes.items())))
+    for f in failures:
+        print(f"FAIL {f}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent checkout contention benchmark")
+    parser.add_argument("--checkouts", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--hot", type=int, default=3, help="products every cart contains")
+    parser.add_argument("--stock", type=int, default=400, help="starting stock of each hot product")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="fraction submitted twice")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,94 @@
+# bench/cold_start.py
+# Startup-to-first-200 measurement for one API worker.
+#
+#   python bench/cold_start.py [--runs 5] [--path /api/clients]
+#
+# Starts `uvicorn main:app` on a free port and records, from process spawn,
+# when /healthz first answers, when /readyz turns 200 (pool open and warm),
+# and when a real API call first returns 200. Medians are compared with the
+# budget in startup_budget.json for the backend being measured; the exit
+# status is non-zero when any is over budget.
+#
+# The backend is the one the server would pick: Postgres by default, which
+# needs a reachable DATABASE_URL and measures the production startup path
+# (installs, warm-up, background loops), or STORAGE_BACKEND=sqlite.
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(HERE)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _status(url: str):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as r:
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def run_once(path: str, timeout: float = 30.0):
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=SERVER_DIR)
+    marks = {}
+    try:
+        while len(marks) < 3:
+            if time.perf_counter() - t0 > timeout:
+                raise RuntimeError(f"server not ready after {timeout}s: {marks}")
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode}")
+            for key, url in (("spawn_to_healthz_ms", "/healthz"),
+                             ("spawn_to_ready_ms", "/readyz"),
+                             ("spawn_to_first_api_200_ms", path)):
+                if key not in marks and _status(base + url) == 200:
+                    marks[key] = (time.perf_counter() - t0) * 1000
+            time.sleep(0.01)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return marks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/api/clients")
+    args = parser.parse_args()
+
+    backend = "sqlite" if os.environ.get("STORAGE_BACKEND", "postgres") == "sqlite" else "postgres"
+    with open(os.path.join(HERE, "startup_budget.json")) as f:
+        budget = json.load(f)[backend]
+    runs = [run_once(args.path) for _ in range(args.runs)]
+    print(f"backend: {backend}")
+    over = False
+    for key in ("spawn_to_healthz_ms", "spawn_to_ready_ms", "spawn_to_first_api_200_ms"):
+        median = statistics.median(r[key] for r in runs)
+        flag = "OK" if median <= budget[key] else "OVER"
+        over = over or flag == "OVER"
+        print(f"{key:28} median {median:8.1f} ms  budget {budget[key]:6d} ms  {flag}")
+    if over:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
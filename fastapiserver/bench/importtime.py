@@ -0,0 +1,66 @@
+# bench/importtime.py
+# Import-time report for the API process, built from `python -X importtime`.
+#
+#   python bench/importtime.py [--module main] [--top 25] [--out bench/importtime_report.txt]
+#
+# Prints the slowest imports by cumulative time, writes the full sorted report
+# to --out so it can be committed and diffed between changes, and exits
+# non-zero if the total exceeds "import_main_ms" in startup_budget.json.
+# Imports made by main.startup are not in it; cold_start.py times those on
+# the Postgres path. The numpy-backed modules (cube, forecast, snapshot) are
+# imported there only when CUBE_ENABLED, FORECAST_REFRESH_SECONDS or
+# SNAPSHOT_REFRESH_SECONDS turn them on.
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(HERE)
+
+
+def measure(module: str):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SERVER_DIR, capture_output=True, text=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr[-2000:])
+    rows = []
+    for line in proc.stderr.splitlines():
+        # "import time:      self [us] |  cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    # Nesting is shown by indentation; top-level imports have a single space
+    total_us = sum(r[0] for r in rows if not r[2].startswith("  "))
+    return total_us, sorted(rows, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--out", default=os.path.join(HERE, "importtime_report.txt"))
+    args = parser.parse_args()
+
+    total_us, rows = measure(args.module)
+    with open(os.path.join(HERE, "startup_budget.json")) as f:
+        budget_ms = json.load(f)["import_main_ms"]
+
+    lines = [f"interpreter startup + import {args.module}: {total_us / 1000:.1f} ms (budget {budget_ms} ms)",
+             f"{'cumulative ms':>14} {'self ms':>9}  module"]
+    lines += [f"{c / 1000:>14.1f} {s / 1000:>9.1f}  {n}" for c, s, n in rows]
+    with open(args.out, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines[:args.top + 2]))
+    print(f"full report: {args.out}")
+    if total_us / 1000 > budget_ms:
+        raise SystemExit(f"over budget by {total_us / 1000 - budget_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# bench/storage_analytics.py
+# Analytics query timings per storage backend.
+#
+#   python bench/storage_analytics.py [--rows 100000] [--runs 7] [--backends sqlite,postgres]
+#
+# Seeds the same synthetic sales and customer_traffic rows (January 2001,
+# two tagged stores) into each backend, then times every analytics method
+# for that window and prints median / p95 milliseconds side by side. The
+# postgres run uses DATABASE_URL and deletes its rows afterwards.
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from storage_conformance import WINDOW, seed_sales  # noqa: E402
+
+METHODS = [
+    "get_sales_by_category", "get_sales_by_payment_method", "get_sales_by_demographic",
+    "get_traffic_by_hour", "get_traffic_by_supermarket", "get_sales",
+]
+
+
+def sales_rows(store_ids, n):
+    return [(str(uuid.uuid4()), s["supermarketId"], s["date"], s["category"], s["product"], s["quantity"],
+             s["unitPrice"], s["totalAmount"], s["paymentMethod"], s["customerAge"], s["customerGender"])
+            for s in seed_sales(store_ids, n)]
+
+
+def traffic_rows(store_ids):
+    rows = []
+    for store in store_ids:
+        for day in range(31):
+            for hour in range(7, 22):
+                rows.append((str(uuid.uuid4()), store, WINDOW[0] + timedelta(days=day), hour,
+                             (day * 7 + hour * 13) % 90 + 10, (day + hour) % 40 + 60))
+    return rows
+
+
+async def time_methods(storage, runs: int):
+    out = {}
+    for name in METHODS:
+        fn = getattr(storage, name)
+        await fn(*WINDOW)  # warm caches / statement plans
+        samples = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            await fn(*WINDOW)
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+        out[name] = (statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))])
+    return out
+
+
+SALES_COLS = ("id, supermarket_id, date, category, product, quantity, unit_price, total_amount, "
+              "payment_method, customer_age, customer_gender")
+TRAFFIC_COLS = "id, supermarket_id, date, hour, visitor_count, avg_transaction_value"
+
+
+async def bench_sqlite(rows: int, runs: int):
+    from sqlite_storage import SQLiteStorage
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(os.path.join(tmp, "bench.db"))
+        await storage.open()
+        try:
+            stores = [(await storage.create_supermarket({"name": f"bench {n}", "location": "x", "city": "c",
+                                                         "region": "r", "size": "small", "type": "urban"}))["id"]
+                      for n in range(2)]
+
+            def seed(conn):
+                conn.executemany(f"INSERT INTO sales ({SALES_COLS}) VALUES ({','.join('?' * 11)})",
+                                 sales_rows(stores, rows))
+                conn.executemany(f"INSERT INTO customer_traffic ({TRAFFIC_COLS}) VALUES ({','.join('?' * 6)})",
+                                 traffic_rows(stores))
+                conn.execute("ANALYZE")
+
+            await storage._write(seed)
+            return await time_methods(storage, runs)
+        finally:
+            await storage.close()
+
+
+async def bench_postgres(rows: int, runs: int):
+    from storage import Storage
+    from db import init_db_pool, close_db_pool, get_conn
+    await init_db_pool()
+    storage = Storage()
+    tag = f"bench {uuid.uuid4().hex[:8]}"
+    stores = [(await storage.create_supermarket({"name": f"{tag} {n}", "location": "x", "city": "c",
+                                                 "region": "r", "size": "small", "type": "urban"}))["id"]
+              for n in range(2)]
+    try:
+        async with get_conn() as conn:
+            await conn.copy_records_to_table("sales", records=sales_rows(stores, rows),
+                                             columns=[c.strip() for c in SALES_COLS.split(",")])
+            await conn.copy_records_to_table("customer_traffic", records=traffic_rows(stores),
+                                             columns=[c.strip() for c in TRAFFIC_COLS.split(",")])
+            await conn.execute("ANALYZE sales; ANALYZE customer_traffic")
+        return await time_methods(storage, runs)
+    finally:
+        async with get_conn() as conn:
+            for table in ("sales", "customer_traffic"):
+                await conn.execute(f"DELETE FROM {table} WHERE supermarket_id = ANY($1)", stores)
+            await conn.execute("DELETE FROM supermarkets WHERE id = ANY($1)", stores)
+        await close_db_pool()
+
+
+BACKENDS = {"sqlite": bench_sqlite, "postgres": bench_postgres}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time analytics queries per storage backend")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--backends", default="sqlite,postgres")
+    args = parser.parse_args()
+    names = args.backends.split(",")
+    results = {name: asyncio.run(BACKENDS[name](args.rows, args.runs)) for name in names}
+    print(f"{'method':32}" + "".join(f"{n + ' p50/p95 ms':>26}" for n in names))
+    for method in METHODS:
+        print(f"{method:32}" + "".join(f"{results[n][method][0]:>12.2f} /{results[n][method][1]:>11.2f}"
+                                       for n in names))
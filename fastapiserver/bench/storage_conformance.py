@@ -0,0 +1,261 @@
+# bench/storage_conformance.py
+# Conformance run for the storage backends.
+#
+#   python bench/storage_conformance.py [--backends sqlite,postgres]
+#
+# Drives every StorageBackend method through the same scenario and checks
+# the results against values computed here in Python, so both backends are
+# held to one reference (and therefore to each other). The sqlite run uses a
+# throwaway file. The postgres run uses DATABASE_URL: its rows are tagged
+# with a random marker, analytics are read for a January 2001 window that no
+# real data falls in, and everything it wrote is deleted at the end.
+# Exit status is non-zero on the first mismatch.
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+WINDOW = (datetime(2001, 1, 1), datetime(2001, 2, 1))
+CATEGORIES = ["dairy", "bakery", "produce", "frozen"]
+METHODS = ["cash", "card", "mobile"]
+
+
+class Mismatch(AssertionError):
+    pass
+
+
+def check(name, got, expected):
+    if got != expected:
+        raise Mismatch(f"{name}: got {got!r}, expected {expected!r}")
+
+
+def close(a, b) -> bool:
+    return a is not None and b is not None and abs(float(a) - float(b)) < 1e-6
+
+
+def age_group(age):
+    if age < 25:
+        return "under_25"
+    if age <= 44:
+        return "25_44"
+    if age <= 64:
+        return "45_64"
+    return "65_plus"
+
+
+def seed_sales(store_ids, n=300, seed=7):
+    rnd = random.Random(seed)
+    return [{
+        "supermarketId": rnd.choice(store_ids),
+        "date": WINDOW[0] + timedelta(minutes=rnd.randrange(30 * 24 * 60)),
+        "category": rnd.choice(CATEGORIES),
+        "product": f"p{rnd.randrange(20)}",
+        "quantity": rnd.randint(1, 5),
+        "unitPrice": rnd.randint(100, 900),
+        "totalAmount": rnd.randint(100, 4500),
+        "paymentMethod": rnd.choice(METHODS),
+        "customerAge": rnd.randint(16, 80),
+        "customerGender": rnd.choice(["female", "male"]),
+    } for _ in range(n)]
+
+
+async def run_scenario(storage, tag: str):
+    # --- CRM ---
+    c = await storage.create_client({"name": f"{tag} Ada", "email": "ada@example.com", "phone": None,
+                                     "company": f"{tag} Co", "status": "active", "lastContact": None})
+    check("create_client.name", c["name"], f"{tag} Ada")
+    check("get_client", (await storage.get_client(c["id"]))["email"], "ada@example.com")
+    check("update_client", (await storage.update_client(c["id"], {"status": "inactive"}))["status"], "inactive")
+    check("update_client.missing", await storage.update_client(str(uuid.uuid4()), {"status": "x"}), None)
+    check("search_clients", [r["id"] for r in await storage.search_clients(tag.lower())], [c["id"]])
+    check("get_clients", c["id"] in {r["id"] for r in await storage.get_clients()}, True)
+
+    due = datetime(2030, 5, 1, 9, 30)
+    f1 = await storage.create_follow_up({"clientId": c["id"], "title": "call", "description": None,
+                                         "scheduledDate": due + timedelta(days=1), "type": "call"})
+    f2 = await storage.create_follow_up({"clientId": c["id"], "title": "visit", "description": "x",
+                                         "scheduledDate": due, "type": "meeting"})
+    check("create_follow_up.completed", f1["completed"], False)
+    check("follow_ups_by_client order", [r["id"] for r in await storage.get_follow_ups_by_client(c["id"])],
+          [f2["id"], f1["id"]])
+    done = await storage.complete_follow_up(f1["id"])
+    check("complete_follow_up", (done["completed"], done["completed_at"] is not None), (True, True))
+    check("update_follow_up", (await storage.update_follow_up(f2["id"], {"title": "visit 2"}))["title"], "visit 2")
+    check("get_follow_up", (await storage.get_follow_up(f2["id"]))["title"], "visit 2")
+    check("delete_follow_up", await storage.delete_follow_up(f2["id"]), True)
+    check("delete_follow_up.again", await storage.delete_follow_up(f2["id"]), False)
+
+    t = await storage.create_task({"clientId": c["id"], "title": "quote", "description": None,
+                                   "dueDate": due, "priority": "high"})
+    check("create_task", (t["priority"], t["completed"], t["due_date"]), ("high", False, due))
+    check("get_tasks_by_client", [r["id"] for r in await storage.get_tasks_by_client(c["id"])], [t["id"]])
+    mine = {f1["id"], t["id"]}
+    agenda = await storage.get_agenda(due - timedelta(days=1), due + timedelta(days=2))
+    check("get_agenda", [(r["kind"], r["id"]) for r in agenda if r["id"] in mine], [("task", t["id"])])
+    agenda = await storage.get_agenda(due - timedelta(days=1), due + timedelta(days=2), include_completed=True)
+    check("get_agenda.completed", [(r["id"], r["due_at"]) for r in agenda if r["id"] in mine],
+          [(t["id"], due), (f1["id"], due + timedelta(days=1))])
+    check("complete_task", (await storage.complete_task(t["id"]))["completed"], True)
+    check("update_task", (await storage.update_task(t["id"], {"priority": "low"}))["priority"], "low")
+    check("get_task", (await storage.get_task(t["id"]))["priority"], "low")
+    check("get_tasks", t["id"] in {r["id"] for r in await storage.get_tasks()}, True)
+
+    i = await storage.create_interaction({"clientId": c["id"], "type": "email", "subject": "hi", "notes": None})
+    check("get_interactions_by_client", [r["id"] for r in await storage.get_interactions_by_client(c["id"])], [i["id"]])
+    check("get_interactions", i["id"] in {r["id"] for r in await storage.get_interactions()}, True)
+
+    for n in range(2):
+        await storage.create_interaction({"clientId": c["id"], "type": "call", "subject": f"hi {n}", "notes": None})
+    newest = [r["id"] for r in sorted(await storage.get_interactions_by_client(c["id"]),
+                                      key=lambda r: (r["created_at"], r["id"]), reverse=True)]
+    ov = await storage.get_client_overview(c["id"], limit=2)
+    check("client_overview", (ov["name"], ov["open_follow_ups"], ov["open_tasks"], ov["last_interaction_at"] is not None,
+                              ov["last_completed_at"] is not None, [r["id"] for r in ov["tasks"]["items"]]),
+          (f"{tag} Ada", 0, 0, True, True, [t["id"]]))
+    check("client_overview.page", [r["id"] for r in ov["interactions"]["items"]], newest[:2])
+    rest = await storage.get_client_section(c["id"], "interactions", ov["interactions"]["next_cursor"], limit=2)
+    check("client_section.cursor", ([r["id"] for r in rest["items"]], rest["next_cursor"]), (newest[2:], None))
+    # --- Bulk ---
+    fid = [r["id"] for r in (await storage.bulk_mutate("follow_ups", {"create": [
+        {"clientId": c["id"], "title": f"bulk {n}", "description": None, "scheduledDate": due,
+         "completed": False, "completedAt": None, "type": "call"} for n in range(3)]}))["created"]]
+    missing = str(uuid.uuid4())
+    res = await storage.bulk_mutate("follow_ups", {
+        "update": [{"id": fid[0], "changes": {"title": "moved", "scheduled_date": "2030-05-03T09:30:00"}},
+                   {"id": fid[1], "changes": {"title": "renamed"}}, {"id": missing, "changes": {"title": "x"}}],
+        "complete": [fid[1], missing], "delete": [fid[2]]})
+    check("bulk.results", [(r["op"], r["status"]) for r in res["results"]],
+          [("update", "updated"), ("update", "updated"), ("update", "not_found"),
+           ("complete", "completed"), ("complete", "not_found"), ("delete", "deleted")])
+    got = {r["id"]: r for r in await storage.get_follow_ups_by_client(c["id"])}
+    check("bulk.applied", (got[fid[0]]["title"], got[fid[0]]["scheduled_date"], got[fid[1]]["completed"], fid[2] in got),
+          ("moved", datetime(2030, 5, 3, 9, 30), True, False))
+    try:
+        await storage.bulk_mutate("follow_ups", {"update": [{"id": fid[0], "changes": {"title": "y"}}],
+                                                 "complete": [fid[0]], "delete": [fid[0], fid[0]]})
+        check("bulk.duplicate_ids", "accepted", "ValueError")
+    except ValueError:
+        check("bulk.untouched", (await storage.get_follow_up(fid[0]))["title"], "moved")
+    await storage.bulk_mutate("follow_ups", {"delete": fid})
+
+    check("client_overview.missing", await storage.get_client_overview(str(uuid.uuid4())), None)
+
+    # --- Stores ---
+    stores = [await storage.create_supermarket({"name": f"{tag} store {n}", "location": "x", "city": "c",
+                                                "region": "r", "size": "small", "type": "urban"})
+              for n in range(2)]
+    ids = [s["id"] for s in stores]
+    check("get_supermarkets", set(ids) <= {r["id"] for r in await storage.get_supermarkets()}, True)
+
+    sales = seed_sales(ids)
+    for s in sales:
+        await storage.create_sales(s)
+    got = [r for r in await storage.get_sales(*WINDOW) if r["supermarket_id"] in ids]
+    check("get_sales.count", len(got), len(sales))
+    check("get_sales.order", [r["date"] for r in got], sorted((r["date"] for r in got), reverse=True))
+
+    def grouped(key):
+        acc = defaultdict(lambda: [0, 0])
+        for s in sales:
+            acc[key(s)][0] += s["totalAmount"]
+            acc[key(s)][1] += 1
+        return {k: tuple(v) for k, v in acc.items()}
+
+    for name, fn, key_fields, key in (
+            ("by_category", storage.get_sales_by_category, ("category",), lambda s: (s["category"],)),
+            ("by_payment_method", storage.get_sales_by_payment_method, ("method",), lambda s: (s["paymentMethod"],)),
+            ("by_demographic", storage.get_sales_by_demographic, ("gender", "age_group"),
+             lambda s: (s["customerGender"], age_group(s["customerAge"])))):
+        rows = await fn(*WINDOW)
+        check(f"sales_{name}", {tuple(r[k] for k in key_fields): (r["total"], r["count"]) for r in rows},
+              grouped(key))
+        check(f"sales_{name}.order", [r["total"] for r in rows], sorted((r["total"] for r in rows), reverse=True))
+
+    for n, (cur, minimum) in enumerate([(3, 10), (50, 10), (10, 10)]):
+        await storage.create_inventory({"supermarketId": ids[0], "product": f"{tag} item {n}", "category": "dairy",
+                                        "currentStock": cur, "minimumStock": minimum, "lastRestocked": None,
+                                        "supplier": "s", "costPrice": 1, "sellingPrice": 2})
+    check("get_inventory_by_supermarket", [r["product"] for r in await storage.get_inventory_by_supermarket(ids[0])],
+          [f"{tag} item {n}" for n in range(3)])
+    low = [r["product"] for r in await storage.get_low_stock_items() if r["supermarket_id"] in ids]
+    check("get_low_stock_items", low, [f"{tag} item 0", f"{tag} item 2"])
+    check("get_inventory", len([r for r in await storage.get_inventory() if r["supermarket_id"] in ids]), 3)
+
+    hour = datetime(2001, 1, 3, 14, 20)
+    first = await storage.create_customer_traffic({"supermarketId": ids[0], "date": hour, "hour": 14,
+                                                   "visitorCount": 10, "avgTransactionValue": 100})
+    merged = await storage.create_customer_traffic({"supermarketId": ids[0], "date": hour, "hour": 14,
+                                                    "visitorCount": 30, "avgTransactionValue": 200})
+    check("create_customer_traffic.upsert", (merged["id"], merged["visitor_count"], merged["avg_transaction_value"],
+                                             merged["date"]), (first["id"], 40, 175, datetime(2001, 1, 3)))
+    await storage.create_customer_traffic({"supermarketId": ids[1], "date": hour, "hour": 9,
+                                           "visitorCount": 5, "avgTransactionValue": 50})
+    by_hour = {r["hour"]: (r["totalvisitors"], r["avgtransaction"]) for r in await storage.get_traffic_by_hour(*WINDOW)}
+    check("traffic_by_hour.keys", sorted(by_hour), [9, 14])
+    check("traffic_by_hour.14", (by_hour[14][0], close(by_hour[14][1], 175)), (40, True))
+    by_store = [(r["name"], r["totalvisitors"]) for r in await storage.get_traffic_by_supermarket(*WINDOW)]
+    check("traffic_by_supermarket", by_store, [(f"{tag} store 0", 40), (f"{tag} store 1", 5)])
+    check("get_customer_traffic",
+          len([r for r in await storage.get_customer_traffic() if r["supermarket_id"] in ids]), 2)
+
+    check("delete_task", await storage.delete_task(t["id"]), True)
+    return c["id"], ids
+
+
+async def run_sqlite():
+    from sqlite_storage import SQLiteStorage
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(os.path.join(tmp, "conformance.db"))
+        await storage.open()
+        try:
+            await run_scenario(storage, f"T{uuid.uuid4().hex[:8]}")
+        finally:
+            await storage.close()
+
+
+async def run_postgres():
+    from storage import Storage
+    from db import init_db_pool, close_db_pool, get_conn
+    await init_db_pool()
+    tag = f"T{uuid.uuid4().hex[:8]}"
+    try:
+        await run_scenario(Storage(), tag)
+    finally:
+        async with get_conn() as conn:
+            stores = [r["id"] for r in await conn.fetch(
+                "SELECT id FROM supermarkets WHERE name LIKE $1", f"{tag}%")]
+            clients = [r["id"] for r in await conn.fetch(
+                "SELECT id FROM clients WHERE name LIKE $1", f"{tag}%")]
+            for table in ("sales", "inventory", "customer_traffic"):
+                await conn.execute(f"DELETE FROM {table} WHERE supermarket_id = ANY($1)", stores)
+            await conn.execute("DELETE FROM supermarkets WHERE id = ANY($1)", stores)
+            for table in ("follow_ups", "tasks", "interactions"):
+                await conn.execute(f"DELETE FROM {table} WHERE client_id = ANY($1)", clients)
+            await conn.execute("DELETE FROM clients WHERE id = ANY($1)", clients)
+        await close_db_pool()
+
+
+BACKENDS = {"sqlite": run_sqlite, "postgres": run_postgres}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the storage conformance scenario")
+    parser.add_argument("--backends", default="sqlite,postgres")
+    args = parser.parse_args()
+    failed = False
+    for name in args.backends.split(","):
+        try:
+            asyncio.run(BACKENDS[name]())
+            print(f"{name}: ok")
+        except Mismatch as e:
+            print(f"{name}: FAIL {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
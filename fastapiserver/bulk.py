@@ -0,0 +1,115 @@
+# bulk.py
+# Batched create / update / complete / delete for follow-ups and tasks.
+#
+# A batch is applied in one transaction with one set-based statement per
+# operation: creates and updates go through unnest() of per-column arrays,
+# completes and deletes through id = ANY($1). Updates are grouped by the set
+# of columns they change, so each group is one UPDATE ... FROM unnest(...).
+# Statement text depends only on the table, operation and (sorted) column
+# set, so the handful of common shapes hit the connection's prepared
+# statement cache instead of being re-parsed per call.
+#
+# Validation happens here, before the database is touched: unknown columns,
+# badly typed values, ids repeated within an operation and batches over
+# BULK_MAX_OPS are rejected as a whole.
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+
+MAX_OPS = int(os.environ.get("BULK_MAX_OPS", "1000"))
+
+OPERATIONS = ("create", "update", "complete", "delete")
+
+# Writable columns and their Postgres array element types, in insert order
+COLUMNS: Dict[str, Dict[str, str]] = {
+    "follow_ups": {
+        "client_id": "varchar", "title": "text", "description": "text", "scheduled_date": "timestamp",
+        "completed": "boolean", "completed_at": "timestamp", "type": "text",
+    },
+    "tasks": {
+        "client_id": "varchar", "title": "text", "description": "text", "due_date": "timestamp",
+        "completed": "boolean", "completed_at": "timestamp", "priority": "text",
+    },
+}
+
+# Columns an update may not set to NULL
+REQUIRED = {"follow_ups": {"client_id", "title", "scheduled_date", "type"}, "tasks": {"title"}}
+
+
+class BatchTooLarge(ValueError):
+    pass
+
+
+def _camel(column: str) -> str:
+    head, *rest = column.split("_")
+    return head + "".join(w.title() for w in rest)
+
+
+def _coerce(table: str, column: str, value: Any) -> Any:
+    kind = COLUMNS[table][column]
+    if value is None:
+        if column in REQUIRED[table]:
+            raise ValueError(f"{table}.{column} cannot be null")
+        return None
+    if kind == "timestamp":
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                raise ValueError(f"{table}.{column}: not a timestamp: {value!r}")
+        if not isinstance(value, datetime):
+            raise ValueError(f"{table}.{column}: not a timestamp: {value!r}")
+        if value.tzinfo is not None:  # columns are TIMESTAMP (UTC, no zone)
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if kind == "boolean":
+        if not isinstance(value, bool):
+            raise ValueError(f"{table}.{column}: not a boolean: {value!r}")
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"{table}.{column}: not a string: {value!r}")
+    return value
+
+
+def _unique(ids: List[str], op: str) -> List[str]:
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"Duplicate ids in {op}")
+    return ids
+
+
+class Batch:
+    """A validated batch: creates as rows in COLUMNS order, updates grouped by column set."""
+
+    def __init__(self, table: str, ops: Dict):
+        if table not in COLUMNS:
+            raise ValueError(f"Bulk operations are not supported for {table!r}")
+        size = sum(len(ops.get(op) or []) for op in OPERATIONS)
+        if size > MAX_OPS:
+            raise BatchTooLarge(f"Batch has {size} operations; the limit is {MAX_OPS}")
+        columns = COLUMNS[table]
+        self.table = table
+        self.creates: List[Tuple] = [
+            tuple(_coerce(table, c, payload.get(_camel(c))) for c in columns)
+            for payload in ops.get("create") or []]
+        self.updates: Dict[Tuple[str, ...], List[Tuple]] = defaultdict(list)
+        update_ids = []
+        for item in ops.get("update") or []:
+            changes = item["changes"]
+            unknown = set(changes) - columns.keys()
+            if unknown:
+                raise ValueError(f"Unknown {table} columns: {', '.join(sorted(unknown))}")
+            if not changes:
+                raise ValueError(f"Update of {item['id']} has no changes")
+            shape = tuple(sorted(changes))
+            self.updates[shape].append((item["id"], *(_coerce(table, c, changes[c]) for c in shape)))
+            update_ids.append(item["id"])
+        self.update_ids = _unique(update_ids, "update")
+        self.complete = _unique(list(ops.get("complete") or []), "complete")
+        self.delete = _unique(list(ops.get("delete") or []), "delete")
+
+
+def outcomes(op: str, ids: List[str], hit: set) -> List[Dict]:
+    """Per-id results in request order."""
+    done = {"update": "updated", "complete": "completed", "delete": "deleted"}[op]
+    return [{"op": op, "id": i, "status": done if i in hit else "not_found"} for i in ids]
@@ -0,0 +1,339 @@
+# catalog.py
+# In-memory product catalog (products table) with faceted filtering.
+#
+# The whole catalog is loaded into a CatalogIndex. Rows are laid out in price
+# order and every posting is a bitmask (a Python int) over those positions:
+# facet values (category, color, price band, in stock), one mask per distinct
+# rating, and an inverted index of name/description tokens. A mask costs a
+# bit per product, so tokens on fewer than 1/32 of the rows keep a sorted
+# array of positions instead and become a mask only when a query uses them.
+# Each posting is built once from its positions. A price range is
+# a contiguous run of bits, so a listing is a handful of big-int ANDs plus
+# reading the page's bits off in order; counts are bit_count(). Nothing
+# touches Postgres per request. "relevance" ranks rows with more query words
+# in the name first, then by rating. Facet counts are disjunctive: each facet
+# is counted over the rows matching every *other* filter, so picking a
+# category still shows what the other categories would return. Counts for
+# the unfiltered catalog are computed once per build.
+#
+# A statement-level trigger on products NOTIFYs "catalog"; the listener
+# rebuilds the index (debounced) and swaps it in whole, so readers always see
+# one consistent version. A reload every CATALOG_REFRESH_SECONDS covers a
+# dropped LISTEN connection.
+import asyncio
+import bisect
+from array import array
+import os
+import re
+from typing import Dict, List, Optional, Tuple, Union
+import asyncpg
+from db import DATABASE_URL, get_conn
+from metrics import metrics
+
+CHANNEL = "catalog"
+REFRESH_SECONDS = float(os.environ.get("CATALOG_REFRESH_SECONDS", "300"))
+DEBOUNCE_SECONDS = float(os.environ.get("CATALOG_DEBOUNCE_SECONDS", "0.5"))
+PRICE_BANDS = [float(b) for b in os.environ.get("CATALOG_PRICE_BANDS", "500,1000,2000,5000").split(",")]
+SORTS = ("relevance", "price", "-price", "rating", "-rating")
+
+_INSTALL_LOCK = 728_011
+
+NOTIFY_DDL = f"""
+CREATE OR REPLACE FUNCTION notify_catalog() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('{CHANNEL}', TG_OP);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_notify_catalog ON products;
+CREATE TRIGGER products_notify_catalog
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON products
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_catalog();
+"""
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+async def install_catalog_notify():
+    async with get_conn() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+            if await conn.fetchval("SELECT to_regclass('products') IS NOT NULL"):
+                await conn.execute(NOTIFY_DDL)
+
+
+def tokens(text: Optional[str]) -> List[str]:
+    return _TOKEN.findall(text.lower()) if text else []
+
+
+def price_band(price: float) -> str:
+    i = bisect.bisect_right(PRICE_BANDS, price)
+    lo = f"{PRICE_BANDS[i - 1]:g}" if i else "0"
+    return f"{lo}-{PRICE_BANDS[i]:g}" if i < len(PRICE_BANDS) else f"{lo}+"
+
+
+# --- Index ---
+# A token posting: a bitmask, or the positions of a rare token
+Posting = Union[int, array]
+
+
+def _mask(positions, size: int) -> int:
+    buf = bytearray((size + 7) // 8)
+    for i in positions:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, "little")
+
+
+def _postings(positions: Dict[str, List[int]], size: int) -> Dict[str, Posting]:
+    # A position costs 4 bytes, a mask size / 8: keep whichever is smaller
+    return {k: array("I", v) if len(v) * 32 < size else _mask(v, size) for k, v in positions.items()}
+
+
+def _take(mask: int, skip: int, take: int, descending: bool = False) -> List[int]:
+    """Positions skip .. skip + take of mask in bit order, without expanding all of it."""
+    out = []
+    while mask and len(out) < take:
+        if descending:
+            i = mask.bit_length() - 1
+            mask ^= 1 << i
+        else:
+            low = mask & -mask
+            i = low.bit_length() - 1
+            mask ^= low
+        if skip:
+            skip -= 1
+        else:
+            out.append(i)
+    return out
+
+
+class CatalogIndex:
+    FACETS = ("category", "color", "price_band", "in_stock")
+
+    def __init__(self, rows: List[Dict], version: int = 0):
+        self.version = version
+        # Position = rank by price, so a price range is a contiguous run of bits
+        self.products = sorted((self._normalize(r) for r in rows), key=lambda p: (p["price"], p["id"]))
+        self.prices = [p["price"] for p in self.products]
+        self.by_id = {p["id"]: i for i, p in enumerate(self.products)}
+        self.all = (1 << len(self.products)) - 1
+        size = len(self.products)
+        facet_rows: Dict[str, Dict[str, List[int]]] = {f: {} for f in self.FACETS}
+        word_rows: Dict[str, List[int]] = {}
+        name_word_rows: Dict[str, List[int]] = {}
+        by_rating: Dict[float, List[int]] = {}
+        for i, p in enumerate(self.products):
+            values = {
+                "category": [p["category"] or ""],
+                "color": [c.lower() for c in p["colors"] or ()],
+                "price_band": [price_band(p["price"])],
+                "in_stock": ["true" if p["in_stock"] > 0 else "false"],
+            }
+            for facet, vs in values.items():
+                rows = facet_rows[facet]
+                for v in set(vs):
+                    rows.setdefault(v, []).append(i)
+            for word in set(tokens(p["name"]) + tokens(p["description"])):
+                word_rows.setdefault(word, []).append(i)
+            for word in set(tokens(p["name"])):
+                name_word_rows.setdefault(word, []).append(i)
+            by_rating.setdefault(p["rating"], []).append(i)
+        self.postings: Dict[str, Dict[str, int]] = {
+            f: {v: _mask(rows, size) for v, rows in facet_rows[f].items()} for f in self.FACETS}
+        self.words = _postings(word_rows, size)
+        self.name_words = _postings(name_word_rows, size)
+        # Ratings have few distinct values: one mask each, highest first
+        self.rating_groups: List[Tuple[float, int]] = sorted(
+            ((r, _mask(rows, size)) for r, rows in by_rating.items()), reverse=True)
+        self._sorted_words = sorted(self.words)
+        self.base_facets = self.facets({})
+
+    def _word(self, postings: Dict[str, Posting], word: str) -> int:
+        hits = postings.get(word, 0)
+        return hits if isinstance(hits, int) else _mask(hits, len(self.products))
+
+    @staticmethod
+    def _normalize(row: Dict) -> Dict:
+        p = dict(row)
+        p["price"] = float(p["price"])
+        p["rating"] = float(p["rating"]) if p.get("rating") is not None else 0.0
+        p["in_stock"] = float(p["in_stock"]) if p.get("in_stock") is not None else 0.0
+        return p
+
+    # --- Filters ---
+    def _search(self, q: str) -> int:
+        # Every query word must match; the last one may be a prefix (type-ahead)
+        words = tokens(q)
+        result = self.all
+        for n, word in enumerate(words):
+            hits = self._word(self.words, word)
+            if n == len(words) - 1 and not hits:
+                start = bisect.bisect_left(self._sorted_words, word)
+                for w in self._sorted_words[start:]:
+                    if not w.startswith(word):
+                        break
+                    hits |= self._word(self.words, w)
+            result &= hits
+            if not result:
+                break
+        return result
+
+    def _price_range(self, lo: Optional[float], hi: Optional[float]) -> int:
+        start = bisect.bisect_left(self.prices, lo) if lo is not None else 0
+        end = bisect.bisect_right(self.prices, hi) if hi is not None else len(self.prices)
+        return ((1 << end) - 1) ^ ((1 << start) - 1) if end > start else 0
+
+    def _matching(self, filters: Dict, skip: Optional[str] = None) -> int:
+        """Rows matching every filter except the `skip` facet."""
+        mask = self.all
+        for facet in self.FACETS:
+            wanted = filters.get(facet)
+            if wanted and facet != skip:
+                postings = self.postings[facet]
+                any_of = 0
+                for v in wanted:
+                    any_of |= postings.get(v, 0)
+                mask &= any_of
+        if filters.get("q"):
+            mask &= self._search(filters["q"])
+        if filters.get("min_price") is not None or filters.get("max_price") is not None:
+            mask &= self._price_range(filters.get("min_price"), filters.get("max_price"))
+        if filters.get("min_rating") is not None:
+            for rating, rows in self.rating_groups:
+                if rating < filters["min_rating"]:
+                    mask &= ~rows
+        return mask
+
+    def facets(self, filters: Dict) -> Dict[str, Dict[str, int]]:
+        out = {}
+        for facet in self.FACETS:
+            base = self._matching(filters, skip=facet)
+            counts = {v: (base & rows).bit_count() for v, rows in self.postings[facet].items()}
+            out[facet] = {v: n for v, n in sorted(counts.items()) if n}
+        return out
+
+    # --- Listing ---
+    def _by_rating(self, mask: int, skip: int, take: int, descending: bool) -> List[int]:
+        out = []
+        for _, rows in (self.rating_groups if descending else reversed(self.rating_groups)):
+            group = mask & rows
+            n = group.bit_count()
+            if skip >= n:
+                skip -= n
+                continue
+            out += _take(group, skip, take - len(out))  # ties in price order
+            skip = 0
+            if len(out) >= take:
+                break
+        return out
+
+    def search(self, filters: Dict, sort: str = "relevance", limit: int = 50, offset: int = 0) -> Dict:
+        if sort not in SORTS:
+            raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+        active = any(v not in (None, [], "") for v in filters.values())
+        matched = self._matching(filters) if active else self.all
+        if sort in ("price", "-price"):
+            page = _take(matched, offset, limit, descending=sort == "-price")
+        elif sort in ("rating", "-rating") or not filters.get("q"):
+            page = self._by_rating(matched, offset, limit, descending=sort != "rating")
+        else:
+            # Tiers by how many query words are in the name, best rated first in each
+            words = set(tokens(filters["q"]))
+            at_least = [matched] + [0] * len(words)  # at_least[k]: k or more name hits
+            for w in words:
+                hits = self._word(self.name_words, w)
+                for k in range(len(words), 0, -1):
+                    at_least[k] |= at_least[k - 1] & hits
+            page = []
+            for k in range(len(words), -1, -1):
+                tier = at_least[k] & ~at_least[k + 1] if k < len(words) else at_least[k]
+                n = tier.bit_count()
+                if offset >= n:
+                    offset -= n
+                    continue
+                page += self._by_rating(tier, offset, limit - len(page), descending=True)
+                offset = 0
+                if len(page) >= limit:
+                    break
+        return {"total": matched.bit_count(), "items": [self.products[i] for i in page],
+                "version": self.version, "facets": self.facets(filters) if active else self.base_facets}
+
+    def get(self, id: int) -> Optional[Dict]:
+        i = self.by_id.get(id)
+        return self.products[i] if i is not None else None
+
+
+# --- Service ---
+class Catalog:
+    def __init__(self):
+        self.index: Optional[CatalogIndex] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._dirty = asyncio.Event()
+        self._listener: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def ensure_loaded(self) -> CatalogIndex:
+        if self._ready is None:
+            self._ready = asyncio.get_running_loop().create_future()
+            self._task = asyncio.create_task(self._run())
+        await asyncio.shield(self._ready)
+        return self.index
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self._close_listener()
+        self._task, self._ready = None, None
+
+    async def _close_listener(self):
+        if self._listener is not None:
+            try:
+                await self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    async def _listen(self):
+        await self._close_listener()
+        self._listener = await asyncpg.connect(DATABASE_URL)
+        await self._listener.add_listener(CHANNEL, lambda *args: self._dirty.set())
+
+    async def reload(self):
+        with metrics.timer("catalog.reload_seconds"):
+            async with get_conn() as conn:
+                if await conn.fetchval("SELECT to_regclass('products') IS NULL"):
+                    rows = []
+                else:
+                    rows = await conn.fetch("SELECT * FROM products")
+            version = self.index.version + 1 if self.index else 1
+            # Build off the event loop; large catalogs take a while to index
+            self.index = await asyncio.to_thread(CatalogIndex, [dict(r) for r in rows], version)
+        metrics.set_gauge("catalog.products", len(self.index.products))
+
+    async def _run(self):
+        try:
+            await self._listen()
+            await self.reload()
+            self._ready.set_result(None)
+        except Exception as e:
+            self._ready.set_exception(e)
+            self._ready = None
+            return
+        while True:
+            try:
+                await asyncio.wait_for(self._dirty.wait(), REFRESH_SECONDS)
+                await asyncio.sleep(DEBOUNCE_SECONDS)  # fold bursts of writes into one rebuild
+            except asyncio.TimeoutError:
+                pass
+            self._dirty.clear()
+            try:
+                if self._listener is None or self._listener.is_closed():
+                    await self._listen()
+                await self.reload()
+            except Exception as e:  # keep serving the previous index
+                print(f"catalog reload failed: {e!r}")
+                await self._close_listener()
+
+
+catalog = Catalog()
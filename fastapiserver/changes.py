@@ -0,0 +1,317 @@
+# changes.py
+# Trigger-fed change log and the incremental change feed built on it.
+#
+# Every INSERT/UPDATE/DELETE on a tracked table appends (table, row id, op,
+# txid) to change_log. The feed reads the log in (txid, seq) order but only
+# up to the oldest transaction still in flight, so a token never skips a
+# change that commits later. For each changed id it returns the row as it is
+# now, or a tombstone if the row is gone, so a consumer that applies the feed
+# converges on the source even when two transactions touch the same row.
+#
+# Consumers that pass a name have their token recorded in change_consumers
+# each time they ask for the next page: asking for changes after a token
+# acknowledges everything before it. The prune loop deletes entries below the
+# lowest acknowledged txid of the consumers seen within
+# CHANGE_CONSUMER_TTL_DAYS, and anything older than CHANGE_LOG_MAX_AGE_DAYS
+# whether acknowledged or not, so an abandoned consumer cannot pin the log.
+# The position of the newest pruned entry is kept in change_log_floor; a
+# token below it may have missed changes, so reading from it fails with
+# TokenExpired (410 from the API) and the consumer has to resync.
+#
+# With SHARD_MAP set, the store-scoped tables (shards.STORE_TABLES) live on
+# the shards, and each shard keeps its own change_log, consumers and prune
+# loop. txids are per database, so the token holds one position per database.
+import asyncio
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from db import get_conn
+from shards import router, STORE_TABLES
+
+TRACKED_TABLES = (
+    "clients", "follow_ups", "tasks", "interactions",
+    "supermarkets", "sales", "inventory", "customer_traffic",
+)
+
+CHANGE_LOG_DDL = """
+CREATE TABLE IF NOT EXISTS change_log (
+  seq BIGSERIAL PRIMARY KEY,
+  txid BIGINT NOT NULL DEFAULT txid_current(),
+  table_name TEXT NOT NULL,
+  row_id VARCHAR NOT NULL,
+  op CHAR(1) NOT NULL,
+  changed_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS change_log_txid_seq ON change_log (txid, seq);
+CREATE INDEX IF NOT EXISTS change_log_changed_at ON change_log (changed_at);
+
+CREATE TABLE IF NOT EXISTS change_log_floor (
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  txid BIGINT NOT NULL,
+  seq BIGINT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS change_consumers (
+  name TEXT PRIMARY KEY,
+  txid BIGINT NOT NULL,
+  seq BIGINT NOT NULL,
+  acked_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- TG_ARGV[0] is the logical table name: on a partitioned table the trigger
+-- fires from each partition, where TG_TABLE_NAME is the partition's name.
+-- Rows tiering.py moves to cold storage are not deleted for consumers, so it
+-- sets change_log.skip for its archive transactions.
+CREATE OR REPLACE FUNCTION log_row_change() RETURNS trigger AS $$
+DECLARE
+  tbl TEXT := COALESCE(TG_ARGV[0], TG_TABLE_NAME);
+BEGIN
+  IF current_setting('change_log.skip', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP = 'DELETE' THEN
+    INSERT INTO change_log (table_name, row_id, op) VALUES (tbl, OLD.id, 'D');
+    RETURN OLD;
+  END IF;
+  INSERT INTO change_log (table_name, row_id, op)
+  VALUES (tbl, NEW.id, CASE WHEN TG_OP = 'INSERT' THEN 'I' ELSE 'U' END);
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+OPS = {"I": "insert", "U": "update", "D": "delete"}
+
+# Advisory lock key so concurrent workers don't race on DDL at startup
+_INSTALL_LOCK = 728_001
+_PRUNE_LOCK = 728_015
+
+PRUNE_SECONDS = float(os.environ.get("CHANGE_LOG_PRUNE_SECONDS", "300"))
+PRUNE_BATCH = int(os.environ.get("CHANGE_LOG_PRUNE_BATCH", "10000"))
+CONSUMER_TTL_DAYS = int(os.environ.get("CHANGE_CONSUMER_TTL_DAYS", "7"))
+MAX_AGE_DAYS = int(os.environ.get("CHANGE_LOG_MAX_AGE_DAYS", "30"))
+
+
+class TokenExpired(Exception):
+    pass
+
+
+async def _install(conn, tables):
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+        await conn.execute(CHANGE_LOG_DDL)
+        for table in tables:
+            # CREATE TRIGGER takes a SHARE ROW EXCLUSIVE lock, so skip it when already there
+            if await conn.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = $1 AND tgrelid = to_regclass($2))",
+                    f"{table}_change_log", table):
+                continue
+            await conn.execute(f"""
+                CREATE TRIGGER {table}_change_log
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE log_row_change('{table}')
+            """)
+
+
+def _home_tables() -> List[str]:
+    return [t for t in TRACKED_TABLES if not (router.enabled and t in STORE_TABLES)]
+
+
+async def install_change_log():
+    async with get_conn() as conn:
+        await _install(conn, _home_tables())
+    for shard in router.names:
+        async with router.conn(shard) as conn:
+            await _install(conn, STORE_TABLES)
+
+
+# --- Tokens ---
+# A token is "<txid>.<seq>": the position of the last change delivered. When
+# sharded, each shard's position follows as ",<shard>:<txid>.<seq>"; a shard
+# missing from the token starts from the beginning of its log.
+Positions = Dict[Optional[str], Tuple[int, int]]
+
+
+def encode_token(positions: Positions) -> str:
+    txid, seq = positions.get(None, (0, 0))
+    parts = [f"{txid}.{seq}"]
+    parts += [f"{shard}:{t}.{s}" for shard, (t, s) in sorted(
+        (k, v) for k, v in positions.items() if k is not None)]
+    return ",".join(parts)
+
+
+def _decode_position(text: str) -> Tuple[int, int]:
+    txid, seq = text.split(".", 1)
+    return int(txid), int(seq)
+
+
+def decode_token(token: Optional[str]) -> Positions:
+    if not token:
+        return {}
+    try:
+        home, *shards = token.split(",")
+        positions: Positions = {None: _decode_position(home)}
+        for part in shards:
+            shard, position = part.split(":", 1)
+            positions[shard] = _decode_position(position)
+        return positions
+    except ValueError:
+        raise ValueError(f"Invalid change token: {token!r}")
+
+
+def _validate_tables(tables: Optional[List[str]]) -> List[str]:
+    if not tables:
+        return list(TRACKED_TABLES)
+    unknown = [t for t in tables if t not in TRACKED_TABLES]
+    if unknown:
+        raise ValueError(f"Untracked tables: {', '.join(unknown)}")
+    return tables
+
+
+async def read_changes(since: Optional[str] = None, tables: Optional[List[str]] = None,
+                       page_size: int = 1000, max_pages: int = 50,
+                       consumer: Optional[str] = None) -> AsyncIterator[Dict]:
+    """Yield change events after `since`, then a final {"token": ...} marker.
+
+    Each event is {"table", "id", "op", "row", "txid", "seq"}; `row` is the
+    current row for inserts/updates and None for deletes. Rows touched several
+    times within a page are emitted once, at their last position. A named
+    `consumer` acknowledges `since`. When sharded, each database's changes
+    are read in turn and events from a shard also carry "shard".
+    """
+    tables = _validate_tables(tables)
+    positions = decode_token(since)
+    home = [t for t in _home_tables() if t in tables]
+    sources = [(None, home)] if home else []
+    sources += [(shard, [t for t in STORE_TABLES if t in tables]) for shard in router.names]
+    # Checked on every database before anything is yielded
+    for shard, source_tables in sources:
+        if source_tables and shard in positions:
+            async with router.conn(shard) as conn:
+                floor = await conn.fetchrow("SELECT txid, seq FROM change_log_floor")
+            if floor is not None and positions[shard] < (floor["txid"], floor["seq"]):
+                raise TokenExpired("Change token is older than the change log; resync and start without a token")
+    more = False
+    for shard, source_tables in sources:
+        if not source_tables:
+            continue
+        state = {"position": positions.get(shard, (0, 0)), "more": False}
+        async with router.conn(shard) as conn:
+            async for event in _read_source(conn, source_tables, state, page_size, max_pages, consumer):
+                if shard is not None:
+                    event["shard"] = shard
+                yield event
+        positions[shard] = state["position"]
+        more = more or state["more"]
+    yield {"token": encode_token(positions), "more": more}
+
+
+async def _read_source(conn, tables: List[str], state: Dict, page_size: int, max_pages: int,
+                       consumer: Optional[str]) -> AsyncIterator[Dict]:
+    # Reads one database's change_log from state["position"]; leaves the new
+    # position and whether more remains in `state`
+    txid, seq = state["position"]
+    more = False
+    if consumer:
+        await conn.execute("""
+            INSERT INTO change_consumers (name, txid, seq) VALUES ($1, $2, $3)
+            ON CONFLICT (name) DO UPDATE SET txid = EXCLUDED.txid, seq = EXCLUDED.seq, acked_at = NOW()
+        """, consumer, txid, seq)
+    horizon = await conn.fetchval("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    for _ in range(max_pages):
+        log = await conn.fetch("""
+            SELECT seq, txid, table_name, row_id, op
+            FROM change_log
+            WHERE (txid, seq) > ($1, $2) AND txid < $3 AND table_name = ANY($4)
+            ORDER BY txid, seq
+            LIMIT $5
+        """, txid, seq, horizon, tables, page_size)
+        if not log:
+            more = False
+            break
+
+        # Last entry per row wins within the page
+        latest: Dict[Tuple[str, str], Any] = {}
+        for entry in log:
+            latest[(entry["table_name"], entry["row_id"])] = entry
+
+        ids_by_table: Dict[str, List[str]] = {}
+        for table, row_id in latest:
+            ids_by_table.setdefault(table, []).append(row_id)
+        current: Dict[Tuple[str, str], Dict] = {}
+        for table, ids in ids_by_table.items():
+            rows = await conn.fetch(f"SELECT * FROM {table} WHERE id = ANY($1)", ids)
+            for r in rows:
+                current[(table, r["id"])] = dict(r)
+
+        for key, entry in sorted(latest.items(), key=lambda kv: (kv[1]["txid"], kv[1]["seq"])):
+            row = current.get(key)
+            if row is None:
+                op = "delete"
+            elif entry["op"] == "D":
+                op = "update"  # deleted and re-created under the same id
+            else:
+                op = OPS[entry["op"]]
+            yield {
+                "table": key[0], "id": key[1], "op": op, "row": row,
+                "txid": entry["txid"], "seq": entry["seq"],
+            }
+
+        txid, seq = log[-1]["txid"], log[-1]["seq"]
+        more = len(log) == page_size
+
+    if not more and txid < horizon:
+        # Caught up: everything below the horizon has been seen
+        txid, seq = horizon, 0
+    state["position"], state["more"] = (txid, seq), more
+
+
+# --- Pruning ---
+async def prune_change_log(batch_size: int = PRUNE_BATCH) -> int:
+    """Drop log entries every active consumer has acknowledged, on every database."""
+    deleted = 0
+    for shard in [None] + router.names:
+        async with router.conn(shard) as conn:
+            deleted += await _prune(conn, batch_size)
+    return deleted
+
+
+async def _prune(conn, batch_size: int) -> int:
+    # In bounded batches, one short transaction each
+    deleted = 0
+    while True:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", _PRUNE_LOCK):
+                return deleted  # another worker is pruning
+            floor = await conn.fetchval("""
+                SELECT MIN(txid) FROM change_consumers
+                WHERE acked_at > NOW() - make_interval(days => $1)
+            """, CONSUMER_TTL_DAYS)
+            # Raises the pruned floor to the newest entry this batch removes
+            n = await conn.fetchval("""
+                WITH gone AS (
+                  DELETE FROM change_log WHERE seq IN (
+                    SELECT seq FROM change_log
+                    WHERE txid < $1 OR changed_at < NOW() - make_interval(days => $2)
+                    LIMIT $3
+                  ) RETURNING txid, seq
+                ), newest AS (
+                  SELECT txid, seq FROM gone ORDER BY txid DESC, seq DESC LIMIT 1
+                ), raised AS (
+                  INSERT INTO change_log_floor (txid, seq) SELECT txid, seq FROM newest
+                  ON CONFLICT (id) DO UPDATE SET txid = EXCLUDED.txid, seq = EXCLUDED.seq
+                  WHERE (change_log_floor.txid, change_log_floor.seq) < (EXCLUDED.txid, EXCLUDED.seq)
+                )
+                SELECT COUNT(*) FROM gone
+            """, floor or 0, MAX_AGE_DAYS, batch_size)
+        deleted += n
+        if n < batch_size:
+            return deleted
+
+
+async def change_log_prune_loop(interval: float = PRUNE_SECONDS):
+    while True:
+        try:
+            await prune_change_log()
+        except Exception as e:  # keep the loop alive; the next round catches up
+            print(f"change_log prune failed: {e!r}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,172 @@
+# checkout.py
+# Cart -> order in one transaction (products/orders/order_items/cart_items,
+# see products_data/read_data.py).
+#
+# A checkout consumes the session's cart (DELETE ... RETURNING, so two
+# submits of the same cart cannot both see it), inserts the order and all of
+# its items in one statement, and decrements products.in_stock last, only
+# where enough stock is left. If any line is short the whole transaction
+# rolls back and the cart is untouched.
+#
+# Contention: the order_items insert takes FOR KEY SHARE on each product (the
+# product_id foreign key check). The decrement runs right before COMMIT and
+# takes FOR NO KEY UPDATE, which does not conflict with KEY SHARE, so other
+# checkouts' inserts never block it and a popular product is exclusively
+# locked for one statement per checkout. It takes those locks in product id
+# order, so checkouts sharing products queue instead of deadlocking. Prices
+# are read without locks and the decrement re-checks them; a price change in
+# between fails the checkout (409) rather than charging a stale price.
+#
+# Idempotency: orders.idempotency_key is unique. A retried request with the
+# same Idempotency-Key returns the order the first one created (replayed =
+# true), whether the first one finished long ago or commits while the retry
+# is in flight. A key is bound to the session that first used it; reusing it
+# for another session's cart is an error, not a replay.
+import json
+from collections import defaultdict
+from typing import Dict, List, Optional
+import asyncpg
+from db import get_conn
+from metrics import metrics
+
+_INSTALL_LOCK = 728_012
+
+CHECKOUT_DDL = """
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS session_id TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS orders_idempotency_key ON orders (idempotency_key)
+  WHERE idempotency_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS cart_items_session ON cart_items (session_id);
+CREATE INDEX IF NOT EXISTS order_items_order ON order_items (order_id);
+"""
+
+CONSUME_CART_SQL = "DELETE FROM cart_items WHERE session_id = $1 RETURNING product_id, quantity"
+
+PRICES_SQL = "SELECT id, name, price, in_stock FROM products WHERE id = ANY($1::int[])"
+
+CREATE_ORDER_SQL = """
+WITH o AS (
+  INSERT INTO orders (customer_info, shipping_address, total_amount, idempotency_key, session_id)
+  VALUES ($1::jsonb, $2::jsonb, $3, $4, $5)
+  RETURNING *
+), items AS (
+  INSERT INTO order_items (order_id, product_id, product_name, product_price, quantity)
+  SELECT o.id, i.product_id, i.name, i.price, i.quantity
+  FROM o, unnest($6::int[], $7::text[], $8::numeric[], $9::int[]) AS i(product_id, name, price, quantity)
+  RETURNING *
+)
+SELECT o.*, (SELECT array_agg(i::order_items ORDER BY i.product_id) FROM items i) AS items FROM o
+"""
+
+# The inner SELECT takes the row locks in id order. FOR NO KEY UPDATE, not FOR
+# UPDATE: the latter conflicts with the KEY SHARE locks concurrent checkouts'
+# order_items inserts hold, which deadlocks two carts sharing a product.
+DECREMENT_SQL = """
+UPDATE products p SET in_stock = p.in_stock - d.quantity
+FROM (
+  SELECT l.id, w.quantity, w.price
+  FROM (SELECT id FROM products WHERE id = ANY($1::int[]) ORDER BY id FOR NO KEY UPDATE) l
+  JOIN unnest($1::int[], $2::int[], $3::numeric[]) AS w(id, quantity, price) USING (id)
+) d
+WHERE p.id = d.id AND p.in_stock >= d.quantity AND p.price = d.price
+RETURNING p.id
+"""
+
+
+class EmptyCart(ValueError):
+    pass
+
+
+class IdempotencyKeyReused(Exception):
+    """The Idempotency-Key belongs to an order from another session."""
+
+
+class CheckoutConflict(Exception):
+    """Stock ran out or a price changed; nothing was applied."""
+
+    def __init__(self, message: str, products: List[int]):
+        super().__init__(message)
+        self.products = products
+
+
+async def install_checkout():
+    async with get_conn() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+            if await conn.fetchval("SELECT to_regclass('orders') IS NOT NULL AND to_regclass('cart_items') IS NOT NULL"):
+                await conn.execute(CHECKOUT_DDL)
+
+
+def _order(row, items: List, replayed: bool) -> Dict:
+    order = dict(row)
+    for k in ("customer_info", "shipping_address"):
+        if isinstance(order.get(k), str):
+            order[k] = json.loads(order[k])
+    return {**order, "items": [dict(i) for i in items], "replayed": replayed}
+
+
+async def _replay(conn, key: Optional[str], session_id: str) -> Optional[Dict]:
+    if not key:
+        return None
+    row = await conn.fetchrow("SELECT * FROM orders WHERE idempotency_key = $1", key)
+    if row is None:
+        return None
+    if row["session_id"] != session_id:
+        raise IdempotencyKeyReused(f"Idempotency-Key {key!r} was used for another session's checkout")
+    items = await conn.fetch("SELECT * FROM order_items WHERE order_id = $1 ORDER BY product_id", row["id"])
+    metrics.incr("checkout.replayed")
+    return _order(row, items, True)
+
+
+async def checkout(session_id: str, customer_info: Dict, shipping_address: Dict,
+                   idempotency_key: Optional[str] = None) -> Dict:
+    async with get_conn() as conn:
+        replay = await _replay(conn, idempotency_key, session_id)
+        if replay:
+            return replay
+        try:
+            with metrics.timer("checkout.seconds"):
+                return await _checkout(conn, session_id, customer_info, shipping_address, idempotency_key)
+        except asyncpg.exceptions.UniqueViolationError:
+            # The same key committed from another request while this one ran
+            replay = await _replay(conn, idempotency_key, session_id)
+            if replay is None:
+                raise
+            return replay
+
+
+async def _checkout(conn, session_id, customer_info, shipping_address, idempotency_key) -> Dict:
+    async with conn.transaction():
+        cart = await conn.fetch(CONSUME_CART_SQL, session_id)
+        if not cart:
+            # A duplicate submit that lost the race for the cart
+            replay = await _replay(conn, idempotency_key, session_id)
+            if replay:
+                return replay
+            raise EmptyCart(f"Cart {session_id!r} is empty")
+        wanted: Dict[int, int] = defaultdict(int)
+        for line in cart:
+            wanted[line["product_id"]] += line["quantity"]
+        ids = sorted(wanted)
+        products = {r["id"]: r for r in await conn.fetch(PRICES_SQL, ids)}
+        missing = [i for i in ids if i not in products]
+        if missing:
+            raise ValueError(f"Unknown products in cart: {missing}")
+        short = [i for i in ids if products[i]["in_stock"] is None or products[i]["in_stock"] < wanted[i]]
+        if short:
+            raise CheckoutConflict("Not enough stock", short)
+
+        prices = [products[i]["price"] for i in ids]
+        quantities = [wanted[i] for i in ids]
+        total = sum(p * q for p, q in zip(prices, quantities))
+        order = await conn.fetchrow(
+            CREATE_ORDER_SQL, json.dumps(customer_info), json.dumps(shipping_address), total,
+            idempotency_key, session_id, ids, [products[i]["name"] for i in ids], prices, quantities)
+
+        # Last statement before COMMIT: product rows stay locked only this long
+        applied = {r["id"] for r in await conn.fetch(DECREMENT_SQL, ids, quantities, prices)}
+        if len(applied) < len(ids):
+            metrics.incr("checkout.conflicts")
+            raise CheckoutConflict("Stock or price changed during checkout", [i for i in ids if i not in applied])
+    metrics.incr("checkout.orders")
+    return _order(order, order["items"], False)
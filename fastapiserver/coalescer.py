@@ -0,0 +1,130 @@
+# coalescer.py
+# Micro-batching for high-rate single-row inserts.
+#
+# Concurrent callers enqueue rows for the same table; the batch is flushed
+# after `max_delay` seconds or as soon as it holds `max_rows`, as a single
+# INSERT ... SELECT FROM unnest(...) inside one transaction. Ids are generated
+# here so every caller gets back exactly its own RETURNING row. If a batch
+# fails (say one row violates a foreign key) its rows are retried one by one
+# so only the offending caller sees the error.
+import asyncio
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from db import get_conn
+from metrics import metrics
+
+# Columns and Postgres types of each coalesced table, in insert order
+COALESCED_TABLES: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "interactions": (
+        ("id", "varchar"), ("client_id", "varchar"), ("type", "text"),
+        ("subject", "text"), ("notes", "text"),
+    ),
+    "follow_ups": (
+        ("id", "varchar"), ("client_id", "varchar"), ("title", "text"),
+        ("description", "text"), ("scheduled_date", "timestamp"),
+        ("completed", "boolean"), ("completed_at", "timestamp"), ("type", "text"),
+    ),
+    "tasks": (
+        ("id", "varchar"), ("client_id", "varchar"), ("title", "text"),
+        ("description", "text"), ("due_date", "timestamp"),
+        ("completed", "boolean"), ("completed_at", "timestamp"), ("priority", "text"),
+    ),
+}
+
+
+def _batch_sql(table: str) -> str:
+    cols = COALESCED_TABLES[table]
+    names = ", ".join(c for c, _ in cols)
+    arrays = ", ".join(f"${i + 1}::{t}[]" for i, (_, t) in enumerate(cols))
+    return f"INSERT INTO {table} ({names}) SELECT * FROM unnest({arrays}) RETURNING *"
+
+
+def _single_sql(table: str) -> str:
+    cols = COALESCED_TABLES[table]
+    names = ", ".join(c for c, _ in cols)
+    params = ", ".join(f"${i + 1}" for i in range(len(cols)))
+    return f"INSERT INTO {table} ({names}) VALUES ({params}) RETURNING *"
+
+
+class _Pending:
+    __slots__ = ("values", "future", "enqueued")
+
+    def __init__(self, values: List[Any], future: asyncio.Future):
+        self.values = values
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class WriteCoalescer:
+    def __init__(self, max_delay: float = 0.005, max_rows: int = 100):
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self._buffers: Dict[str, List[_Pending]] = {t: [] for t in COALESCED_TABLES}
+        self._timers: Dict[str, Optional[asyncio.TimerHandle]] = {t: None for t in COALESCED_TABLES}
+        self._inflight: set = set()
+        metrics.set_gauge("coalescer.max_delay_ms", max_delay * 1000)
+        metrics.set_gauge("coalescer.max_rows", max_rows)
+
+    async def insert(self, table: str, values: List[Any]) -> Dict:
+        """Queue one row (all columns except id, in COALESCED_TABLES order)."""
+        loop = asyncio.get_running_loop()
+        pending = _Pending([str(uuid.uuid4()), *values], loop.create_future())
+        buf = self._buffers[table]
+        buf.append(pending)
+        if len(buf) >= self.max_rows:
+            self._start_flush(table)
+        elif self._timers[table] is None:
+            self._timers[table] = loop.call_later(self.max_delay, self._start_flush, table)
+        return await pending.future
+
+    def _start_flush(self, table: str):
+        timer = self._timers[table]
+        if timer is not None:
+            timer.cancel()
+            self._timers[table] = None
+        batch = self._buffers[table]
+        if not batch:
+            return
+        self._buffers[table] = []
+        task = asyncio.get_running_loop().create_task(self._flush(table, batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _flush(self, table: str, batch: List[_Pending]):
+        now = time.perf_counter()
+        metrics.observe("coalescer.batch_rows", len(batch))
+        metrics.observe("coalescer.queue_wait_ms", (now - batch[0].enqueued) * 1000)
+        metrics.incr(f"coalescer.{table}.flushes")
+        metrics.incr(f"coalescer.{table}.rows", len(batch))
+        try:
+            columns = list(zip(*(p.values for p in batch)))
+            async with get_conn() as conn:
+                async with conn.transaction():
+                    rows = await conn.fetch(_batch_sql(table), *columns)
+            by_id = {r["id"]: dict(r) for r in rows}
+            for p in batch:
+                if not p.future.done():
+                    p.future.set_result(by_id[p.values[0]])
+        except Exception:
+            metrics.incr(f"coalescer.{table}.batch_failures")
+            await self._flush_individually(table, batch)
+        metrics.observe("coalescer.flush_ms", (time.perf_counter() - now) * 1000)
+
+    async def _flush_individually(self, table: str, batch: List[_Pending]):
+        async with get_conn() as conn:
+            for p in batch:
+                if p.future.done():
+                    continue
+                try:
+                    row = await conn.fetchrow(_single_sql(table), *p.values)
+                    p.future.set_result(dict(row))
+                except Exception as e:
+                    p.future.set_exception(e)
+
+    async def drain(self):
+        """Flush everything queued and wait for in-flight batches (used at shutdown)."""
+        for table in COALESCED_TABLES:
+            self._start_flush(table)
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
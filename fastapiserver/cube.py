@@ -0,0 +1,505 @@
+# cube.py
+# Rollup cube of sales and customer_traffic over the store hierarchy
+# (region -> city -> store, plus store size and type) x time.
+#
+# Postgres side, on every database holding store tables:
+#   cube_deltas  statement triggers on sales and customer_traffic append one
+#                row per (store, day) touched by a statement, with the signed
+#                change in revenue, quantity, transactions and visitors.
+#                Writers only ever append, so busy stores don't queue on a
+#                shared counter row.
+#   cube_cells   one row per (store, day) with the running totals. A single
+#                applier per database (advisory try-lock, like the stock
+#                engine) folds claimed deltas into it and stamps each changed
+#                cell with the next value of cube_version.
+# Installing the triggers on a table backfills its existing rows into
+# cube_cells in the same transaction. Rows deleted by tiering.py are moved to
+# cold storage, not gone, so the triggers skip them (cube.skip) and the cube
+# keeps their history; months archived before the cube was installed are not
+# in it.
+#
+# Serving side: every worker holds the last CUBE_DAYS days in memory as NumPy
+# arrays, measures x members x days, for the stores and for each rollup
+# (region, region/city, size, type, region/size, region/type). A refresh reads
+# only the cells whose version is above the last one seen on that database,
+# and adds the difference to the store row and to each rollup it belongs to,
+# so a region-wide query slices a few rows that are already summed. Ratio
+# metrics (avg_basket, conversion) are computed from the summed measures.
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from db import get_conn
+from metrics import metrics
+from shards import router
+
+CUBE_DAYS = int(os.environ.get("CUBE_DAYS", "400"))
+APPLY_INTERVAL = float(os.environ.get("CUBE_APPLY_SECONDS", "1"))
+REFRESH_SECONDS = float(os.environ.get("CUBE_REFRESH_SECONDS", "5"))
+APPLY_BATCH = int(os.environ.get("CUBE_APPLY_BATCH", "10000"))
+
+_INSTALL_LOCK = 728_013
+_APPLY_LOCK = 728_014
+
+MEASURES = ("revenue", "quantity", "transactions", "visitors")
+RATIOS = {"avg_basket": ("revenue", "transactions"), "conversion": ("transactions", "visitors")}
+METRICS = MEASURES + tuple(RATIOS)
+GRAINS = ("day", "week", "month", "total")
+LEVELS = ("region", "city", "store", "size", "type")
+# level -> level its `parent` names
+PARENT = {"region": None, "city": "region", "store": "city", "size": "region", "type": "region"}
+# level -> next level down, for drill-down links
+CHILD = {"region": "city", "city": "store", "store": None, "size": None, "type": None}
+# rollups kept in memory, keyed by the store attributes they group on
+ROLLUPS = (("region",), ("region", "city"), ("size",), ("type",), ("region", "size"), ("region", "type"))
+UNKNOWN = "(unknown)"
+
+CUBE_DDL = """
+CREATE TABLE IF NOT EXISTS cube_deltas (
+  id BIGSERIAL PRIMARY KEY,
+  supermarket_id VARCHAR NOT NULL,
+  day TIMESTAMP NOT NULL,
+  revenue BIGINT NOT NULL DEFAULT 0,
+  quantity BIGINT NOT NULL DEFAULT 0,
+  transactions BIGINT NOT NULL DEFAULT 0,
+  visitors BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE SEQUENCE IF NOT EXISTS cube_version;
+
+CREATE TABLE IF NOT EXISTS cube_cells (
+  supermarket_id VARCHAR NOT NULL,
+  day TIMESTAMP NOT NULL,
+  revenue BIGINT NOT NULL DEFAULT 0,
+  quantity BIGINT NOT NULL DEFAULT 0,
+  transactions BIGINT NOT NULL DEFAULT 0,
+  visitors BIGINT NOT NULL DEFAULT 0,
+  version BIGINT NOT NULL,
+  PRIMARY KEY (supermarket_id, day)
+);
+CREATE INDEX IF NOT EXISTS cube_cells_version ON cube_cells (version);
+
+CREATE OR REPLACE FUNCTION cube_sales_delta() RETURNS trigger AS $$
+BEGIN
+  IF current_setting('cube.skip', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO cube_deltas (supermarket_id, day, revenue, quantity, transactions)
+    SELECT supermarket_id, date_trunc('day', date), SUM(total_amount), SUM(quantity), COUNT(*)
+    FROM new_rows GROUP BY 1, 2;
+  END IF;
+  IF TG_OP IN ('DELETE', 'UPDATE') THEN
+    INSERT INTO cube_deltas (supermarket_id, day, revenue, quantity, transactions)
+    SELECT supermarket_id, date_trunc('day', date), -SUM(total_amount), -SUM(quantity), -COUNT(*)
+    FROM old_rows GROUP BY 1, 2;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION cube_traffic_delta() RETURNS trigger AS $$
+BEGIN
+  IF current_setting('cube.skip', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO cube_deltas (supermarket_id, day, visitors)
+    SELECT supermarket_id, date_trunc('day', date), SUM(visitor_count) FROM new_rows GROUP BY 1, 2;
+  END IF;
+  IF TG_OP IN ('DELETE', 'UPDATE') THEN
+    INSERT INTO cube_deltas (supermarket_id, day, visitors)
+    SELECT supermarket_id, date_trunc('day', date), -SUM(visitor_count) FROM old_rows GROUP BY 1, 2;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# table -> (trigger function, backfill of its existing rows as cube_cells columns)
+SOURCES = {
+    "sales": ("cube_sales_delta", """
+        SELECT supermarket_id, date_trunc('day', date) AS day, SUM(total_amount) AS revenue,
+               SUM(quantity) AS quantity, COUNT(*) AS transactions, 0 AS visitors
+        FROM sales GROUP BY 1, 2
+    """),
+    "customer_traffic": ("cube_traffic_delta", """
+        SELECT supermarket_id, date_trunc('day', date) AS day, 0 AS revenue, 0 AS quantity,
+               0 AS transactions, SUM(visitor_count) AS visitors
+        FROM customer_traffic GROUP BY 1, 2
+    """),
+}
+
+ADD_CELLS = """
+INSERT INTO cube_cells AS c (supermarket_id, day, revenue, quantity, transactions, visitors, version)
+SELECT supermarket_id, day, SUM(revenue), SUM(quantity), SUM(transactions), SUM(visitors), nextval('cube_version')
+FROM ({source}) d
+GROUP BY supermarket_id, day
+ON CONFLICT (supermarket_id, day) DO UPDATE SET
+  revenue = c.revenue + EXCLUDED.revenue,
+  quantity = c.quantity + EXCLUDED.quantity,
+  transactions = c.transactions + EXCLUDED.transactions,
+  visitors = c.visitors + EXCLUDED.visitors,
+  version = EXCLUDED.version
+"""
+
+APPLY_SQL = f"""
+WITH claimed AS (
+  DELETE FROM cube_deltas WHERE id IN (SELECT id FROM cube_deltas ORDER BY id LIMIT $1)
+  RETURNING supermarket_id, day, revenue, quantity, transactions, visitors
+), cells AS (
+  {ADD_CELLS.format(source="SELECT * FROM claimed")}
+  RETURNING 1
+)
+SELECT (SELECT COUNT(*) FROM claimed) AS deltas, (SELECT COUNT(*) FROM cells) AS cells
+"""
+
+CHANGED_SQL = """
+SELECT supermarket_id, day, revenue, quantity, transactions, visitors, version
+FROM cube_cells WHERE version > $1 AND day >= $2 AND day < $3
+"""
+
+
+def cube_trigger_ddl(table: str) -> str:
+    """(Re)create the cube triggers on `table`; partitions.py calls this for a new parent."""
+    fn = SOURCES[table][0]
+    # A trigger with transition tables may only have one event
+    return "\n".join(f"""
+        DROP TRIGGER IF EXISTS {table}_cube_{event} ON {table};
+        CREATE TRIGGER {table}_cube_{event} AFTER {event.upper()} ON {table}
+        REFERENCING {refs} FOR EACH STATEMENT EXECUTE PROCEDURE {fn}();
+    """ for event, refs in (("insert", "NEW TABLE AS new_rows"),
+                            ("update", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+                            ("delete", "OLD TABLE AS old_rows")))
+
+
+def drop_cube_triggers_ddl(table: str, relation: Optional[str] = None) -> str:
+    """Drop `table`'s cube triggers from `relation` (the table itself, or what it was renamed to)."""
+    return "\n".join(f"DROP TRIGGER IF EXISTS {table}_cube_{event} ON {relation or table};"
+                      for event in ("insert", "update", "delete"))
+
+
+async def install_cube(conn):
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+        await conn.execute(CUBE_DDL)
+        for table in SOURCES:
+            if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", table):
+                continue
+            installed = await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = $1 AND tgrelid = to_regclass($2))",
+                f"{table}_cube_insert", table)
+            if installed:
+                continue  # re-creating them would block writes at every startup
+            # CREATE TRIGGER blocks writes to the table until commit, so the
+            # backfill and the triggers see the same rows
+            await conn.execute(cube_trigger_ddl(table))
+            await conn.execute(ADD_CELLS.format(source=SOURCES[table][1]))
+
+
+async def install_all():
+    async with get_conn() as conn:
+        await install_cube(conn)
+    for name in router.names:
+        async with router.conn(name) as conn:
+            await install_cube(conn)
+
+
+async def apply_pending(conn, batch_size: int = APPLY_BATCH) -> int:
+    """Fold up to batch_size deltas into cube_cells; returns how many."""
+    async with conn.transaction():
+        if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", _APPLY_LOCK):
+            return 0  # another worker is applying on this database
+        if await conn.fetchval("SELECT to_regclass('cube_deltas') IS NULL"):
+            return 0
+        row = await conn.fetchrow(APPLY_SQL, batch_size)
+    metrics.incr("cube.deltas_applied", row["deltas"])
+    return row["deltas"]
+
+
+async def drain(conn) -> int:
+    applied = 0
+    while True:
+        n = await apply_pending(conn)
+        applied += n
+        if n < APPLY_BATCH:
+            return applied
+
+
+async def cube_apply_loop(interval: float = APPLY_INTERVAL):
+    while True:
+        try:
+            with metrics.timer("cube.apply_seconds"):
+                await router.fan_out(drain)
+        except Exception as e:  # keep the loop alive; retried next tick
+            print(f"cube apply failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+# --- In-memory cube ---
+def _ts(d: date) -> datetime:
+    return datetime.combine(d, datetime.min.time())
+
+
+def _buckets(start: date, end: date, grain: str) -> Tuple[List[int], List[str]]:
+    """Column offsets where each period starts within [start, end), and their labels."""
+    if grain == "total":
+        return [0], [f"{start.isoformat()}/{end.isoformat()}"]
+    offsets, labels = [], []
+    day = start
+    while day < end:
+        if grain == "week":
+            first = day - timedelta(days=day.weekday())
+            nxt = first + timedelta(days=7)
+        elif grain == "month":
+            first = day.replace(day=1)
+            nxt = (first + timedelta(days=32)).replace(day=1)
+        else:
+            first, nxt = day, day + timedelta(days=1)
+        offsets.append((day - start).days)
+        labels.append(first.isoformat())
+        day = nxt
+    return offsets, labels
+
+
+class Rollup:
+    """Measures x members x days, summed over the stores of each member."""
+
+    def __init__(self, attrs: Tuple[str, ...]):
+        self.attrs = attrs
+        self.members: List[Tuple[str, ...]] = []
+        self.index: Dict[Tuple[str, ...], int] = {}
+        self.codes = np.zeros(0, dtype=np.int64)  # store row -> member
+        self.values = np.zeros((len(MEASURES), 0, CUBE_DAYS), dtype=np.int64)
+
+    def assign(self, row: int, store: Dict, cells: np.ndarray):
+        """Count store `row` (and the cells it already has) under the member for `store`."""
+        key = tuple(store[a] for a in self.attrs)
+        code = self.index.get(key)
+        if code is None:
+            code = len(self.members)
+            self.members.append(key)
+            self.index[key] = code
+            self.values = np.concatenate([self.values, np.zeros((len(MEASURES), 1, CUBE_DAYS), dtype=np.int64)], axis=1)
+        if row == len(self.codes):
+            self.codes = np.append(self.codes, code)
+        elif self.codes[row] == code:
+            return
+        else:
+            self.values[:, self.codes[row]] -= cells[:, row]
+            self.codes[row] = code
+        self.values[:, code] += cells[:, row]
+
+    def populated(self) -> np.ndarray:
+        """Members that currently have at least one store."""
+        return np.bincount(self.codes, minlength=len(self.members)) > 0
+
+
+class Cube:
+    def __init__(self):
+        self.start: Optional[date] = None  # first day held
+        self.store_ids: List[str] = []
+        self.stores: List[Dict] = []      # row -> {id, name, region, city, size, type}
+        self.row: Dict[str, int] = {}
+        self.cells = np.zeros((len(MEASURES), 0, CUBE_DAYS), dtype=np.int64)
+        self.rollups = {attrs: Rollup(attrs) for attrs in ROLLUPS}
+        self.watermarks: Dict[Optional[str], int] = {}
+        self.refreshed_at: Optional[datetime] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def end(self) -> date:
+        return self.start + timedelta(days=CUBE_DAYS)
+
+    # --- Loading ---
+    async def ensure_loaded(self):
+        if self.refreshed_at is None:
+            await self.refresh()
+
+    async def refresh(self):
+        async with self._lock:
+            with metrics.timer("cube.refresh_seconds"):
+                start = date.today() - timedelta(days=CUBE_DAYS - 1)
+                if self.start is None:
+                    self.start = start
+                    self.cells = np.zeros((len(MEASURES), 0, CUBE_DAYS), dtype=np.int64)
+                    self.watermarks = {}
+                elif start != self.start:
+                    await self._slide(start)
+                await self._load_stores()
+                for shard in router.names or [None]:
+                    await self._pull(shard)
+            self.refreshed_at = datetime.now()
+            metrics.set_gauge("cube.stores", len(self.stores))
+
+    async def _load_stores(self):
+        async with get_conn() as conn:
+            rows = await conn.fetch("SELECT id, name, region, city, size, type FROM supermarkets")
+        known = {r["id"]: dict(r) for r in rows}
+        for row, store_id in enumerate(self.store_ids):
+            if store_id in known and known[store_id] != self.stores[row]:
+                self._set_store(row, known[store_id])  # new attributes, or no longer unknown
+        for store_id in sorted(set(known) - set(self.row)):
+            self._set_store(self._add_store(store_id), known[store_id])
+
+    @staticmethod
+    def _unknown(store_id: str) -> Dict:
+        return {"id": store_id, "name": None, "region": UNKNOWN, "city": UNKNOWN, "size": UNKNOWN, "type": UNKNOWN}
+
+    def _add_store(self, store_id: str) -> int:
+        n = len(self.store_ids)
+        if n == self.cells.shape[1]:
+            grown = np.zeros((len(MEASURES), max(16, 2 * n), CUBE_DAYS), dtype=np.int64)
+            grown[:, :n] = self.cells
+            self.cells = grown
+        self.store_ids.append(store_id)
+        self.row[store_id] = n
+        return n
+
+    def _set_store(self, row: int, store: Dict):
+        if row == len(self.stores):
+            self.stores.append(store)
+        else:
+            self.stores[row] = store
+        for rollup in self.rollups.values():
+            rollup.assign(row, store, self.cells)
+
+    async def _slide(self, start: date):
+        """Move the window forward to begin at `start`, then read the days that entered it."""
+        shift = min((start - self.start).days, CUBE_DAYS)
+        old_end = self.end
+        for values in [self.cells] + [r.values for r in self.rollups.values()]:
+            values[:, :, :CUBE_DAYS - shift] = values[:, :, shift:]
+            values[:, :, CUBE_DAYS - shift:] = 0
+        self.start = start
+        for shard in router.names or [None]:
+            async with router.conn(shard) as conn:
+                if await conn.fetchval("SELECT to_regclass('cube_cells') IS NULL"):
+                    continue
+                rows = await conn.fetch("SELECT * FROM cube_cells WHERE day >= $1 AND day < $2",
+                                        _ts(max(old_end, start)), _ts(self.end))
+            self._apply(rows)
+
+    async def _pull(self, shard: Optional[str]):
+        async with router.conn(shard) as conn:
+            if await conn.fetchval("SELECT to_regclass('cube_cells') IS NULL"):
+                return
+            if shard not in self.watermarks:
+                # First load: the window's cells and the version they were read at, in one snapshot
+                async with conn.transaction(isolation="repeatable_read", readonly=True):
+                    rows = await conn.fetch("SELECT * FROM cube_cells WHERE day >= $1 AND day < $2",
+                                            _ts(self.start), _ts(self.end))
+                    top = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM cube_cells")
+            else:
+                rows = await conn.fetch(CHANGED_SQL, self.watermarks[shard], _ts(self.start), _ts(self.end))
+                top = max((r["version"] for r in rows), default=self.watermarks[shard])
+        self.watermarks[shard] = top
+        self._apply(rows)
+        metrics.incr("cube.cells_read", len(rows))
+
+    def _apply(self, rows):
+        """Overwrite store cells with `rows` and push the differences into every rollup."""
+        if not rows:
+            return
+        stores, days, values = [], [], []
+        for r in rows:
+            d = (r["day"].date() - self.start).days
+            if not 0 <= d < CUBE_DAYS:
+                continue
+            s = self.row.get(r["supermarket_id"])
+            if s is None:
+                # Not in supermarkets (yet): counted as unknown until it shows up
+                s = self._add_store(r["supermarket_id"])
+                self._set_store(s, self._unknown(r["supermarket_id"]))
+            stores.append(s)
+            days.append(d)
+            values.append([r[m] for m in MEASURES])
+        if not stores:
+            return
+        s, d = np.array(stores), np.array(days)
+        new = np.array(values, dtype=np.int64).T  # measures x changed cells
+        diff = new - self.cells[:, s, d]
+        self.cells[:, s, d] = new
+        for rollup in self.rollups.values():
+            np.add.at(rollup.values, (slice(None), rollup.codes[s], d), diff)
+
+    # --- Queries ---
+    def query(self, level: str, parent: Optional[str] = None, metric: str = "revenue", grain: str = "month",
+              start: Optional[date] = None, end: Optional[date] = None, limit: int = 100) -> Dict:
+        if level not in LEVELS:
+            raise ValueError(f"level must be one of {', '.join(LEVELS)}")
+        if metric not in METRICS:
+            raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+        if grain not in GRAINS:
+            raise ValueError(f"grain must be one of {', '.join(GRAINS)}")
+        if parent is not None and PARENT[level] is None:
+            raise ValueError(f"level {level} has no parent")
+        start = max(start or self.start, self.start)
+        end = min(end or self.end, self.end)
+        if end <= start:
+            raise ValueError("end must be after start")
+
+        values, members = self._slice(level, parent)
+        lo, hi = (start - self.start).days, (end - self.start).days
+        offsets, periods = _buckets(start, end, grain)
+        # measures x members x periods
+        summed = np.add.reduceat(values[:, :, lo:hi], offsets, axis=2) if values.shape[1] else \
+            np.zeros((len(MEASURES), 0, len(offsets)), dtype=np.int64)
+        series = self._metric(summed, metric)
+        totals = self._metric(summed.sum(axis=2, keepdims=True), metric)[:, 0]
+        grand = self._metric(summed.sum(axis=(1, 2), keepdims=True), metric)[0, 0]
+        order = np.argsort(-np.nan_to_num(totals, nan=-np.inf), kind="stable")[:limit]
+        return {
+            "level": level, "parent": parent, "metric": metric, "grain": grain,
+            "start": start, "end": end, "periods": periods, "drill_down": CHILD[level],
+            "total": self._number(grand, metric), "member_count": len(members),
+            "members": [dict(members[i], total=self._number(totals[i], metric),
+                             series=[self._number(v, metric) for v in series[i]]) for i in order],
+        }
+
+    def _slice(self, level: str, parent: Optional[str]) -> Tuple[np.ndarray, List[Dict]]:
+        """Rows of the pre-summed array for `level` (under `parent`) and their labels."""
+        if level == "store":
+            rows = [i for i, s in enumerate(self.stores) if parent is None or s["city"] == parent]
+            members = [{"key": self.stores[i]["id"], "name": self.stores[i]["name"],
+                        "region": self.stores[i]["region"], "city": self.stores[i]["city"],
+                        "size": self.stores[i]["size"], "type": self.stores[i]["type"]} for i in rows]
+            return self.cells[:, rows], members
+        attrs = ("region", level) if level == "city" or parent is not None else (level,)
+        rollup = self.rollups[attrs]
+        populated = rollup.populated()
+        rows = [i for i, m in enumerate(rollup.members) if populated[i] and (parent is None or m[0] == parent)]
+        members = [dict(zip(rollup.attrs, rollup.members[i]), key=rollup.members[i][-1]) for i in rows]
+        return rollup.values[:, rows], members
+
+    @staticmethod
+    def _metric(summed: np.ndarray, metric: str) -> np.ndarray:
+        if metric in RATIOS:
+            num, den = (summed[MEASURES.index(m)].astype(np.float64) for m in RATIOS[metric])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.where(den > 0, num / den, np.nan)
+        return summed[MEASURES.index(metric)]
+
+    @staticmethod
+    def _number(v, metric: str):
+        if metric in RATIOS:
+            return None if np.isnan(v) else round(float(v), 4)
+        return int(v)
+
+    def status(self) -> Dict:
+        return {"start": self.start, "end": self.end, "stores": len(self.stores),
+                "watermarks": {k or "home": v for k, v in self.watermarks.items()},
+                "refreshed_at": self.refreshed_at}
+
+
+async def cube_refresh_loop(interval: float = REFRESH_SECONDS):
+    while True:
+        try:
+            await cube.refresh()
+        except Exception as e:  # keep the loop alive; the cube keeps its last state
+            print(f"cube refresh failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+cube = Cube()
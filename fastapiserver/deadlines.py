@@ -0,0 +1,83 @@
+# deadlines.py
+# Query deadlines and cancellation of abandoned requests.
+#
+# QueryGuardMiddleware gives every /api request a query deadline picked by
+# route class (see admission.classify) or a per-path override; pool
+# connections (db.DeadlineConnection) pass it to each query as asyncpg's
+# timeout, which cancels the query server-side when it expires. It also watches the
+# ASGI receive channel: if the client disconnects before the response is
+# finished, the request task is cancelled, which makes asyncpg cancel the
+# in-flight query server-side and return its connection to the pool.
+import asyncio
+import os
+from typing import Dict
+from db import statement_timeout_ms
+from admission import classify, POINT_READS, WRITES, ANALYTICS, BULK_READS
+from metrics import metrics
+
+# route class -> query deadline in ms
+CLASS_TIMEOUTS_MS: Dict[str, int] = {
+    POINT_READS: int(os.environ.get("DEADLINE_POINT_READS_MS", "2000")),
+    WRITES: int(os.environ.get("DEADLINE_WRITES_MS", "5000")),
+    ANALYTICS: int(os.environ.get("DEADLINE_ANALYTICS_MS", "30000")),
+    BULK_READS: int(os.environ.get("DEADLINE_BULK_READS_MS", "60000")),
+}
+
+# Exact-path overrides for endpoints heavier than their class
+PATH_TIMEOUTS_MS: Dict[str, int] = {
+    "/api/analytics/sales/demographics": 45000,
+}
+
+
+def timeout_for(method: str, path: str):
+    if path in PATH_TIMEOUTS_MS:
+        return PATH_TIMEOUTS_MS[path]
+    route_class = classify(method, path)
+    return CLASS_TIMEOUTS_MS.get(route_class) if route_class else None
+
+
+class QueryGuardMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timeout_ms = timeout_for(scope["method"], scope["path"])
+        if timeout_ms is None:
+            return await self.app(scope, receive, send)
+
+        queue: asyncio.Queue = asyncio.Queue()
+        response_done = False
+
+        async def guarded_send(message):
+            nonlocal response_done
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_done = True
+            await send(message)
+
+        token = statement_timeout_ms.set(timeout_ms)
+        try:
+            app_task = asyncio.create_task(self.app(scope, queue.get, guarded_send))
+        finally:
+            statement_timeout_ms.reset(token)
+
+        async def watch():
+            while True:
+                message = await receive()
+                await queue.put(message)
+                if message["type"] == "http.disconnect":
+                    if not response_done and not app_task.done():
+                        metrics.incr("db.cancelled_on_disconnect")
+                        app_task.cancel()
+                    return
+
+        watcher = asyncio.create_task(watch())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not response_done and watcher.done():
+                return  # client went away; nothing left to answer
+            raise
+        finally:
+            watcher.cancel()
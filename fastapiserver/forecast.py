@@ -0,0 +1,341 @@
+# forecast.py
+# Rolling averages, week-over-week deltas and seasonal forecasts for
+# store x hour traffic and store x category sales.
+#
+# Input is a daily series per key, pre-aggregated in SQL and cached per day
+# for the last FORECAST_HISTORY_DAYS (today excluded, it is still filling
+# up). A refresh compares per-day fingerprints (row count and sums) and
+# re-reads only the days that changed, like basket.py, then refits every
+# series at once in a process pool: fit_days() builds the keys x days matrix
+# from the per-day dicts and fit_series() fits all its rows together, so
+# neither a Python loop per series nor the matrix fill runs on the event loop.
+# The pool's processes come from a forkserver, not forked from the worker
+# with its event loop, sockets and pool connections.
+#
+# With FORECAST_REFRESH_SECONDS > 0 (off by default) one worker refits on
+# that interval (advisory lock, as in snapshot.py); otherwise a worker fits
+# on the first forecast request and again on the first one of each new day.
+# Each fit is written to <FORECAST_DIR>/<kind>.npz with an atomic rename;
+# every worker loads the file when it changes and the endpoints only slice
+# the loaded arrays.
+#
+# The forecast is a seasonal baseline: each weekday's mean over the last
+# FORECAST_SEASONS weeks, scaled by how the last 7 days compare with those
+# weeks (level), with an 80% band from the spread around the weekday means.
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import asyncpg
+import numpy as np
+from db import DATABASE_URL
+from metrics import metrics
+from shards import router
+
+HISTORY_DAYS = int(os.environ.get("FORECAST_HISTORY_DAYS", "84"))
+SEASONS = int(os.environ.get("FORECAST_SEASONS", "4"))
+HORIZON = int(os.environ.get("FORECAST_HORIZON_DAYS", "28"))
+REFRESH_SECONDS = float(os.environ.get("FORECAST_REFRESH_SECONDS", "0"))
+WORKERS = int(os.environ.get("FORECAST_WORKERS", "1"))
+FORECAST_DIR = os.environ.get("FORECAST_DIR", "forecasts")
+Z80 = 1.2816
+
+_REFRESH_LOCK = 728_016
+
+# kind -> daily aggregate (keyed by the leading columns) and fingerprint
+SERIES = {
+    "traffic": {
+        "keys": ("supermarket_id", "hour"),
+        "measures": ("visitors",),
+        "daily": """
+            SELECT date_trunc('day', date) AS day, supermarket_id, hour, SUM(visitor_count) AS visitors
+            FROM customer_traffic
+            WHERE date >= $1 AND date < $2 AND date_trunc('day', date) = ANY($3::timestamp[])
+            GROUP BY 1, 2, 3
+        """,
+        "fingerprint": """
+            SELECT date_trunc('day', date) AS day, COUNT(*) AS n, COALESCE(SUM(visitor_count), 0) AS s
+            FROM customer_traffic WHERE date >= $1 AND date < $2 GROUP BY 1
+        """,
+    },
+    "sales": {
+        "keys": ("supermarket_id", "category"),
+        "measures": ("revenue", "quantity"),
+        "daily": """
+            SELECT date_trunc('day', date) AS day, supermarket_id, category,
+                   SUM(total_amount) AS revenue, SUM(quantity) AS quantity
+            FROM sales
+            WHERE date >= $1 AND date < $2 AND date_trunc('day', date) = ANY($3::timestamp[])
+            GROUP BY 1, 2, 3
+        """,
+        "fingerprint": """
+            SELECT date_trunc('day', date) AS day, COUNT(*) AS n, COALESCE(SUM(total_amount), 0) AS s
+            FROM sales WHERE date >= $1 AND date < $2 GROUP BY 1
+        """,
+    },
+}
+
+
+class ForecastUnavailable(Exception):
+    pass
+
+
+# --- Model (runs in the process pool) ---
+def fit_series(values: np.ndarray, horizon: int, seasons: int) -> Dict[str, np.ndarray]:
+    """Fit every row of a keys x days matrix (oldest day first)."""
+    n, d = values.shape
+    values = values.astype(np.float64)
+    last7 = values[:, -7:].sum(axis=1)
+    prev7 = values[:, -14:-7].sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wow_pct = np.where(prev7 > 0, (last7 - prev7) / prev7, np.nan)
+    s = max(1, min(seasons, d // 7))
+    # Weeks aligned to end on the last day, so block position p is the
+    # weekday of future day j whenever j % 7 == p
+    block = values[:, d - 7 * s:].reshape(n, s, 7)
+    profile = block.mean(axis=1)                       # n x 7 weekday means
+    base = profile.mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        level = np.where(base > 0, values[:, -7:].mean(axis=1) / base, 1.0)
+    spread = block.std(axis=1).mean(axis=1) if s > 1 else np.zeros(n)
+    steps = np.arange(horizon) % 7
+    forecast = profile[:, steps] * level[:, None]
+    # Backtest: predict the last week from the `s` weeks before it
+    mae = np.full(n, np.nan)
+    if d >= 7 * (s + 1):
+        prior = values[:, d - 7 * (s + 1):d - 7].reshape(n, s, 7).mean(axis=1)
+        mae = np.abs(prior - values[:, -7:]).mean(axis=1)
+    return {
+        "rolling_7": values[:, -7:].mean(axis=1),
+        "rolling_28": values[:, -28:].mean(axis=1),
+        "last_7": last7,
+        "wow_delta": last7 - prev7,
+        "wow_pct": wow_pct,
+        "forecast": forecast,
+        "lower": np.maximum(forecast - Z80 * spread[:, None], 0.0),
+        "upper": forecast + Z80 * spread[:, None],
+        "backtest_mae": mae,
+    }
+
+
+def fit_days(per_day: List[Dict[Tuple, Tuple]], n_measures: int, horizon: int,
+             seasons: int) -> Tuple[List[Tuple], List[Dict[str, np.ndarray]]]:
+    """Fit each measure of per-day {key: measures} dicts (oldest day first)."""
+    keys = sorted({k for day in per_day for k in day}, key=str)
+    row = {k: i for i, k in enumerate(keys)}
+    values = np.zeros((n_measures, len(keys), len(per_day)))
+    for j, day in enumerate(per_day):
+        if day:
+            rows = [row[k] for k in day]
+            values[:, rows, j] = np.array(list(day.values()), dtype=np.float64).T
+    return keys, [fit_series(values[m], horizon, seasons) for m in range(n_measures)]
+
+
+def _py(v) -> Optional[float]:
+    v = float(v)
+    return None if np.isnan(v) else round(v, 3)
+
+
+class Fitted:
+    def __init__(self, keys: List[Tuple], first_day: datetime, measure_arrays: Dict[str, Dict[str, np.ndarray]],
+                 fitted_at: Optional[datetime] = None):
+        self.keys = keys
+        self.first_day = first_day  # first forecast day
+        self.arrays = measure_arrays
+        self.fitted_at = fitted_at or datetime.now()
+
+    def save(self, path: str):
+        meta = {"keys": self.keys, "first_day": self.first_day.isoformat(), "fitted_at": self.fitted_at.isoformat()}
+        arrays = {f"{m}.{name}": a for m, per in self.arrays.items() for name, a in per.items()}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Fitted":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            arrays: Dict[str, Dict[str, np.ndarray]] = defaultdict(dict)
+            for name in data.files:
+                if name != "meta":
+                    m, field = name.split(".", 1)
+                    arrays[m][field] = data[name]
+        return cls([tuple(k) for k in meta["keys"]], datetime.fromisoformat(meta["first_day"]), dict(arrays),
+                   datetime.fromisoformat(meta["fitted_at"]))
+
+    def rows_for(self, prefix: Optional[str], second: Optional[str] = None) -> List[int]:
+        return [i for i, k in enumerate(self.keys)
+                if (prefix is None or k[0] == prefix) and (second is None or str(k[1]) == second)]
+
+    def describe(self, i: int, measure: str, horizon: int) -> Dict:
+        a = self.arrays[measure]
+        days = [self.first_day + timedelta(days=j) for j in range(horizon)]
+        return {
+            "rolling_7": _py(a["rolling_7"][i]), "rolling_28": _py(a["rolling_28"][i]),
+            "last_7": _py(a["last_7"][i]), "wow_delta": _py(a["wow_delta"][i]), "wow_pct": _py(a["wow_pct"][i]),
+            "backtest_mae": _py(a["backtest_mae"][i]),
+            "forecast": [{"date": day.date().isoformat(), "value": _py(a["forecast"][i, j]),
+                          "lower": _py(a["lower"][i, j]), "upper": _py(a["upper"][i, j])}
+                         for j, day in enumerate(days)],
+        }
+
+
+# --- Service ---
+def _path(kind: str) -> str:
+    return os.path.join(FORECAST_DIR, f"{kind}.npz")
+
+
+def _today() -> datetime:
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _age_seconds() -> Optional[float]:
+    try:
+        return time.time() - min(os.stat(_path(kind)).st_mtime for kind in SERIES)
+    except FileNotFoundError:
+        return None
+
+
+class Forecaster:
+    def __init__(self):
+        self.fingerprints: Dict[str, Dict[datetime, Tuple]] = {k: {} for k in SERIES}
+        self.daily: Dict[str, Dict[datetime, Dict[Tuple, Tuple]]] = {k: {} for k in SERIES}
+        self.fitted: Dict[str, Fitted] = {}
+        self._loaded: Dict[str, int] = {}  # kind -> mtime_ns of the file in self.fitted
+        self._built: set = set()  # kinds this worker has fitted since it started
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = asyncio.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=WORKERS,
+                                             mp_context=multiprocessing.get_context("forkserver"))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def refresh(self, interval: float = REFRESH_SECONDS):
+        """Refit unless another worker did so within the interval, then load the latest fits."""
+        async with self._lock:
+            age = _age_seconds()
+            if age is None or age >= interval:
+                # The lock is held on its own connection so the refit can use the whole pool
+                conn = await asyncpg.connect(DATABASE_URL)
+                try:
+                    if await conn.fetchval("SELECT pg_try_advisory_lock($1)", _REFRESH_LOCK):
+                        with metrics.timer("forecast.refresh_seconds"):
+                            await self._refit()
+                finally:
+                    await conn.close()  # releases the session lock
+            await asyncio.to_thread(self._load)
+
+    async def _refit(self):
+        end = _today()
+        start = end - timedelta(days=HISTORY_DAYS)
+        for kind in SERIES:
+            if await self._update_days(kind, start, end) or kind not in self._built:
+                await self._fit(kind, start, end)
+            else:
+                os.utime(_path(kind))  # unchanged; mark it fresh for the other workers
+
+    def _load(self):
+        for kind in SERIES:
+            try:
+                mtime = os.stat(_path(kind)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self._loaded.get(kind) != mtime:
+                self.fitted[kind] = Fitted.load(_path(kind))
+                self._loaded[kind] = mtime
+
+    async def _update_days(self, kind: str, start: datetime, end: datetime) -> bool:
+        spec = SERIES[kind]
+        totals: Dict[datetime, List] = defaultdict(lambda: [0, 0])
+        for r in await router.fetch_all(spec["fingerprint"], start, end):
+            totals[r["day"]][0] += r["n"]
+            totals[r["day"]][1] += r["s"]
+        seen = {day: tuple(t) for day, t in totals.items()}
+        old = self.fingerprints[kind]
+        stale = sorted(day for day, fp in seen.items() if old.get(day) != fp)
+        gone = [day for day in old if day not in seen]
+        for day in gone:
+            self.daily[kind].pop(day, None)
+        if stale:
+            metrics.incr("forecast.days_reread", len(stale))
+            fresh: Dict[datetime, Dict[Tuple, Tuple]] = {day: {} for day in stale}
+            for r in await router.fetch_all(spec["daily"], stale[0], stale[-1] + timedelta(days=1), stale):
+                key = tuple(r[c] for c in spec["keys"])
+                prev = fresh[r["day"]].get(key, (0,) * len(spec["measures"]))
+                fresh[r["day"]][key] = tuple(p + r[m] for p, m in zip(prev, spec["measures"]))
+            self.daily[kind].update(fresh)
+        self.fingerprints[kind] = seen
+        # A new day also shifts the window, so refit whenever the day set moved
+        return bool(stale or gone) or (kind in self.fitted and self.fitted[kind].first_day != end)
+
+    async def _fit(self, kind: str, start: datetime, end: datetime):
+        spec = SERIES[kind]
+        per_day = [self.daily[kind].get(start + timedelta(days=i), {}) for i in range((end - start).days)]
+        loop = asyncio.get_running_loop()
+        keys, fits = await loop.run_in_executor(
+            self._executor(), fit_days, per_day, len(spec["measures"]), HORIZON, SEASONS)
+        fitted = Fitted(keys, end, dict(zip(spec["measures"], fits)))
+        await asyncio.to_thread(fitted.save, _path(kind))
+        self._built.add(kind)
+        metrics.set_gauge(f"forecast.{kind}_series", len(keys))
+
+    async def ensure_fitted(self, kind: str) -> Fitted:
+        fitted = self.fitted.get(kind)
+        if fitted is None or (REFRESH_SECONDS <= 0 and fitted.first_day < _today()):
+            await self.refresh()
+        if kind not in self.fitted:
+            raise ForecastUnavailable(f"No {kind} forecast yet; another worker may still be fitting it")
+        return self.fitted[kind]
+
+    def status(self) -> Dict:
+        return {kind: {"series": len(f.keys), "fitted_at": f.fitted_at, "first_forecast_day": f.first_day}
+                for kind, f in self.fitted.items()}
+
+    # --- Results ---
+    async def traffic(self, supermarket_id: Optional[str] = None, horizon: int = 7) -> Dict:
+        fitted = await self.ensure_fitted("traffic")
+        horizon = min(horizon, HORIZON)
+        out: Dict[str, Dict] = defaultdict(dict)
+        for i in fitted.rows_for(supermarket_id):
+            store, hour = fitted.keys[i]
+            out[store][hour] = fitted.describe(i, "visitors", horizon)
+        return {"generated_at": fitted.fitted_at, "stores": {s: {"hours": h} for s, h in out.items()}}
+
+    async def sales(self, supermarket_id: Optional[str] = None, category: Optional[str] = None,
+                    metric: str = "revenue", horizon: int = 7) -> Dict:
+        if metric not in SERIES["sales"]["measures"]:
+            raise ValueError(f"metric must be one of {SERIES['sales']['measures']}")
+        fitted = await self.ensure_fitted("sales")
+        horizon = min(horizon, HORIZON)
+        out: Dict[str, Dict] = defaultdict(dict)
+        for i in fitted.rows_for(supermarket_id, category):
+            store, cat = fitted.keys[i]
+            out[store][cat] = fitted.describe(i, metric, horizon)
+        return {"generated_at": fitted.fitted_at, "metric": metric,
+                "stores": {s: {"categories": c} for s, c in out.items()}}
+
+
+async def forecast_refresh_loop(interval: float = REFRESH_SECONDS):
+    while True:
+        try:
+            await forecaster.refresh(interval)
+        except Exception as e:  # keep the loop alive; the previous fit keeps serving
+            print(f"forecast refresh failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+forecaster = Forecaster()
@@ -0,0 +1,271 @@
+# inventory_engine.py
+# Stock levels driven by the sales feed, and low-stock tracking without
+# scanning inventory.
+#
+# An insert trigger on sales queues (store, product, quantity) in
+# stock_pending, so only sales made after this was installed are charged
+# against current stock. apply_pending() deletes a batch from the queue and
+# decrements inventory.current_stock per (store, product) with one set-based
+# UPDATE, all in one transaction, so every sale is applied exactly once
+# whichever path inserted it (API, bulk loader, POS) and sales rows are never
+# rewritten (no change-log, dashboard or cube events for bookkeeping). A loop
+# runs it every STOCK_APPLY_SECONDS on each database; an advisory try-lock
+# keeps it to one applier per database at a time.
+#
+# Row triggers on inventory record an event in stock_events and NOTIFY
+# "stock_threshold" whenever an item crosses its minimum in either direction,
+# whatever changed it. stock_events() pages on the event id, one cursor
+# position per shard. The partial index inventory_low_stock holds only the
+# items at or below their minimum, so the low-stock endpoint reads just that.
+# Events older than STOCK_EVENTS_MAX_AGE_DAYS are pruned every
+# STOCK_EVENTS_PRUNE_SECONDS; a cursor from before that resumes at the oldest
+# event still kept.
+import asyncio
+import heapq
+import itertools
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+from db import get_conn
+from metrics import metrics
+from shards import router
+
+APPLY_INTERVAL = float(os.environ.get("STOCK_APPLY_SECONDS", "1"))
+BATCH_SIZE = int(os.environ.get("STOCK_APPLY_BATCH", "5000"))
+PRUNE_SECONDS = float(os.environ.get("STOCK_EVENTS_PRUNE_SECONDS", "3600"))
+PRUNE_BATCH = int(os.environ.get("STOCK_EVENTS_PRUNE_BATCH", "10000"))
+MAX_AGE_DAYS = int(os.environ.get("STOCK_EVENTS_MAX_AGE_DAYS", "30"))
+
+_INSTALL_LOCK = 728_006
+_APPLY_LOCK = 728_007
+_PRUNE_LOCK = 728_019
+
+INVENTORY_DDL = """
+CREATE INDEX IF NOT EXISTS inventory_low_stock
+  ON inventory (current_stock) WHERE current_stock <= minimum_stock;
+CREATE INDEX IF NOT EXISTS inventory_store_product ON inventory (supermarket_id, product);
+
+CREATE TABLE IF NOT EXISTS stock_events (
+  id BIGSERIAL PRIMARY KEY,
+  inventory_id VARCHAR NOT NULL,
+  supermarket_id VARCHAR NOT NULL,
+  product TEXT NOT NULL,
+  low BOOLEAN NOT NULL,
+  current_stock INTEGER NOT NULL,
+  minimum_stock INTEGER NOT NULL,
+  at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS stock_events_at ON stock_events (at);
+
+CREATE OR REPLACE FUNCTION stock_threshold_crossed() RETURNS trigger AS $$
+DECLARE
+  is_low BOOLEAN := NEW.current_stock <= NEW.minimum_stock;
+BEGIN
+  INSERT INTO stock_events (inventory_id, supermarket_id, product, low, current_stock, minimum_stock)
+  VALUES (NEW.id, NEW.supermarket_id, NEW.product, is_low, NEW.current_stock, NEW.minimum_stock);
+  PERFORM pg_notify('stock_threshold', json_build_object(
+    'id', NEW.id, 'supermarket_id', NEW.supermarket_id, 'product', NEW.product,
+    'low', is_low, 'current_stock', NEW.current_stock, 'minimum_stock', NEW.minimum_stock)::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS inventory_threshold_update ON inventory;
+CREATE TRIGGER inventory_threshold_update
+AFTER UPDATE OF current_stock, minimum_stock ON inventory
+FOR EACH ROW
+WHEN ((OLD.current_stock <= OLD.minimum_stock) IS DISTINCT FROM (NEW.current_stock <= NEW.minimum_stock))
+EXECUTE PROCEDURE stock_threshold_crossed();
+
+DROP TRIGGER IF EXISTS inventory_threshold_insert ON inventory;
+CREATE TRIGGER inventory_threshold_insert
+AFTER INSERT ON inventory
+FOR EACH ROW WHEN (NEW.current_stock <= NEW.minimum_stock)
+EXECUTE PROCEDURE stock_threshold_crossed();
+"""
+
+SALES_DDL = """
+CREATE TABLE IF NOT EXISTS stock_pending (
+  id BIGSERIAL PRIMARY KEY,
+  supermarket_id VARCHAR NOT NULL,
+  product TEXT NOT NULL,
+  quantity INTEGER NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION queue_stock_sale() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO stock_pending (supermarket_id, product, quantity)
+  VALUES (NEW.supermarket_id, NEW.product, NEW.quantity);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# Also used by partitions.py to move the trigger onto a partitioned sales
+STOCK_TRIGGER_DDL = """
+CREATE TRIGGER sales_stock_pending
+AFTER INSERT ON sales
+FOR EACH ROW EXECUTE PROCEDURE queue_stock_sale()
+"""
+
+CLAIM_SQL = """
+WITH pending AS (
+  SELECT id FROM stock_pending ORDER BY id LIMIT $1
+)
+DELETE FROM stock_pending s
+USING pending p WHERE s.id = p.id
+RETURNING s.supermarket_id, s.product, s.quantity
+"""
+
+# When a store lists a product more than once, the newest row is the one charged
+DECREMENT_SQL = """
+WITH d AS (
+  SELECT * FROM unnest($1::varchar[], $2::text[], $3::int[]) AS d(supermarket_id, product, qty)
+),
+target AS (
+  SELECT DISTINCT ON (i.supermarket_id, i.product) i.id, d.qty
+  FROM inventory i JOIN d ON i.supermarket_id = d.supermarket_id AND i.product = d.product
+  ORDER BY i.supermarket_id, i.product, i.created_at DESC
+)
+UPDATE inventory i SET current_stock = GREATEST(i.current_stock - t.qty, 0)
+FROM target t WHERE i.id = t.id
+"""
+
+
+async def install_inventory_engine(conn):
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+        if await conn.fetchval("SELECT to_regclass('inventory') IS NOT NULL"):
+            await conn.execute(INVENTORY_DDL)
+        if await conn.fetchval("SELECT to_regclass('sales') IS NOT NULL"):
+            await conn.execute(SALES_DDL)
+            if not await conn.fetchval("""
+                    SELECT EXISTS (SELECT 1 FROM pg_trigger
+                                   WHERE tgname = 'sales_stock_pending' AND tgrelid = 'sales'::regclass)"""):
+                await conn.execute(STOCK_TRIGGER_DDL)
+
+
+async def install_all():
+    async with get_conn() as conn:
+        await install_inventory_engine(conn)
+    for name in router.names:
+        async with router.conn(name) as conn:
+            await install_inventory_engine(conn)
+
+
+async def apply_pending(conn, batch_size: int = BATCH_SIZE) -> int:
+    """Apply up to batch_size unapplied sales to stock; returns how many."""
+    async with conn.transaction():
+        if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", _APPLY_LOCK):
+            return 0  # another worker is applying on this database
+        sold = await conn.fetch(CLAIM_SQL, batch_size)
+        if not sold:
+            return 0
+        totals: Dict[tuple, int] = defaultdict(int)
+        for r in sold:
+            totals[(r["supermarket_id"], r["product"])] += r["quantity"]
+        keys = list(totals)
+        await conn.execute(DECREMENT_SQL, [k[0] for k in keys], [k[1] for k in keys],
+                           [totals[k] for k in keys])
+    metrics.incr("stock.sales_applied", len(sold))
+    return len(sold)
+
+
+async def drain(conn) -> int:
+    applied = 0
+    while True:
+        n = await apply_pending(conn)
+        applied += n
+        if n < BATCH_SIZE:
+            return applied
+
+
+async def stock_apply_loop(interval: float = APPLY_INTERVAL):
+    while True:
+        try:
+            with metrics.timer("stock.apply_seconds"):
+                await router.fan_out(drain)
+        except Exception as e:  # keep the loop alive; retried next tick
+            print(f"stock apply failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+# --- Pruning ---
+async def prune_stock_events(conn, batch_size: int = PRUNE_BATCH) -> int:
+    """Drop events older than MAX_AGE_DAYS on one database; returns how many."""
+    # In bounded batches, one short transaction each
+    deleted = 0
+    while True:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", _PRUNE_LOCK):
+                return deleted  # another worker is pruning
+            if not await conn.fetchval("SELECT to_regclass('stock_events') IS NOT NULL"):
+                return deleted
+            n = await conn.fetchval("""
+                WITH gone AS (
+                  DELETE FROM stock_events WHERE id IN (
+                    SELECT id FROM stock_events
+                    WHERE at < NOW() - make_interval(days => $1)
+                    LIMIT $2
+                  ) RETURNING 1
+                )
+                SELECT COUNT(*) FROM gone
+            """, MAX_AGE_DAYS, batch_size)
+        deleted += n
+        if n < batch_size:
+            return deleted
+
+
+async def stock_events_prune_loop(interval: float = PRUNE_SECONDS):
+    while True:
+        try:
+            deleted = sum(await router.fan_out(prune_stock_events))
+            metrics.incr("stock.events_pruned", deleted)
+        except Exception as e:  # keep the loop alive; the next round catches up
+            print(f"stock_events prune failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+def _encode_cursor(last: Dict[str, int]) -> str:
+    return ",".join(f"{shard}:{i}" if shard else str(i) for shard, i in sorted(last.items()))
+
+
+def _decode_cursor(cursor: Optional[str]) -> Dict[str, int]:
+    if not cursor:
+        return {}
+    try:
+        return {shard: int(i) for shard, _, i in (part.rpartition(":") for part in cursor.split(","))}
+    except ValueError:
+        raise ValueError(f"Invalid stock event cursor: {cursor!r}")
+
+
+async def stock_events(after: Optional[str] = None, since: Optional[datetime] = None,
+                       limit: int = 500) -> List[Dict]:
+    """Threshold crossings after the `after` cursor (and `since`), oldest first, across all shards.
+
+    Each event carries the cursor to resume after it.
+    """
+    last = _decode_cursor(after)
+    shards = router.names or [""]
+
+    async def fetch(shard):
+        async with router.conn(shard or None) as conn:
+            return await conn.fetch("""
+                SELECT id, inventory_id, supermarket_id, product, low, current_stock, minimum_stock, at
+                FROM stock_events
+                WHERE id > $1 AND at > COALESCE($2, '-infinity'::timestamp)
+                ORDER BY id
+                LIMIT $3
+            """, last.get(shard, 0), since, limit)
+
+    parts = await asyncio.gather(*(fetch(shard) for shard in shards))
+    # Keeps each shard in id order, so its cursor position only moves forward
+    merged = heapq.merge(*([(shard, dict(r)) for r in rows] for shard, rows in zip(shards, parts)),
+                         key=lambda t: t[1]["at"])
+    events = []
+    for shard, event in itertools.islice(merged, limit):
+        last[shard] = event.pop("id")
+        event["cursor"] = _encode_cursor(last)
+        events.append(event)
+    return events
@@ -0,0 +1,478 @@
+# jobs.py
+# Background jobs for long-running exports and reports.
+#
+# Jobs are rows in the `jobs` table, so a restart loses nothing: queued jobs
+# stay queued, and jobs whose worker stopped heartbeating are put back in the
+# queue. A runner claims work with FOR UPDATE SKIP LOCKED, so several runners
+# (the API process and any number of `python jobs.py worker` processes) can
+# share the queue. Each job type has a concurrency limit across all runners,
+# checked when a job is claimed. A job finishes only if it is still running
+# under the runner that claimed it; if it was requeued as stale meanwhile,
+# the slow runner's result is dropped. Results are written to SPOOL_DIR and
+# removed, with their row, once they expire.
+import argparse
+import asyncio
+import csv
+import json
+import os
+import shutil
+import socket
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+import db
+from db import get_conn
+from metrics import metrics
+from shards import router, STORE_TABLES
+
+SPOOL_DIR = os.environ.get("JOB_SPOOL_DIR", "spool")
+RESULT_TTL = timedelta(hours=float(os.environ.get("JOB_RESULT_TTL_HOURS", "24")))
+# A running job whose heartbeat is older than this is presumed orphaned
+STALE_AFTER = timedelta(seconds=60)
+POLL_INTERVAL = 1.0
+# Longest a progress update waits for a pool connection before it is skipped
+PROGRESS_ACQUIRE_TIMEOUT = 0.1
+# Rows fetched from the export cursor and handed to the writer thread at a time
+EXPORT_BATCH = 1000
+# Serializes claims so the running-job count each one checks is exact
+_CLAIM_LOCK = 728_018
+
+# Running jobs per type, across every runner
+CONCURRENCY = {
+    "export": int(os.environ.get("JOB_EXPORT_CONCURRENCY", "2")),
+    "report": int(os.environ.get("JOB_REPORT_CONCURRENCY", "1")),
+}
+
+JOBS_DDL = """
+CREATE TABLE IF NOT EXISTS jobs (
+  id VARCHAR PRIMARY KEY DEFAULT gen_random_uuid(),
+  type TEXT NOT NULL,
+  params JSONB NOT NULL DEFAULT '{}',
+  status TEXT NOT NULL DEFAULT 'queued',
+  progress BIGINT NOT NULL DEFAULT 0,
+  total BIGINT,
+  result_path TEXT,
+  content_type TEXT,
+  error TEXT,
+  worker TEXT,
+  heartbeat_at TIMESTAMP,
+  created_at TIMESTAMP DEFAULT NOW(),
+  started_at TIMESTAMP,
+  finished_at TIMESTAMP,
+  expires_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (type, created_at) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS jobs_running ON jobs (type) WHERE status = 'running';
+"""
+
+# CSV exports: kind -> (query, header, columns)
+EXPORTS = {
+    "clients": (
+        "SELECT * FROM clients ORDER BY created_at DESC",
+        ["Name", "Email", "Phone", "Company", "Status", "Last Contact", "Created At"],
+        ["name", "email", "phone", "company", "status", "last_contact", "created_at"],
+    ),
+    "follow-ups": (
+        "SELECT * FROM follow_ups ORDER BY scheduled_date ASC",
+        ["Title", "Type", "Scheduled Date", "Completed", "Client ID", "Description"],
+        ["title", "type", "scheduled_date", "completed", "client_id", "description"],
+    ),
+    "tasks": (
+        "SELECT * FROM tasks ORDER BY created_at DESC",
+        ["Title", "Priority", "Due Date", "Completed", "Client ID", "Description"],
+        ["title", "priority", "due_date", "completed", "client_id", "description"],
+    ),
+    "sales": ("SELECT * FROM sales ORDER BY date DESC", None, None),
+    "inventory": ("SELECT * FROM inventory ORDER BY product", None, None),
+    "customer_traffic": ("SELECT * FROM customer_traffic ORDER BY date DESC, hour DESC", None, None),
+}
+
+EXPORT_TABLES = {"follow-ups": "follow_ups"}
+
+# Analytics reports: name -> Storage method
+REPORTS = (
+    "get_sales_by_category", "get_sales_by_payment_method", "get_sales_by_demographic",
+    "get_traffic_by_hour", "get_traffic_by_supermarket", "get_low_stock_items",
+)
+
+
+def _cell(v):
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.isoformat()
+    return v
+
+
+class JobContext:
+    """Handed to job handlers for progress reporting."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.progress = 0
+        self._reported_at = 0.0
+
+    async def set_total(self, total: Optional[int]):
+        async with get_conn() as conn:
+            await conn.execute("UPDATE jobs SET total = $2 WHERE id = $1", self.job_id, total)
+
+    async def advance(self, n: int = 1, force: bool = False):
+        """Count n more rows; reported at most once a second.
+
+        Handlers call this while holding a pool connection of their own, so a
+        periodic report only waits briefly for a second one and is skipped if
+        the pool is exhausted (the runner's heartbeat keeps the job alive).
+        A forced report is made after the handler has released its connection.
+        """
+        self.progress += n
+        now = asyncio.get_running_loop().time()
+        if force or now - self._reported_at >= 1.0:
+            self._reported_at = now
+            if force:
+                async with get_conn() as conn:
+                    await self._report(conn)
+                return
+            if db.pool is None:
+                return
+            try:
+                conn = await db.pool.acquire(timeout=PROGRESS_ACQUIRE_TIMEOUT)
+            except asyncio.TimeoutError:
+                metrics.incr("jobs.progress_skipped")
+                return
+            try:
+                await self._report(conn)
+            finally:
+                await db.pool.release(conn)
+
+    async def _report(self, conn):
+        await conn.execute(
+            "UPDATE jobs SET progress = $2, heartbeat_at = NOW() WHERE id = $1",
+            self.job_id, self.progress)
+
+
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# --- Handlers: return (path, content_type) ---
+async def _export_columns(conn, query: str):
+    stmt = await conn.prepare(query)
+    return [a.name for a in stmt.get_attributes()]
+
+
+async def _write_rows(ctx: JobContext, conn, query: str, columns, path: str):
+    """Stream query's rows to path as header-less CSV; file writes run in a thread."""
+    f = await asyncio.to_thread(open, path, "w", newline="")
+    try:
+        writer = csv.writer(f)
+        # Cursors need a transaction; rows are streamed, not buffered
+        async with conn.transaction(readonly=True):
+            cursor = await conn.cursor(query)
+            while True:
+                rows = await cursor.fetch(EXPORT_BATCH)
+                if not rows:
+                    break
+                await asyncio.to_thread(writer.writerows, [[_cell(r[c]) for c in columns] for r in rows])
+                await ctx.advance(len(rows))
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+def _concat(path: str, header, pieces):
+    with open(path, "w", newline="") as out:
+        csv.writer(out).writerow(header)
+        for piece in pieces:
+            with open(piece, newline="") as f:
+                shutil.copyfileobj(f, out)
+
+
+async def _on_sources(table: str, fn):
+    """fn(conn) on every shard for a store-scoped table, else on the home database."""
+    if table in STORE_TABLES:
+        return await router.fan_out(fn)  # just the home database when unsharded
+    async with get_conn() as conn:
+        return [await fn(conn)]
+
+
+async def run_export(ctx: JobContext, params: Dict):
+    kind = params["kind"]
+    query, header, columns = EXPORTS[kind]
+    table = EXPORT_TABLES.get(kind, kind)
+    path = os.path.join(SPOOL_DIR, f"{ctx.job_id}.csv")
+    part = path + ".part"
+
+    estimates = await _on_sources(table, lambda conn: conn.fetchval(
+        "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass($1)", table))
+    estimate = sum(e for e in estimates if e and e > 0)
+    await ctx.set_total(estimate or None)
+    if columns is None:
+        columns = header = (await _on_sources(table, lambda conn: _export_columns(conn, query)))[0]
+
+    # Each source streams into its own piece file at the same time; the pieces
+    # are then joined, so rows are ordered within a shard but not across them
+    pieces = [f"{part}.{i}" for i in range(len(estimates))]
+    free_pieces = list(reversed(pieces))
+    writers = []
+
+    async def write(conn):
+        writers.append(asyncio.current_task())
+        await _write_rows(ctx, conn, query, columns, free_pieces.pop())
+
+    try:
+        await _on_sources(table, write)
+        await asyncio.to_thread(_concat, part, header, pieces)
+        os.replace(part, path)
+    except BaseException:
+        # Stop the other shards' writers before their pieces are removed
+        others = [t for t in writers if t is not asyncio.current_task()]
+        for t in others:
+            t.cancel()
+        await asyncio.gather(*others, return_exceptions=True)
+        _discard(part)
+        raise
+    finally:
+        for piece in pieces:
+            _discard(piece)
+    await ctx.advance(0, force=True)
+    return path, "text/csv"
+
+
+async def run_report(ctx: JobContext, params: Dict):
+    from storage import storage
+
+    name = params["report"]
+    kwargs = {}
+    for k in ("start", "end"):
+        if params.get(k):
+            kwargs[k] = datetime.fromisoformat(params[k])
+    method = getattr(storage, name)
+    rows = await (method(**kwargs) if kwargs else method())
+    path = os.path.join(SPOOL_DIR, f"{ctx.job_id}.json")
+    try:
+        with open(path + ".part", "w") as f:
+            json.dump(rows, f, default=str)
+        os.replace(path + ".part", path)
+    except BaseException:
+        _discard(path + ".part")
+        raise
+    await ctx.advance(len(rows), force=True)
+    return path, "application/json"
+
+
+HANDLERS: Dict[str, Callable[[JobContext, Dict], Awaitable]] = {
+    "export": run_export,
+    "report": run_report,
+}
+
+
+def validate(job_type: str, params: Dict):
+    if job_type == "export":
+        if params.get("kind") not in EXPORTS:
+            raise ValueError(f"Unknown export kind: {params.get('kind')}")
+    elif job_type == "report":
+        if params.get("report") not in REPORTS:
+            raise ValueError(f"Unknown report: {params.get('report')}")
+    else:
+        raise ValueError(f"Unknown job type: {job_type}")
+
+
+# --- Queue API ---
+async def install_jobs():
+    async with get_conn() as conn:
+        await conn.execute(JOBS_DDL)
+
+
+async def enqueue(job_type: str, params: Dict) -> Dict:
+    validate(job_type, params)
+    async with get_conn() as conn:
+        row = await conn.fetchrow(
+            "INSERT INTO jobs (type, params) VALUES ($1, $2::jsonb) RETURNING *",
+            job_type, json.dumps(params))
+    metrics.incr(f"jobs.{job_type}.queued")
+    return _public(row)
+
+
+async def get_job(job_id: str) -> Optional[Dict]:
+    async with get_conn() as conn:
+        row = await conn.fetchrow("SELECT * FROM jobs WHERE id = $1", job_id)
+    return _public(row) if row else None
+
+
+async def get_job_file(job_id: str) -> Optional[Dict]:
+    async with get_conn() as conn:
+        row = await conn.fetchrow(
+            "SELECT result_path, content_type FROM jobs WHERE id = $1 AND status = 'done'", job_id)
+    return dict(row) if row else None
+
+
+def _public(row) -> Dict:
+    job = dict(row)
+    job["params"] = json.loads(job["params"]) if isinstance(job["params"], str) else job["params"]
+    job.pop("result_path", None)
+    job.pop("worker", None)
+    return job
+
+
+# --- Runner ---
+class JobRunner:
+    def __init__(self, concurrency: Dict[str, int] = CONCURRENCY):
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency
+        # No runner can use more than the global limit, so it is also the local one
+        self.slots = {t: asyncio.Semaphore(n) for t, n in concurrency.items()}
+        self._tasks: set = set()
+        self._loop_task: Optional[asyncio.Task] = None
+
+    async def _claim(self, job_type: str) -> Optional[Dict]:
+        async with get_conn() as conn:
+            async with conn.transaction():
+                # Taken before the UPDATE so its snapshot sees every earlier claim
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", _CLAIM_LOCK)
+                row = await conn.fetchrow("""
+                    UPDATE jobs SET status = 'running', worker = $2,
+                           started_at = NOW(), heartbeat_at = NOW()
+                    WHERE id = (
+                      SELECT id FROM jobs WHERE status = 'queued' AND type = $1
+                      ORDER BY created_at
+                      FOR UPDATE SKIP LOCKED
+                      LIMIT 1
+                    )
+                    AND (SELECT COUNT(*) FROM jobs WHERE status = 'running' AND type = $1) < $3
+                    RETURNING id, type, params
+                """, job_type, self.name, self.concurrency[job_type])
+        return dict(row) if row else None
+
+    def _lost(self, job: Dict, status: str) -> bool:
+        """True if a finishing UPDATE matched nothing: the job was requeued as stale."""
+        if status != "UPDATE 0":
+            return False
+        metrics.incr(f"jobs.{job['type']}.lost")
+        print(f"job {job['id']} was requeued while {self.name} ran it; result dropped")
+        return True
+
+    async def _execute(self, job: Dict, slot: asyncio.Semaphore):
+        ctx = JobContext(job["id"])
+        params = json.loads(job["params"]) if isinstance(job["params"], str) else job["params"]
+        try:
+            with metrics.timer(f"jobs.{job['type']}.seconds"):
+                path, content_type = await HANDLERS[job["type"]](ctx, params)
+            async with get_conn() as conn:
+                status = await conn.execute("""
+                    UPDATE jobs SET status = 'done', result_path = $2, content_type = $3,
+                           finished_at = NOW(), expires_at = NOW() + $4::interval
+                    WHERE id = $1 AND worker = $5 AND status = 'running'
+                """, job["id"], path, content_type, RESULT_TTL, self.name)
+            # The file is left alone when lost: the new run writes the same path
+            if not self._lost(job, status):
+                metrics.incr(f"jobs.{job['type']}.done")
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back to the queue
+            async with get_conn() as conn:
+                await conn.execute("""
+                    UPDATE jobs SET status = 'queued', worker = NULL, progress = 0
+                    WHERE id = $1 AND worker = $2 AND status = 'running'
+                """, job["id"], self.name)
+            raise
+        except Exception as e:
+            async with get_conn() as conn:
+                status = await conn.execute("""
+                    UPDATE jobs SET status = 'failed', error = $2, finished_at = NOW(),
+                           expires_at = NOW() + $3::interval
+                    WHERE id = $1 AND worker = $4 AND status = 'running'
+                """, job["id"], repr(e), RESULT_TTL, self.name)
+            if not self._lost(job, status):
+                metrics.incr(f"jobs.{job['type']}.failed")
+        finally:
+            slot.release()
+
+    async def requeue_stale(self):
+        async with get_conn() as conn:
+            await conn.execute("""
+                UPDATE jobs SET status = 'queued', worker = NULL, progress = 0
+                WHERE status = 'running' AND heartbeat_at < NOW() - $1::interval
+            """, STALE_AFTER)
+
+    async def cleanup_expired(self):
+        async with get_conn() as conn:
+            rows = await conn.fetch(
+                "DELETE FROM jobs WHERE expires_at < NOW() RETURNING result_path")
+        for r in rows:
+            if r["result_path"]:
+                _discard(r["result_path"])
+
+    async def _heartbeat(self):
+        async with get_conn() as conn:
+            await conn.execute(
+                "UPDATE jobs SET heartbeat_at = NOW() WHERE status = 'running' AND worker = $1",
+                self.name)
+
+    async def run(self):
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        last_housekeeping = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if loop.time() - last_housekeeping > STALE_AFTER.total_seconds() / 3:
+                    last_housekeeping = loop.time()
+                    await self._heartbeat()
+                    await self.requeue_stale()
+                    await self.cleanup_expired()
+                claimed = False
+                for job_type, slot in self.slots.items():
+                    if slot.locked():
+                        continue
+                    await slot.acquire()
+                    try:
+                        job = await self._claim(job_type)
+                    except BaseException:
+                        slot.release()
+                        raise
+                    if job is None:
+                        slot.release()
+                        continue
+                    claimed = True
+                    task = asyncio.create_task(self._execute(job, slot))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                if not claimed:
+                    await asyncio.sleep(POLL_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # DB hiccup: back off and retry
+                print(f"job runner error: {e!r}")
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def start(self):
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    from db import init_db_pool, close_db_pool
+
+    parser = argparse.ArgumentParser(description="Background job worker")
+    parser.add_argument("command", choices=["worker"])
+    parser.parse_args()
+
+    async def run():
+        await init_db_pool()
+        await install_jobs()
+        runner = JobRunner()
+        try:
+            await runner.run()
+        finally:
+            await runner.stop()
+            await close_db_pool()
+
+    asyncio.run(run())
@@ -1,23 +1,55 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Query
-from datetime import datetime
-from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Query, Request, Body, Header
+from datetime import datetime, timedelta
+from fastapi.responses import PlainTextResponse, StreamingResponse, Response
 from typing import List, Optional
 import uvicorn
-from storage import storage
+from storage import storage, EMBEDDED, naive_utc
 from models import (
     ClientCreate, Client, FollowUpCreate, FollowUp,
     TaskCreate, Task, InteractionCreate, Interaction,
     SupermarketCreate, Supermarket,
     SalesCreate, Sales,
     InventoryCreate, Inventory,
-    CustomerTrafficCreate, CustomerTraffic
+    CustomerTrafficCreate, CustomerTraffic,
+    FollowUpBulk, TaskBulk, CheckoutRequest
 )
 import io
 import csv
+import json
 import asyncio
+from changes import install_change_log, read_changes, decode_token, change_log_prune_loop, TokenExpired, PRUNE_SECONDS as CHANGE_LOG_PRUNE_SECONDS
+from partitions import partition_maintenance_loop
+from metrics import metrics
+from traffic_ingest import traffic_aggregator, ensure_traffic_unique_key
+from shards import router as shard_router
+import jobs
+import stream
+import inventory_engine
+from scheduler import scheduler, install_scheduler
+import overview
+import bulk
+from catalog import catalog, install_catalog_notify
+import checkout
+from basket import baskets, basket_refresh_loop, BasketsUnavailable, REFRESH_SECONDS as BASKET_REFRESH_SECONDS
+from admission import admission, AdmissionMiddleware
+from deadlines import QueryGuardMiddleware
+import asyncpg
+import os
+import sys
 
 app = FastAPI(title="CRM + Supermarket Analytics API")
+app.add_middleware(AdmissionMiddleware, controller=admission)
+# Outermost, so a disconnect also abandons a request still queued for admission
+app.add_middleware(QueryGuardMiddleware)
+
+# QueryCanceledError: a server-side statement_timeout; TimeoutError: the
+# request's deadline (deadlines.py) expired and asyncpg cancelled the query
+@app.exception_handler(asyncpg.exceptions.QueryCanceledError)
+@app.exception_handler(asyncio.TimeoutError)
+async def query_timeout_handler(request: Request, exc: Exception):
+    metrics.incr("db.statement_timeouts")
+    return Response(content='{"detail":"Query timed out"}', status_code=504, media_type="application/json")
 # Clients
 @app.get("/api/clients", response_model=List[dict])
 async def get_clients():
@@ -34,6 +66,26 @@ async def get_client(id: str):
         raise HTTPException(status_code=404, detail="Client not found")
     return client
 
+# Client 360: client row, recent follow-ups/tasks/interactions, open counts
+# and last activity in one database round trip
+@app.get("/api/clients/{id}/overview", response_model=dict)
+async def get_client_overview(id: str, limit: int = Query(overview.DEFAULT_LIMIT, ge=1, le=overview.MAX_LIMIT)):
+    client = await storage.get_client_overview(id, limit)
+    if not client:
+        raise HTTPException(status_code=404, detail="Client not found")
+    return client
+
+# Next page of one overview section, from that section's next_cursor
+@app.get("/api/clients/{id}/overview/{section}", response_model=dict)
+async def get_client_section(id: str, section: str, cursor: Optional[str] = None,
+                             limit: int = Query(overview.DEFAULT_LIMIT, ge=1, le=overview.MAX_LIMIT)):
+    if section not in overview.SECTIONS:
+        raise HTTPException(status_code=404, detail="Unknown section")
+    try:
+        return await storage.get_client_section(id, section, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/api/clients", status_code=201, response_model=dict)
 async def create_client(payload: ClientCreate):
     return await storage.create_client(payload.dict())
@@ -65,6 +117,11 @@ async def get_follow_ups_by_client(clientId: str):
 async def create_follow_up(payload: FollowUpCreate):
     return await storage.create_follow_up(payload.dict())
 
+# Bulk create/update/complete/delete in one transaction; per-id results
+@app.post("/api/follow-ups/bulk", response_model=dict)
+async def bulk_follow_ups(payload: FollowUpBulk):
+    return await apply_bulk("follow_ups", payload.dict())
+
 @app.put("/api/follow-ups/{id}", response_model=dict)
 async def update_follow_up(id: str, payload: dict):
     follow = await storage.update_follow_up(id, payload)
@@ -99,6 +156,18 @@ async def get_tasks_by_client(clientId: str):
 async def create_task(payload: TaskCreate):
     return await storage.create_task(payload.dict())
 
+@app.post("/api/tasks/bulk", response_model=dict)
+async def bulk_tasks(payload: TaskBulk):
+    return await apply_bulk("tasks", payload.dict())
+
+async def apply_bulk(table: str, ops: dict):
+    try:
+        return await storage.bulk_mutate(table, ops)
+    except bulk.BatchTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.put("/api/tasks/{id}", response_model=dict)
 async def update_task(id: str, payload: dict):
     task = await storage.update_task(id, payload)
@@ -120,6 +189,19 @@ async def delete_task(id: str):
         raise HTTPException(status_code=404, detail="Task not found")
     return PlainTextResponse(status_code=204)
 
+# Agenda: open follow-ups and tasks due in [from, to), soonest first
+@app.get("/api/agenda", response_model=List[dict])
+async def get_agenda(start: Optional[datetime] = Query(None, alias="from"),
+                     end: Optional[datetime] = Query(None, alias="to"),
+                     includeCompleted: bool = False,
+                     limit: int = Query(500, ge=1, le=5000)):
+    # due dates are stored as naive UTC, so aware bounds are converted first
+    start = naive_utc(start) or datetime.utcnow()
+    end = naive_utc(end) or start + timedelta(days=7)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+    return await storage.get_agenda(start, end, includeCompleted, limit)
+
 # Interactions
 @app.get("/api/interactions", response_model=List[dict])
 async def get_interactions():
@@ -174,6 +256,78 @@ async def export_tasks_csv():
     output.seek(0)
     return StreamingResponse(iter([output.getvalue()]), media_type="text/csv", headers={"Content-Disposition":"attachment; filename=tasks.csv"})
 
+# Background jobs (exports / reports)
+job_runner = jobs.JobRunner()
+
+@app.post("/api/jobs/export", status_code=202)
+async def create_export_job(kind: str = Body(..., embed=True)):
+    try:
+        return await jobs.enqueue("export", {"kind": kind})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/jobs/report", status_code=202)
+async def create_report_job(report: str = Body(..., embed=True), start: Optional[datetime] = Body(None, embed=True), end: Optional[datetime] = Body(None, embed=True)):
+    params = {"report": report, "start": start.isoformat() if start else None, "end": end.isoformat() if end else None}
+    try:
+        return await jobs.enqueue("report", params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/jobs/{id}")
+async def get_job(id: str):
+    job = await jobs.get_job(id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{id}/download")
+async def download_job(id: str, request: Request):
+    result = await jobs.get_job_file(id)
+    if not result or not os.path.exists(result["result_path"]):
+        raise HTTPException(status_code=404, detail="Result not available")
+    path = result["result_path"]
+    size = os.path.getsize(path)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename={os.path.basename(path)}",
+    }
+
+    start, end = 0, size - 1
+    status = 200
+    range_header = request.headers.get("range")
+    if range_header:
+        try:
+            unit, spec = range_header.split("=", 1)
+            first, last = spec.split(",")[0].strip().split("-")
+            if unit.strip() != "bytes":
+                raise ValueError
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Range header")
+        if start > end or start >= size:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    def chunks():
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(1 << 16, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    return StreamingResponse(chunks(), status_code=status, media_type=result["content_type"], headers=headers)
+
 # Stats
 @app.get("/api/stats")
 async def get_stats():
@@ -202,21 +356,80 @@ async def create_supermarket(payload: SupermarketCreate):
     return await storage.create_supermarket(payload.dict())
 
 # Analytics endpoints
+# engine=snapshot answers from the memory-mapped columnar snapshot (snapshot.py)
+# instead of querying Postgres; it covers hot data as of the last refresh.
+ENGINE = Query("sql", pattern="^(sql|snapshot)$")
+
+async def from_snapshot(method: str, *args, include_archive: bool = False, **kwargs):
+    if include_archive:
+        raise HTTPException(status_code=400, detail="include_archive is not supported with engine=snapshot")
+    import snapshot
+    try:
+        return await asyncio.to_thread(getattr(snapshot.engine, method), *args, **kwargs)
+    except snapshot.SnapshotUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/api/analytics/sales/category")
-async def sales_by_category():
-    return await storage.get_sales_by_category()
+async def sales_by_category(start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False,
+                            engine: str = ENGINE):
+    if engine == "snapshot":
+        return await from_snapshot("sales_by_category", start, end, include_archive=include_archive)
+    return await storage.get_sales_by_category(start, end, include_archive)
 
 @app.get("/api/analytics/sales/payment-method")
-async def sales_by_payment():
-    return await storage.get_sales_by_payment_method()
+async def sales_by_payment(start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False,
+                           engine: str = ENGINE):
+    if engine == "snapshot":
+        return await from_snapshot("sales_by_payment_method", start, end, include_archive=include_archive)
+    return await storage.get_sales_by_payment_method(start, end, include_archive)
 
 @app.get("/api/analytics/sales/demographics")
-async def sales_by_demo():
-    return await storage.get_sales_by_demographic()
+async def sales_by_demo(start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False,
+                        engine: str = ENGINE):
+    if engine == "snapshot":
+        return await from_snapshot("sales_by_demographic", start, end, include_archive=include_archive)
+    return await storage.get_sales_by_demographic(start, end, include_archive)
 
 @app.get("/api/analytics/sales")
-async def get_sales():
-    return await storage.get_sales()
+async def get_sales(start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False):
+    return await storage.get_sales(start, end, include_archive)
+
+# Ad-hoc questions, answered only from the snapshot
+@app.get("/api/analytics/snapshot")
+async def snapshot_status():
+    return await from_snapshot("status")
+
+@app.get("/api/analytics/sales/basket-sizes")
+async def basket_sizes(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                       supermarketId: Optional[str] = None):
+    return await from_snapshot("basket_sizes", start, end, supermarketId)
+
+@app.get("/api/analytics/sales/elasticity")
+async def price_elasticity(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                           minObservations: int = Query(30, ge=2)):
+    return await from_snapshot("price_elasticity", start, end, minObservations)
+
+@app.get("/api/analytics/sales/spend-percentiles")
+async def spend_percentiles(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                            by: str = Query("supermarket", pattern="^(supermarket|category|payment)$"),
+                            q: str = "50,90,99"):
+    try:
+        qs = [float(x) for x in q.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="q must be a comma-separated list of percentiles")
+    if not qs or any(not 0 <= x <= 100 for x in qs):
+        raise HTTPException(status_code=400, detail="percentiles must be between 0 and 100")
+    column = {"supermarket": "supermarket_id", "category": "category", "payment": "payment_method"}[by]
+    return await from_snapshot("spend_percentiles", start, end, column, qs)
+
+@app.get("/api/analytics/rolling")
+async def rolling_metric(metric: str = Query(..., pattern="^(revenue|units|transactions|visitors)$"),
+                         window: int = Query(7, ge=1, le=365),
+                         start: Optional[datetime] = None, end: Optional[datetime] = None,
+                         supermarketId: Optional[str] = None):
+    return await from_snapshot("rolling", metric, window, start, end, supermarketId)
 
 @app.get("/api/analytics/inventory")
 async def get_inventory():
@@ -227,29 +440,196 @@ async def low_stock_items():
     return await storage.get_low_stock_items()
 
 @app.get("/api/analytics/traffic/hourly")
-async def traffic_by_hour():
-    return await storage.get_traffic_by_hour()
+async def traffic_by_hour(start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False,
+                          engine: str = ENGINE):
+    if engine == "snapshot":
+        return await from_snapshot("traffic_by_hour", start, end, include_archive=include_archive)
+    return await storage.get_traffic_by_hour(start, end, include_archive)
 
 @app.get("/api/analytics/traffic/supermarkets")
-async def traffic_by_supermarket():
-    return await storage.get_traffic_by_supermarket()
+async def traffic_by_supermarket(start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False,
+                                 engine: str = ENGINE):
+    if engine == "snapshot":
+        return await from_snapshot("traffic_by_supermarket", start, end, include_archive=include_archive)
+    return await storage.get_traffic_by_supermarket(start, end, include_archive)
+
+# Top products per store and period, from merged per-day sketches (basket.py)
+@app.get("/api/analytics/top-products")
+async def top_products(period: str = Query("week", pattern="^(day|week|month)$"), date: Optional[datetime] = None,
+                       k: int = Query(10, ge=1, le=100), metric: str = Query("quantity", pattern="^(quantity|revenue)$"),
+                       supermarketId: Optional[str] = None):
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="Basket analytics need the Postgres backend")
+    try:
+        return await baskets.top_products(period, date, k, metric, supermarketId)
+    except BasketsUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+# Association rules (support, confidence, lift) over sales or order baskets
+@app.get("/api/analytics/basket-rules")
+async def basket_rules(source: str = Query("sales", pattern="^(sales|orders)$"),
+                       start: Optional[datetime] = None, end: Optional[datetime] = None,
+                       minSupport: float = Query(0.01, ge=0, le=1), minConfidence: float = Query(0.1, ge=0, le=1),
+                       product: Optional[str] = None, limit: int = Query(50, ge=1, le=1000)):
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="Basket analytics need the Postgres backend")
+    try:
+        return await baskets.rules(source, start, end, minSupport, minConfidence, product, limit)
+    except BasketsUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+# Rolling averages, week-over-week deltas and seasonal forecasts (forecast.py)
+async def from_forecaster(method: str, *args):
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="Forecasts need the Postgres backend")
+    import forecast  # numpy-backed; imported on first use, like snapshot
+    try:
+        return await getattr(forecast.forecaster, method)(*args)
+    except forecast.ForecastUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/analytics/forecast/traffic")
+async def forecast_traffic(supermarketId: Optional[str] = None, horizon: int = Query(7, ge=1, le=28)):
+    return await from_forecaster("traffic", supermarketId, horizon)
+
+@app.get("/api/analytics/forecast/sales")
+async def forecast_sales(supermarketId: Optional[str] = None, category: Optional[str] = None,
+                         metric: str = Query("revenue", pattern="^(revenue|quantity)$"),
+                         horizon: int = Query(7, ge=1, le=28)):
+    return await from_forecaster("sales", supermarketId, category, metric, horizon)
+
+@app.get("/api/analytics/forecast/status")
+async def forecast_status():
+    from forecast import forecaster
+    return forecaster.status()
+
+# Drill-down over the store hierarchy x time, from the pre-aggregated rollup
+# cube (cube.py); `end` is exclusive. Opt-in: its triggers, applier and
+# per-worker refresh only run with CUBE_ENABLED=1
+CUBE_ENABLED = os.environ.get("CUBE_ENABLED") == "1"
+
+@app.get("/api/analytics/cube")
+async def analytics_cube(level: str = Query("region", pattern="^(region|city|store|size|type)$"),
+                         parent: Optional[str] = None,
+                         metric: str = Query("revenue", pattern="^(revenue|quantity|transactions|visitors|avg_basket|conversion)$"),
+                         grain: str = Query("month", pattern="^(day|week|month|total)$"),
+                         start: Optional[datetime] = None, end: Optional[datetime] = None,
+                         limit: int = Query(100, ge=1, le=10000)):
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="The rollup cube needs the Postgres backend")
+    if not CUBE_ENABLED:
+        raise HTTPException(status_code=503, detail="The rollup cube is disabled; set CUBE_ENABLED=1")
+    from cube import cube  # numpy-backed; imported on first use, like snapshot
+    await cube.ensure_loaded()
+    try:
+        return cube.query(level, parent, metric, grain, start.date() if start else None,
+                          end.date() if end else None, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/analytics/cube/status")
+async def analytics_cube_status():
+    if not CUBE_ENABLED:
+        raise HTTPException(status_code=503, detail="The rollup cube is disabled; set CUBE_ENABLED=1")
+    from cube import cube
+    return cube.status()
+
+# Product catalog, served from the in-memory index (catalog.py)
+def catalog_filters(q, category, color, priceBand, inStock, minPrice, maxPrice, minRating) -> dict:
+    return {"q": q, "category": category, "color": [c.lower() for c in color or []], "price_band": priceBand,
+            "in_stock": None if inStock is None else ["true" if inStock else "false"],
+            "min_price": minPrice, "max_price": maxPrice, "min_rating": minRating}
+
+async def catalog_index():
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="The catalog needs the Postgres backend")
+    return await catalog.ensure_loaded()
+
+@app.get("/api/catalog/products")
+async def catalog_products(q: Optional[str] = None, category: Optional[List[str]] = Query(None),
+                           color: Optional[List[str]] = Query(None), priceBand: Optional[List[str]] = Query(None),
+                           inStock: Optional[bool] = None, minPrice: Optional[float] = None,
+                           maxPrice: Optional[float] = None, minRating: Optional[float] = None,
+                           sort: str = Query("relevance", pattern="^(relevance|-?price|-?rating)$"),
+                           limit: int = Query(24, ge=1, le=200), offset: int = Query(0, ge=0)):
+    index = await catalog_index()
+    filters = catalog_filters(q, category, color, priceBand, inStock, minPrice, maxPrice, minRating)
+    return index.search(filters, sort, limit, offset)
+
+@app.get("/api/catalog/facets")
+async def catalog_facets(q: Optional[str] = None, category: Optional[List[str]] = Query(None),
+                         color: Optional[List[str]] = Query(None), priceBand: Optional[List[str]] = Query(None),
+                         inStock: Optional[bool] = None, minPrice: Optional[float] = None,
+                         maxPrice: Optional[float] = None, minRating: Optional[float] = None):
+    index = await catalog_index()
+    return index.facets(catalog_filters(q, category, color, priceBand, inStock, minPrice, maxPrice, minRating))
+
+@app.get("/api/catalog/products/{id}")
+async def catalog_product(id: int):
+    product = (await catalog_index()).get(id)
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return product
+
+# Checkout: the session's cart becomes an order in one transaction. Retries
+# with the same Idempotency-Key return the original order (200, replayed); the
+# same key from another session is rejected (422)
+@app.post("/api/checkout", status_code=201)
+async def create_checkout(payload: CheckoutRequest, response: Response,
+                          idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="Checkout needs the Postgres backend")
+    try:
+        order = await checkout.checkout(payload.sessionId, payload.customerInfo, payload.shippingAddress,
+                                        idempotency_key)
+    except checkout.CheckoutConflict as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "products": e.products})
+    except checkout.IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if order["replayed"]:
+        response.status_code = 200
+    return order
+
+# Low-stock threshold crossings (entered / left), oldest first.
+# Pass the last event's cursor as ?after= to get the next page.
+@app.get("/api/inventory/stock-events")
+async def stock_events(after: Optional[str] = None, since: Optional[datetime] = None,
+                       limit: int = Query(500, ge=1, le=5000)):
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="Stock events need the Postgres backend")
+    try:
+        return await inventory_engine.stock_events(after, naive_utc(since), limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Sensor ingestion: reports are aggregated in memory and flushed periodically
+@app.post("/api/traffic/ingest", status_code=202)
+async def ingest_traffic(payload: List[CustomerTrafficCreate]):
+    accepted = traffic_aggregator.add_many(p.dict() for p in payload)
+    return {"accepted": accepted}
 
 # Custom analytics endpoint (type, filter, groupBy)
 @app.get("/api/analytics/custom")
-async def analytics_custom(type: Optional[str] = None, filter: Optional[str] = None, groupBy: Optional[str] = None):
+async def analytics_custom(type: Optional[str] = None, filter: Optional[str] = None, groupBy: Optional[str] = None,
+                           start: Optional[datetime] = None, end: Optional[datetime] = None,
+                           include_archive: bool = False):
     if type == "sales":
         if groupBy == "category":
-            return await storage.get_sales_by_category()
+            return await storage.get_sales_by_category(start, end, include_archive)
         if groupBy == "payment":
-            return await storage.get_sales_by_payment_method()
+            return await storage.get_sales_by_payment_method(start, end, include_archive)
         if groupBy == "demographics":
-            return await storage.get_sales_by_demographic()
-        return await storage.get_sales()
+            return await storage.get_sales_by_demographic(start, end, include_archive)
+        return await storage.get_sales(start, end, include_archive)
     if type == "traffic":
         if groupBy == "hour":
-            return await storage.get_traffic_by_hour()
+            return await storage.get_traffic_by_hour(start, end, include_archive)
         if groupBy == "supermarket":
-            return await storage.get_traffic_by_supermarket()
+            return await storage.get_traffic_by_supermarket(start, end, include_archive)
         return await storage.get_customer_traffic()
     if type == "inventory":
         if filter == "low-stock":
@@ -257,18 +637,187 @@ async def analytics_custom(type: Optional[str] = None, filter: Optional[str] = N
         return await storage.get_inventory()
     raise HTTPException(status_code=400, detail="Invalid analytics type")
 
+# Live dashboard (SSE): full state on connect, then deltas as tables change
+@app.get("/api/stream/dashboard")
+async def stream_dashboard():
+    if EMBEDDED:
+        raise HTTPException(status_code=503, detail="Live updates need the Postgres backend")
+    if not stream.hub.has_capacity():
+        raise HTTPException(status_code=503, detail="Too many dashboard subscribers")
+    await stream.hub.ensure_started()
+    return StreamingResponse(stream.event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Change feed (NDJSON): one event per line, then {"token": ..., "more": ...}
+# ?consumer=<name> acknowledges `since`, so change_log can be pruned below it
+@app.get("/api/changes")
+async def get_changes(since: Optional[str] = None, tables: Optional[str] = None, limit: int = Query(1000, ge=1, le=10000),
+                      consumer: Optional[str] = Query(None, max_length=100)):
+    table_list = [t.strip() for t in tables.split(",") if t.strip()] if tables else None
+    try:
+        decode_token(since)
+        events = read_changes(since, table_list, page_size=limit, consumer=consumer)
+        first = await events.__anext__()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TokenExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+
+    async def body():
+        yield json.dumps(first, default=str) + "\n"
+        async for event in events:
+            yield json.dumps(event, default=str) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+# Admission control limits, adjustable at runtime:
+# PUT {"analytics": {"limit": 3, "max_queue": 10, "max_wait": 2}}
+@app.get("/api/admin/admission")
+async def get_admission():
+    return admission.snapshot()
+
+@app.put("/api/admin/admission")
+async def update_admission(payload: dict):
+    try:
+        admission.configure(payload)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return admission.snapshot()
+
+@app.get("/api/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+# Health / readiness
+readiness = {"pool": False, "warm": False, "draining": False}
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    import db
+    ready = (readiness["pool"] and readiness["warm"] and not readiness["draining"]
+             and (db.pool is not None or EMBEDDED))
+    body = dict(readiness, pool_size=db.pool.get_size() if db.pool else 0)
+    if not ready:
+        return Response(content=json.dumps(body), status_code=503, media_type="application/json")
+    return body
+
+# Statements on the hot CRM paths; preparing them on every pooled connection
+# keeps the first real requests off the parse/plan path.
+WARM_STATEMENTS = [
+    "SELECT * FROM clients WHERE id = $1",
+    "SELECT * FROM follow_ups WHERE id = $1",
+    "SELECT * FROM tasks WHERE id = $1",
+    "SELECT * FROM follow_ups WHERE client_id = $1 ORDER BY scheduled_date ASC",
+    "SELECT * FROM tasks WHERE client_id = $1 ORDER BY created_at DESC",
+    "SELECT * FROM interactions WHERE client_id = $1 ORDER BY created_at DESC",
+]
+
+async def warm_up():
+    import db
+    conns = [await db.pool.acquire() for _ in range(db.pool.get_size())]
+    try:
+        for conn in conns:
+            for q in WARM_STATEMENTS:
+                # Executing (not just prepare()) populates asyncpg's statement cache
+                await conn.fetch(q, "")
+    finally:
+        for conn in conns:
+            await db.pool.release(conn)
+
 # Run setup/teardown
+background_tasks: List[asyncio.Task] = []
+
 @app.on_event("startup")
 async def startup():
+    if EMBEDDED:
+        # Single-box mode: no Postgres, so none of the pool-backed machinery below
+        await storage.open()
+        readiness["pool"] = readiness["warm"] = True
+        return
     from db import init_db_pool
     await init_db_pool()
+    await shard_router.open()
+    readiness["pool"] = True
+    await install_change_log()
+    await stream.install_all()
+    await inventory_engine.install_all()
+    if CUBE_ENABLED:
+        import cube  # numpy-backed; only workers serving the cube load it
+        await cube.install_all()
+    await install_scheduler()
+    await overview.install_overview_indexes()
+    await install_catalog_notify()
+    await checkout.install_checkout()
+    await ensure_traffic_unique_key()
+    await jobs.install_jobs()
+    await warm_up()
+    if os.environ.get("JOBS_INPROCESS", "1") == "1":
+        job_runner.start()
+    traffic_aggregator.flush_interval = float(os.environ.get("TRAFFIC_FLUSH_SECONDS", "5"))
+    traffic_aggregator.start()
+    if os.environ.get("WRITE_COALESCING") == "1":
+        storage.enable_write_coalescing(
+            max_delay=float(os.environ.get("COALESCE_MAX_DELAY_MS", "5")) / 1000,
+            max_rows=int(os.environ.get("COALESCE_MAX_ROWS", "100")))
+    background_tasks.append(asyncio.create_task(partition_maintenance_loop()))
+    if CHANGE_LOG_PRUNE_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(change_log_prune_loop()))
+    if os.environ.get("SCHEDULER_INPROCESS", "1") == "1":
+        scheduler.start()  # only the elected worker fires reminders
+    if inventory_engine.APPLY_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(inventory_engine.stock_apply_loop()))
+    if inventory_engine.PRUNE_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(inventory_engine.stock_events_prune_loop()))
+    if os.environ.get("TIERING_ENABLED") == "1":
+        from tiering import archival_loop
+        background_tasks.append(asyncio.create_task(archival_loop()))
+    if float(os.environ.get("SNAPSHOT_REFRESH_SECONDS", "0")) > 0:
+        from snapshot import snapshot_refresh_loop
+        background_tasks.append(asyncio.create_task(
+            snapshot_refresh_loop(float(os.environ["SNAPSHOT_REFRESH_SECONDS"]))))
+    if BASKET_REFRESH_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(basket_refresh_loop()))
+    if CUBE_ENABLED:
+        background_tasks.append(asyncio.create_task(cube.cube_apply_loop()))
+        background_tasks.append(asyncio.create_task(cube.cube_refresh_loop()))
+    if float(os.environ.get("FORECAST_REFRESH_SECONDS", "0")) > 0:
+        from forecast import forecast_refresh_loop
+        background_tasks.append(asyncio.create_task(forecast_refresh_loop()))
+    try:
+        await catalog.ensure_loaded()
+    except Exception as e:  # retried on the first catalog request
+        print(f"catalog load failed: {e!r}")
+    readiness["warm"] = True
 
 @app.on_event("shutdown")
 async def shutdown():
+    readiness["draining"] = True
+    if EMBEDDED:
+        await storage.close()
+        readiness["pool"] = False
+        return
+    for task in background_tasks:
+        task.cancel()
+    if storage.coalescer:
+        await storage.coalescer.drain()
+    await traffic_aggregator.stop()
+    await job_runner.stop()
+    await scheduler.stop()
+    await catalog.stop()
+    if "forecast" in sys.modules:  # only imported if forecasts were used
+        sys.modules["forecast"].forecaster.close()
+    await stream.hub.stop()
+    await shard_router.close()
     from db import close_db_pool
     await close_db_pool()
+    readiness["pool"] = False
 
 if __name__ == "__main__":
+    # Development server; use serve.py for production
     uvicorn.run("main:app", host="0.0.0.0", port=5003, reload=True)
 # /app
 #   main.py
@@ -1,8 +1,11 @@
 # models.py
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, ConfigDict
 from typing import Optional, List
 from datetime import datetime
 
+# Read models below aren't used for request validation; build their schemas lazily
+_lazy = ConfigDict(defer_build=True)
+
 # Clients
 class ClientBase(BaseModel):
     name: str
@@ -16,6 +19,7 @@ class ClientCreate(ClientBase):
     pass
 
 class Client(ClientBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
 
@@ -33,6 +37,7 @@ class FollowUpCreate(FollowUpBase):
     pass
 
 class FollowUp(FollowUpBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
 
@@ -50,9 +55,27 @@ class TaskCreate(TaskBase):
     pass
 
 class Task(TaskBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
 
+# Bulk mutations: one transaction per request (see bulk.py)
+class BulkUpdate(BaseModel):
+    id: str
+    changes: dict
+
+class FollowUpBulk(BaseModel):
+    create: List[FollowUpCreate] = []
+    update: List[BulkUpdate] = []
+    complete: List[str] = []
+    delete: List[str] = []
+
+class TaskBulk(BaseModel):
+    create: List[TaskCreate] = []
+    update: List[BulkUpdate] = []
+    complete: List[str] = []
+    delete: List[str] = []
+
 # Interaction
 class InteractionBase(BaseModel):
     clientId: str
@@ -64,6 +87,7 @@ class InteractionCreate(InteractionBase):
     pass
 
 class Interaction(InteractionBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
 
@@ -80,6 +104,7 @@ class SupermarketCreate(SupermarketBase):
     pass
 
 class Supermarket(SupermarketBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
 
@@ -100,6 +125,7 @@ class SalesCreate(SalesBase):
     pass
 
 class Sales(SalesBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
 
@@ -119,6 +145,7 @@ class InventoryCreate(InventoryBase):
     pass
 
 class Inventory(InventoryBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
 
@@ -134,5 +161,12 @@ class CustomerTrafficCreate(CustomerTrafficBase):
     pass
 
 class CustomerTraffic(CustomerTrafficBase):
+    model_config = _lazy
     id: str
     createdAt: Optional[datetime] = None
+
+# Checkout
+class CheckoutRequest(BaseModel):
+    sessionId: str
+    customerInfo: dict
+    shippingAddress: dict
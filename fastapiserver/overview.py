@@ -0,0 +1,72 @@
+# overview.py
+# Client 360: the client row, its most recent follow-ups, tasks and
+# interactions, open counts and last-activity times in one round trip.
+#
+# Every section is ordered newest first by (created_at, id) and paged with a
+# keyset cursor on that pair, so a page is a range scan on the
+# (client_id, created_at, id) indexes below however deep the client scrolls.
+# created_at is nullable, so ordering, keyset and indexes all go through
+# SORT_KEY, which puts undated rows last as NO_DATE; the cursor of an undated
+# row carries NO_DATE too, and row-value comparisons never see a NULL.
+# The overview query asks each section for one row more than the page size to
+# know whether a next cursor exists.
+import base64
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+SECTIONS = ("follow_ups", "tasks", "interactions")
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+_INSTALL_LOCK = 728_010
+
+# asyncpg reads and writes '-infinity' as datetime.min, and the SQLite adapter
+# stores datetime.min as the literal below, so the sentinel round-trips
+# through a cursor on both backends
+NO_DATE = datetime.min
+SORT_KEY = "COALESCE(created_at, '-infinity'::timestamp)"
+SQLITE_SORT_KEY = "COALESCE(created_at, '0001-01-01 00:00:00.000000')"
+
+OVERVIEW_DDL = "\n".join(
+    f"DROP INDEX IF EXISTS {t}_client_recent;\n"
+    f"CREATE INDEX IF NOT EXISTS {t}_client_recent_key ON {t} (client_id, ({SORT_KEY}), id);" for t in SECTIONS)
+
+
+async def install_overview_indexes():
+    from db import get_conn  # keeps this module importable by the embedded backend
+    async with get_conn() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+            await conn.execute(OVERVIEW_DDL)
+
+
+# --- Cursors ---
+def encode_cursor(row: Dict) -> str:
+    raw = f"{(row['created_at'] or NO_DATE).isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, str]]:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        at, id = raw.split("|", 1)
+        return datetime.fromisoformat(at), id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def page(rows: List[Dict], limit: int) -> Dict:
+    """Trim a limit + 1 fetch to a page and its next cursor."""
+    items = rows[:limit]
+    return {"items": items, "next_cursor": encode_cursor(items[-1]) if len(rows) > limit else None}
+
+
+def parse_timestamps(row: Dict) -> Dict:
+    # json_agg renders timestamps as ISO strings; give sections the same
+    # datetime values the per-table endpoints return
+    for k, v in row.items():
+        if isinstance(v, str) and (k.endswith("_at") or k.endswith("_date")):
+            row[k] = datetime.fromisoformat(v)
+    return row
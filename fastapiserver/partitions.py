@@ -0,0 +1,376 @@
+# partitions.py
+# Monthly range partitioning of the time-series tables (sales, customer_traffic).
+#
+# Both tables are partitioned on `date` with one partition per calendar month,
+# named <table>_pYYYY_MM. Queries that filter on `date` with plain range
+# predicates (see storage.date_range_clause) let Postgres prune to the months
+# they touch. The maintenance loop keeps a few months of partitions ahead of
+# time and, if a retention horizon is configured, moves the oldest months to
+# the cold tier (tiering.py, read back by include_archive) and drops them.
+# Maintenance runs on every shard (shards.py), or on the home database when
+# unsharded.
+#
+# Migration of an existing heap table is online. Readers and writers keep
+# using the old table until a final rename, and nothing is scanned under lock:
+#   1. a partitioned <table>_new is created with a partition per month present
+#      (plus a DEFAULT for stray dates) and a copy of every index of the old
+#      table, and a row trigger on the old table mirrors every
+#      insert/update/delete into it from then on;
+#   2. existing rows are copied in MIGRATE_BATCH-row keyset batches, one short
+#      transaction each. The batch holds FOR SHARE locks on the rows it copies,
+#      so a concurrent update waits for the copy and then mirrors over it;
+#   3. one short transaction (lock_timeout bounded) drops the mirror, renames
+#      the tables and their indexes and moves the change-log, dashboard, stock
+#      and cube triggers over; the old table is dropped afterwards.
+#
+# Rows dated beyond the last partition land in <table>_default. When their
+# month's partition is created later, they are moved into it first.
+import argparse
+import asyncio
+import os
+from datetime import date, datetime
+from typing import List, Optional
+from shards import router
+from traffic_ingest import UNIQUE_INDEX as TRAFFIC_KEY
+from inventory_engine import STOCK_TRIGGER_DDL
+
+PARTITIONED_TABLES = ("sales", "customer_traffic")
+
+MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", "3"))
+# Months of history to keep attached; unset keeps everything
+RETENTION_MONTHS = os.environ.get("PARTITION_RETENTION_MONTHS")
+
+_LOCK_TIMEOUT = "5s"
+# Serialises partition create/detach across workers (every worker runs the loop)
+_MAINTAIN_LOCK = 728_017
+MIGRATE_BATCH = int(os.environ.get("PARTITION_MIGRATE_BATCH", "10000"))
+
+
+def _check_table(table: str):
+    if table not in PARTITIONED_TABLES:
+        raise ValueError(f"{table} is not a partitioned table")
+
+
+def month_start(d) -> date:
+    return date(d.year, d.month, 1)
+
+
+def add_months(d: date, n: int) -> date:
+    m = d.month - 1 + n
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+async def is_partitioned(conn, table: str) -> bool:
+    return await conn.fetchval("""
+        SELECT EXISTS (
+          SELECT 1 FROM pg_partitioned_table pt
+          JOIN pg_class c ON c.oid = pt.partrelid
+          WHERE c.relname = $1 AND c.relnamespace = 'public'::regnamespace
+        )
+    """, table)
+
+
+async def list_partitions(conn, table: str) -> List[str]:
+    rows = await conn.fetch("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = $1
+        ORDER BY c.relname
+    """, table)
+    return [r["relname"] for r in rows]
+
+
+async def create_partition(conn, table: str, month: date) -> bool:
+    """Create the partition for `month` if missing. Returns True if created.
+
+    Runs inside the caller's transaction. Rows of that month already in the
+    DEFAULT partition would make a plain CREATE fail, so they are moved into
+    the new partition, which is then attached.
+    """
+    _check_table(table)
+    name = partition_name(table, month)
+    exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name)
+    if exists:
+        return False
+    lo, hi = month, add_months(month, 1)
+    bounds = f"FOR VALUES FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}')"
+    default = f"{table}_default"
+    stray = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", default) and await conn.fetchval(
+        f"SELECT EXISTS (SELECT 1 FROM {default} WHERE date >= $1 AND date < $2)", lo, hi)
+    if not stray:
+        await conn.execute(f"CREATE TABLE {name} PARTITION OF {table} {bounds}")
+        return True
+    await conn.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    # A move, not a change: keep it out of the change feed and the cube
+    await conn.execute("SET LOCAL cube.skip = 'on'; SET LOCAL change_log.skip = 'on'")
+    moved = await conn.execute(f"""
+        WITH moved AS (DELETE FROM {default} WHERE date >= $1 AND date < $2 RETURNING *)
+        INSERT INTO {name} SELECT * FROM moved
+    """, lo, hi)
+    await conn.execute("SET LOCAL cube.skip = 'off'; SET LOCAL change_log.skip = 'off'")
+    await conn.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} {bounds}")
+    print(f"{name}: moved {moved.split()[-1]} rows out of {default}")
+    return True
+
+
+async def ensure_future_partitions(table: str, months_ahead: int = MONTHS_AHEAD) -> List[str]:
+    async def ensure(conn) -> List[str]:
+        created = []
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MAINTAIN_LOCK)
+            if not await is_partitioned(conn, table):
+                return created
+            this_month = month_start(datetime.utcnow())
+            for i in range(months_ahead + 1):
+                month = add_months(this_month, i)
+                if await create_partition(conn, table, month):
+                    created.append(partition_name(table, month))
+        return created
+
+    return [name for created in await router.fan_out(ensure) for name in created]
+
+
+async def archive_old_partitions(table: str, keep_months: int, archive: bool = True) -> List[str]:
+    """Move partitions older than `keep_months` to the cold tier (tiering.py), then drop them."""
+    _check_table(table)
+    cutoff = add_months(month_start(datetime.utcnow()), -keep_months)
+    if archive:
+        import tiering
+        await tiering.run_archival(keep_months, (table,))
+
+    async def drop(conn) -> List[str]:
+        dropped = []
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MAINTAIN_LOCK)
+            if not await is_partitioned(conn, table):
+                return dropped
+            prefix = f"{table}_p"
+            for name in await list_partitions(conn, table):
+                if not name.startswith(prefix):
+                    continue
+                year, month = name[len(prefix):].split("_")
+                if date(int(year), int(month), 1) >= cutoff:
+                    continue
+                # Left alone while rows remain, e.g. another worker was archiving
+                if archive and await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {name})"):
+                    continue
+                await conn.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                await conn.execute(f"DROP TABLE {name}")
+                dropped.append(name)
+        return dropped
+
+    return [name for dropped in await router.fan_out(drop) for name in dropped]
+
+
+async def maintain_partitions():
+    for table in PARTITIONED_TABLES:
+        await ensure_future_partitions(table)
+        if RETENTION_MONTHS:
+            await archive_old_partitions(table, int(RETENTION_MONTHS))
+
+
+async def partition_maintenance_loop(interval: float = 6 * 3600):
+    while True:
+        try:
+            await maintain_partitions()
+        except Exception as e:  # keep the loop alive; retried next interval
+            print(f"partition maintenance failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+# --- Online migration ---
+def _mirror_ddl(table: str, shadow: str) -> str:
+    # Both tables have the same columns in the same order (LIKE), so NEW.* fits
+    return f"""
+    CREATE OR REPLACE FUNCTION {table}_mirror() RETURNS trigger AS $$
+    BEGIN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {shadow} WHERE id = OLD.id AND date = OLD.date;
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {shadow} SELECT NEW.* ON CONFLICT DO NOTHING;
+      END IF;
+      RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS {table}_mirror ON {table};
+    CREATE TRIGGER {table}_mirror AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE {table}_mirror();
+    """
+
+
+async def _index_names(conn, table: str) -> List[str]:
+    return [r["relname"] for r in await conn.fetch("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = to_regclass($1)
+    """, table)]
+
+
+async def _copy_indexes(conn, table: str, shadow: str):
+    """Recreate `table`'s indexes on `shadow` as <name>_new (renamed back at the swap)."""
+    rows = await conn.fetch("""
+        SELECT c.relname AS name, i.indisprimary AS is_primary, i.indisunique AS is_unique,
+               pg_get_indexdef(i.indexrelid) AS definition,
+               EXISTS (SELECT 1 FROM pg_attribute a WHERE a.attrelid = i.indrelid
+                       AND a.attname = 'date' AND a.attnum = ANY(i.indkey)) AS has_date
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = to_regclass($1)
+    """, table)
+    for r in rows:
+        if r["is_primary"] or r["name"] == TRAFFIC_KEY:
+            continue  # replaced by (id, date) and created above
+        if r["is_unique"] and not r["has_date"]:
+            # A unique index on a partitioned table must include the partition key
+            print(f"{table}: unique index {r['name']} does not include date and is not carried over")
+            continue
+        using = r["definition"].split(" USING ", 1)[1]
+        unique = "UNIQUE " if r["is_unique"] else ""
+        await conn.execute(f"CREATE {unique}INDEX {r['name']}_new ON {shadow} USING {using}")
+
+
+async def _has_trigger(conn, name: str, table: str) -> bool:
+    return await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = $1 AND tgrelid = to_regclass($2))", name, table)
+
+
+async def migrate_to_partitioned(table: str, lock_timeout: str = _LOCK_TIMEOUT, batch_size: int = MIGRATE_BATCH,
+                                 shard: Optional[str] = None):
+    """Convert an existing heap `table` on `shard` (home if None) into a monthly-partitioned table online."""
+    from cube import cube_trigger_ddl, drop_cube_triggers_ddl  # numpy; only needed for the swap
+    _check_table(table)
+    shadow, legacy = f"{table}_new", f"{table}_legacy"
+    async with router.conn(shard) as conn:
+        if await is_partitioned(conn, table):
+            if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", legacy):
+                await conn.execute(f"DROP TABLE {legacy}")
+            await ensure_future_partitions(table)
+            return
+
+        # 1. Shadow table and mirror (rerunnable: a half-done copy is resumed)
+        if await conn.fetchval("SELECT to_regclass($1) IS NULL", shadow):
+            months = [r["m"] for r in await conn.fetch(
+                f"SELECT DISTINCT date_trunc('month', date)::date AS m FROM {table} ORDER BY m")]
+            this_month = month_start(datetime.utcnow())
+            months = sorted(set(months) | {add_months(this_month, i) for i in range(MONTHS_AHEAD + 1)})
+            async with conn.transaction():
+                # Indexes are copied below: the old primary key on id alone is not
+                # allowed on a table partitioned by date
+                await conn.execute(
+                    f"CREATE TABLE {shadow} (LIKE {table} INCLUDING ALL EXCLUDING INDEXES) PARTITION BY RANGE (date)")
+                # the old table keeps the {table}_pkey name, so name this one explicitly
+                await conn.execute(f"ALTER TABLE {shadow} ADD CONSTRAINT {table}_pk PRIMARY KEY (id, date)")
+                # supermarkets lives on the home database only
+                if await conn.fetchval("SELECT to_regclass('supermarkets') IS NOT NULL"):
+                    await conn.execute(f"""
+                        ALTER TABLE {shadow} ADD CONSTRAINT fk_{table}_supermarket
+                        FOREIGN KEY (supermarket_id) REFERENCES supermarkets(id)
+                    """)
+                if table == "customer_traffic":
+                    # The (store, day, hour) upsert key used by traffic ingestion; renamed at the swap
+                    await conn.execute(
+                        f"CREATE UNIQUE INDEX {TRAFFIC_KEY}_new ON {shadow} (supermarket_id, date, hour)")
+                await _copy_indexes(conn, table, shadow)
+                for month in months:
+                    await conn.execute(f"""
+                        CREATE TABLE {partition_name(table, month)} PARTITION OF {shadow}
+                        FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')
+                    """)
+                await conn.execute(f"CREATE TABLE {table}_default PARTITION OF {shadow} DEFAULT")
+                await conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+                await conn.execute(_mirror_ddl(table, shadow))
+
+        # 2. Copy in bounded batches; ON CONFLICT skips rows the mirror already wrote
+        last, copied = "", 0
+        while True:
+            async with conn.transaction():
+                rows = await conn.fetch(f"""
+                    WITH batch AS (
+                      SELECT * FROM {table} WHERE id > $1 ORDER BY id LIMIT $2 FOR SHARE
+                    ), copied AS (
+                      INSERT INTO {shadow} SELECT * FROM batch ON CONFLICT DO NOTHING
+                    )
+                    SELECT id FROM batch ORDER BY id DESC LIMIT 1
+                """, last, batch_size)
+            if not rows:
+                break
+            last = rows[0]["id"]
+            copied += batch_size
+            print(f"{table}: ~{copied} rows copied")
+
+        # 3. Swap
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            await conn.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+            await conn.execute(f"DROP TRIGGER {table}_mirror ON {table}")
+            await conn.execute(f"DROP FUNCTION {table}_mirror()")
+            cube_installed = await _has_trigger(conn, f"{table}_cube_insert", table)
+            notify_installed = await _has_trigger(conn, f"{table}_notify_dashboard", table)
+            stock_installed = await _has_trigger(conn, "sales_stock_pending", table)
+            await conn.execute(f"DROP TRIGGER IF EXISTS {table}_change_log ON {table}")
+            await conn.execute(f"DROP TRIGGER IF EXISTS {table}_notify_dashboard ON {table}")
+            await conn.execute(f"DROP TRIGGER IF EXISTS sales_stock_pending ON {table}")
+            await conn.execute(drop_cube_triggers_ddl(table))
+            await conn.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+            await conn.execute(f"ALTER TABLE {shadow} RENAME TO {table}")
+            # The copies take over the old indexes' names
+            for name in await _index_names(conn, table):
+                if name.endswith("_new"):
+                    await conn.execute(f"ALTER INDEX IF EXISTS {name[:-4]} RENAME TO {name[:-4]}_legacy")
+                    await conn.execute(f"ALTER INDEX {name} RENAME TO {name[:-4]}")
+            # Cloned onto every partition; the argument keeps the logical table name in change_log
+            await conn.execute(f"""
+                CREATE TRIGGER {table}_change_log
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE log_row_change('{table}')
+            """)
+            if notify_installed:
+                await conn.execute(f"""
+                    CREATE TRIGGER {table}_notify_dashboard
+                    AFTER INSERT OR UPDATE OR DELETE ON {table}
+                    FOR EACH STATEMENT EXECUTE PROCEDURE notify_dashboard()
+                """)
+            if stock_installed:
+                await conn.execute(STOCK_TRIGGER_DDL)
+            if cube_installed:
+                # The copied rows are already in cube_cells; only new writes count from here
+                await conn.execute(cube_trigger_ddl(table))
+        await conn.execute(f"DROP TABLE {legacy}")
+
+    await ensure_future_partitions(table)
+
+
+if __name__ == "__main__":
+    from db import init_db_pool, close_db_pool
+
+    parser = argparse.ArgumentParser(description="Partition maintenance for sales/customer_traffic, on every shard")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    m = sub.add_parser("migrate")
+    m.add_argument("table", choices=PARTITIONED_TABLES)
+    sub.add_parser("maintain")
+    a = sub.add_parser("archive")
+    a.add_argument("table", choices=PARTITIONED_TABLES)
+    a.add_argument("--keep-months", type=int, required=True)
+    a.add_argument("--no-archive", action="store_true", help="drop old partitions without archiving them")
+    args = parser.parse_args()
+
+    async def run():
+        await init_db_pool()
+        try:
+            if args.cmd == "migrate":
+                for shard in router.names or [None]:
+                    await migrate_to_partitioned(args.table, shard=shard)
+            elif args.cmd == "maintain":
+                await maintain_partitions()
+            else:
+                print(await archive_old_partitions(args.table, args.keep_months, not args.no_archive))
+        finally:
+            await router.close()
+            await close_db_pool()
+
+    asyncio.run(run())
@@ -0,0 +1,356 @@
+# scheduler.py
+# Due-date reminders for follow-ups and tasks.
+#
+# One worker at a time is the scheduler: it holds a session advisory lock on
+# a dedicated connection, and the other workers retry every ELECTION_SECONDS,
+# so a crashed leader is replaced as soon as its connection drops. The leader
+# keeps a timer heap of the not-completed items due within HORIZON_HOURS
+# (loaded through the partial indexes below, then reloaded as the horizon
+# moves) and fires two events per item: "due" at its due time and "overdue"
+# OVERDUE_AFTER_MINUTES later if it is still open.
+#
+# Row triggers NOTIFY "agenda" on every insert, delete and change of
+# due date / completion, from any worker or script, and the leader updates
+# the heap from those notifications instead of reloading. Each event is
+# recorded in reminder_log before it is sent, so a failover or restart does
+# not repeat reminders that already went out. The leader prunes the log on
+# every reload: an entry goes once it is REMINDER_LOG_MAX_AGE_DAYS old and its
+# item is completed, deleted or rescheduled. Entries of items still open at the
+# same due time stay, since reload() relies on them to skip reminders sent.
+#
+# Events go to every registered sink. REMINDER_SINKS picks the built-in ones:
+# "log" prints, "sse" publishes to the dashboard stream (stream.py) and
+# "webhook" POSTs JSON to REMINDER_WEBHOOK_URL.
+import asyncio
+import heapq
+import json
+import os
+import urllib.request
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Protocol, Tuple
+import asyncpg
+from db import DATABASE_URL, get_conn
+from metrics import metrics
+
+HORIZON = timedelta(hours=float(os.environ.get("SCHEDULER_HORIZON_HOURS", "24")))
+OVERDUE_AFTER = timedelta(minutes=float(os.environ.get("OVERDUE_AFTER_MINUTES", "60")))
+ELECTION_SECONDS = float(os.environ.get("SCHEDULER_ELECTION_SECONDS", "10"))
+LOG_MAX_AGE_DAYS = int(os.environ.get("REMINDER_LOG_MAX_AGE_DAYS", "30"))
+LOG_PRUNE_BATCH = int(os.environ.get("REMINDER_LOG_PRUNE_BATCH", "10000"))
+
+REMINDER_CHANNEL = "reminders"
+AGENDA_CHANNEL = "agenda"
+
+_INSTALL_LOCK = 728_008
+_LEADER_LOCK = 728_009
+
+# table -> (kind, due column)
+KINDS = {"follow_ups": ("follow_up", "scheduled_date"), "tasks": ("task", "due_date")}
+TABLES = {kind: (table, column) for table, (kind, column) in KINDS.items()}
+
+SCHEDULER_DDL = """
+CREATE INDEX IF NOT EXISTS follow_ups_scheduled_date ON follow_ups (scheduled_date);
+CREATE INDEX IF NOT EXISTS tasks_due_date ON tasks (due_date);
+CREATE INDEX IF NOT EXISTS follow_ups_open_due ON follow_ups (scheduled_date) WHERE completed IS NOT TRUE;
+CREATE INDEX IF NOT EXISTS tasks_open_due ON tasks (due_date) WHERE completed IS NOT TRUE;
+
+CREATE TABLE IF NOT EXISTS reminder_log (
+  kind TEXT NOT NULL,
+  item_id VARCHAR NOT NULL,
+  event TEXT NOT NULL,
+  due_at TIMESTAMP NOT NULL,
+  fired_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (kind, item_id, event, due_at)
+);
+CREATE INDEX IF NOT EXISTS reminder_log_fired_at ON reminder_log (fired_at);
+
+CREATE OR REPLACE FUNCTION agenda_changed() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    PERFORM pg_notify('agenda', json_build_object('table', TG_TABLE_NAME, 'id', OLD.id, 'deleted', TRUE)::text);
+    RETURN NULL;
+  END IF;
+  PERFORM pg_notify('agenda', json_build_object(
+    'table', TG_TABLE_NAME, 'id', NEW.id, 'completed', COALESCE(NEW.completed, FALSE),
+    'due', to_jsonb(NEW) -> TG_ARGV[0])::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+async def install_scheduler():
+    async with get_conn() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+            await conn.execute(SCHEDULER_DDL)
+            for table, (_, column) in KINDS.items():
+                await conn.execute(f"DROP TRIGGER IF EXISTS {table}_agenda ON {table}")
+                await conn.execute(f"""
+                    CREATE TRIGGER {table}_agenda
+                    AFTER INSERT OR DELETE OR UPDATE OF {column}, completed ON {table}
+                    FOR EACH ROW EXECUTE PROCEDURE agenda_changed('{column}')
+                """)
+
+
+# An entry still matters while its item is open at the same due time
+_STALE_REMINDERS = " AND ".join(f"""NOT EXISTS (SELECT 1 FROM {table} t
+                  WHERE l.kind = '{kind}' AND t.id = l.item_id
+                    AND t.completed IS NOT TRUE AND t.{column} = l.due_at)"""
+                                for table, (kind, column) in KINDS.items())
+
+
+async def prune_reminder_log(batch_size: int = LOG_PRUNE_BATCH) -> int:
+    """Drop old reminder_log entries no open item needs; returns how many."""
+    # In bounded batches, one short transaction each; only the leader calls it
+    deleted = 0
+    async with get_conn() as conn:
+        while True:
+            n = await conn.fetchval(f"""
+                WITH gone AS (
+                  DELETE FROM reminder_log WHERE (kind, item_id, event, due_at) IN (
+                    SELECT kind, item_id, event, due_at FROM reminder_log l
+                    WHERE fired_at < NOW() - make_interval(days => $1) AND {_STALE_REMINDERS}
+                    LIMIT $2
+                  ) RETURNING 1
+                )
+                SELECT COUNT(*) FROM gone
+            """, LOG_MAX_AGE_DAYS, batch_size)
+            deleted += n
+            if n < batch_size:
+                return deleted
+
+
+# --- Sinks ---
+class Sink(Protocol):
+    async def send(self, event: Dict): ...
+
+
+class LogSink:
+    async def send(self, event: Dict):
+        print(f"reminder: {event['event']} {event['kind']} {event['id']} "
+              f"{event['title']!r} due {event['due_at']}")
+
+
+class StreamSink:
+    """Publishes to the dashboard SSE stream of every worker via NOTIFY."""
+
+    async def send(self, event: Dict):
+        async with get_conn() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", REMINDER_CHANNEL, json.dumps(event, default=str))
+
+
+class WebhookSink:
+    def __init__(self, url: str, timeout: float = 5.0):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, body: bytes):
+        req = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            resp.read()
+
+    async def send(self, event: Dict):
+        await asyncio.to_thread(self._post, json.dumps(event, default=str).encode())
+
+
+def sinks_from_env() -> List[Sink]:
+    sinks: List[Sink] = []
+    for name in os.environ.get("REMINDER_SINKS", "log,sse").split(","):
+        name = name.strip()
+        if name == "log":
+            sinks.append(LogSink())
+        elif name == "sse":
+            sinks.append(StreamSink())
+        elif name == "webhook" and os.environ.get("REMINDER_WEBHOOK_URL"):
+            sinks.append(WebhookSink(os.environ["REMINDER_WEBHOOK_URL"]))
+    return sinks
+
+
+# --- Scheduler ---
+Key = Tuple[str, str]  # (kind, id)
+
+
+class Scheduler:
+    def __init__(self, sinks: Optional[List[Sink]] = None):
+        self.sinks: List[Sink] = sinks if sinks is not None else sinks_from_env()
+        self.is_leader = False
+        # Heap of (fire_at, kind, id, event, due_at); `due` is the source of
+        # truth, so entries whose due_at no longer matches are skipped
+        self._heap: List[Tuple[datetime, str, str, str, datetime]] = []
+        self._due: Dict[Key, datetime] = {}
+        self._horizon_end: Optional[datetime] = None
+        self._changes_during_reload: Optional[List[Tuple]] = None
+        self._wakeup = asyncio.Event()
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def add_sink(self, sink: Sink):
+        self.sinks.append(sink)
+
+    # --- Heap maintenance ---
+    def _schedule(self, kind: str, id: str, due_at: datetime):
+        self._due[(kind, id)] = due_at
+        overdue_at = due_at + OVERDUE_AFTER
+        if overdue_at > datetime.utcnow():  # long past items only get the overdue event
+            heapq.heappush(self._heap, (due_at, kind, id, "due", due_at))
+        heapq.heappush(self._heap, (overdue_at, kind, id, "overdue", due_at))
+        self._wakeup.set()
+
+    def _unschedule(self, kind: str, id: str):
+        self._due.pop((kind, id), None)  # heap entries are dropped lazily
+
+    def on_change(self, table: str, id: str, due: Optional[datetime], completed: bool = False,
+                  deleted: bool = False):
+        """Apply one row change to the heap (called for every agenda NOTIFY)."""
+        if self._changes_during_reload is not None:
+            self._changes_during_reload.append((table, id, due, completed, deleted))
+            return
+        kind = KINDS[table][0]
+        if deleted or completed or due is None:
+            self._unschedule(kind, id)
+        elif self._horizon_end is not None and due < self._horizon_end:
+            if self._due.get((kind, id)) != due:
+                self._schedule(kind, id, due)
+        else:
+            self._unschedule(kind, id)  # moved beyond the horizon; the next reload picks it up
+        metrics.set_gauge("scheduler.items", len(self._due))
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            msg = json.loads(payload)
+            due = datetime.fromisoformat(msg["due"]) if msg.get("due") else None
+            self.on_change(msg["table"], msg["id"], due, msg.get("completed", False), msg.get("deleted", False))
+        except Exception as e:
+            print(f"bad agenda notification {payload!r}: {e!r}")
+
+    async def reload(self):
+        """Load every open item due before now + HORIZON (overdue ones included)."""
+        horizon_end = datetime.utcnow() + HORIZON
+        due: Dict[Key, datetime] = {}
+        # Changes notified while the queries run may or may not be in their
+        # results, so they are held back and replayed on top
+        self._changes_during_reload = []
+        try:
+            async with get_conn() as conn:
+                for table, (kind, column) in KINDS.items():
+                    rows = await conn.fetch(f"""
+                        SELECT t.id, t.{column} AS due FROM {table} t
+                        WHERE t.completed IS NOT TRUE AND t.{column} < $1
+                          AND NOT EXISTS (SELECT 1 FROM reminder_log l
+                                          WHERE l.kind = $2 AND l.item_id = t.id
+                                            AND l.event = 'overdue' AND l.due_at = t.{column})
+                    """, horizon_end, kind)
+                    for r in rows:
+                        due[(kind, r["id"])] = r["due"]
+        finally:
+            changes, self._changes_during_reload = self._changes_during_reload, None
+        self._heap, self._due = [], {}
+        for (kind, id), at in due.items():
+            self._schedule(kind, id, at)
+        self._horizon_end = horizon_end
+        for change in changes:
+            self.on_change(*change)
+        metrics.set_gauge("scheduler.items", len(self._due))
+
+    async def _fire(self, kind: str, id: str, event: str, due_at: datetime):
+        table, column = TABLES[kind]
+        async with get_conn() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    f"SELECT * FROM {table} WHERE id = $1 AND completed IS NOT TRUE AND {column} = $2", id, due_at)
+                if row is None:
+                    return
+                # Already sent before a restart or failover
+                if not await conn.fetchval("""
+                    INSERT INTO reminder_log (kind, item_id, event, due_at) VALUES ($1, $2, $3, $4)
+                    ON CONFLICT DO NOTHING RETURNING TRUE
+                """, kind, id, event, due_at):
+                    return
+        payload = {"event": event, "kind": kind, "id": id, "due_at": due_at,
+                   "title": row["title"], "client_id": row["client_id"]}
+        for sink in self.sinks:
+            try:
+                await sink.send(payload)
+            except Exception as e:
+                metrics.incr("scheduler.sink_failures")
+                print(f"reminder sink {type(sink).__name__} failed: {e!r}")
+        metrics.incr(f"scheduler.{event}_fired")
+
+    async def _run_timers(self):
+        while True:
+            now = datetime.utcnow()
+            if self._horizon_end is None or now >= self._horizon_end - HORIZON / 2:
+                try:
+                    metrics.incr("scheduler.log_pruned", await prune_reminder_log())
+                except Exception as e:  # retried at the next reload
+                    print(f"reminder_log prune failed: {e!r}")
+                await self.reload()
+            while self._heap and self._heap[0][0] <= now:
+                _, kind, id, event, due_at = heapq.heappop(self._heap)
+                if self._due.get((kind, id)) != due_at:
+                    continue  # completed, deleted or rescheduled since it was queued
+                if event == "overdue":
+                    self._due.pop((kind, id), None)
+                await self._fire(kind, id, event, due_at)
+            next_at = self._horizon_end - HORIZON / 2
+            if self._heap:
+                next_at = min(next_at, self._heap[0][0])
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       max(0.0, (next_at - datetime.utcnow()).total_seconds()))
+            except asyncio.TimeoutError:
+                pass
+
+    # --- Leader election ---
+    async def _lead(self):
+        self._conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            if not await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", _LEADER_LOCK):
+                return
+            self.is_leader = True
+            metrics.set_gauge("scheduler.leader", 1)
+            await self._conn.add_listener(AGENDA_CHANNEL, self._on_notify)
+            self._horizon_end = None  # force a full load now that we may have missed changes
+            timers = asyncio.create_task(self._run_timers())
+            try:
+                # Stay leader while the lock connection is alive
+                while not timers.done():
+                    await asyncio.sleep(ELECTION_SECONDS)
+                    await self._conn.execute("SELECT 1")
+                await timers  # surface its exception
+            finally:
+                timers.cancel()
+        finally:
+            self.is_leader = False
+            metrics.set_gauge("scheduler.leader", 0)
+            try:
+                await self._conn.close()  # releases the lock
+            except Exception:
+                pass
+            self._conn = None
+
+    async def run(self):
+        while True:
+            try:
+                await self._lead()
+            except Exception as e:  # lost the connection: step down and re-elect
+                print(f"scheduler stepped down: {e!r}")
+            await asyncio.sleep(ELECTION_SECONDS)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+scheduler = Scheduler()
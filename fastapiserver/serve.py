@@ -0,0 +1,193 @@
+# serve.py
+# Production launcher: N uvicorn worker processes sharing one listening socket.
+#
+#   python serve.py --workers 4 --db-budget 40
+#
+# The global Postgres connection budget is split evenly across workers, less
+# the connections each worker opens outside its pools (with SHARD_MAP, half of
+# the rest goes to the shard pools, see shards.py), and each worker opens
+# its whole pool and warms it (see main.warm_up) before it reports ready. A
+# worker that dies is respawned, with backoff while replacements fail. SIGHUP triggers a rolling restart: one worker at a time, a
+# replacement is started and must become ready before the old one is sent
+# SIGTERM and allowed to finish its in-flight requests. SIGTERM/SIGINT stop
+# all workers gracefully.
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+# spawn, so every worker (including rolling-restart replacements) imports fresh code
+mp = multiprocessing.get_context("spawn")
+
+
+def _worker(sock: socket.socket, pool_size: int, ready, log_level: str):
+    # Must be set before db.py is imported by main
+    os.environ["DB_POOL_MAX_SIZE"] = str(pool_size)
+    os.environ["DB_POOL_MIN_SIZE"] = str(pool_size)
+    import asyncio
+    import uvicorn
+
+    config = uvicorn.Config("main:app", log_level=log_level, lifespan="on", access_log=False)
+    server = uvicorn.Server(config)
+
+    async def run():
+        async def report_ready():
+            while not server.started:
+                if server.should_exit:
+                    return
+                await asyncio.sleep(0.05)
+            ready.set()
+
+        watcher = asyncio.create_task(report_ready())
+        try:
+            await server.serve(sockets=[sock])
+        finally:
+            watcher.cancel()
+
+    asyncio.run(run())
+
+
+RESPAWN_MAX_DELAY = 60.0
+
+
+def shard_count() -> int:
+    from shards import load_shard_map
+    shard_map = load_shard_map(os.environ.get("SHARD_MAP"))
+    return len(shard_map["shards"]) if shard_map else 0
+
+
+def dedicated_connections() -> int:
+    """Connections a worker holds outside its pools (see main.startup)."""
+    n = 2  # dashboard stream listener (stream.py), catalog listener (catalog.py)
+    n += shard_count()  # a stream listener per shard
+    if os.environ.get("SCHEDULER_INPROCESS", "1") == "1":
+        n += 1  # reminder leader election (scheduler.py)
+    if float(os.environ.get("SNAPSHOT_REFRESH_SECONDS", "0")) > 0:
+        n += 1  # build lock (snapshot.py)
+    if float(os.environ.get("FORECAST_REFRESH_SECONDS", "0")) > 0:
+        n += 1  # refit lock (forecast.py)
+    return n
+
+
+class Supervisor:
+    def __init__(self, host: str, port: int, workers: int, db_budget: int,
+                 log_level: str = "info", ready_timeout: float = 60.0):
+        self.workers = workers
+        self.dedicated = dedicated_connections()
+        pooled = db_budget // workers - self.dedicated
+        shards = shard_count()
+        shard_pool_max = int(os.environ.get("SHARD_POOL_MAX_SIZE", "0"))
+        if shards and shard_pool_max > 0:
+            self.pool_size = max(1, pooled - shards * shard_pool_max)
+            self.shard_pools = shards * shard_pool_max
+        elif shards:
+            # The shard pools split another pool_size between them (shards.py)
+            self.pool_size = max(1, pooled // 2)
+            self.shard_pools = shards * max(1, self.pool_size // shards)
+        else:
+            self.pool_size = max(1, pooled)
+            self.shard_pools = 0
+        per_worker = self.pool_size + self.shard_pools + self.dedicated
+        if per_worker * workers > db_budget:
+            print(f"warning: {workers} workers need at least {per_worker * workers} "
+                  f"connections, over the budget of {db_budget}")
+        self.log_level = log_level
+        self.ready_timeout = ready_timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(2048)
+        self.sock.set_inheritable(True)
+        self.procs = []
+        self._respawn_at = {}  # worker index -> (delay, monotonic time of next attempt)
+        self._restart = False
+        self._stop = False
+
+    def _spawn(self):
+        ready = mp.Event()
+        proc = mp.Process(target=_worker, args=(self.sock, self.pool_size, ready, self.log_level))
+        proc.start()
+        return proc, ready
+
+    def _spawn_ready(self):
+        proc, ready = self._spawn()
+        if not ready.wait(self.ready_timeout):
+            proc.terminate()
+            proc.join()
+            raise RuntimeError(f"worker {proc.pid} did not become ready in {self.ready_timeout}s")
+        return proc
+
+    def _stop_proc(self, proc, timeout: float = 30.0):
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGTERM)  # uvicorn drains in-flight requests
+            proc.join(timeout)
+        if proc.is_alive():
+            proc.kill()
+            proc.join()
+
+    def rolling_restart(self):
+        for i, old in enumerate(list(self.procs)):
+            try:
+                new = self._spawn_ready()
+            except RuntimeError as e:
+                print(f"rolling restart aborted: {e}")
+                return
+            self.procs[i] = new
+            self._respawn_at.pop(i, None)
+            self._stop_proc(old)
+            print(f"worker {old.pid} replaced by {new.pid}")
+
+    def respawn(self, i: int):
+        """Replace dead worker i. A replacement that fails to get ready is retried later."""
+        delay, at = self._respawn_at.get(i, (0.0, 0.0))
+        if time.monotonic() < at:
+            return
+        if not delay:
+            proc = self.procs[i]
+            print(f"worker {proc.pid} exited ({proc.exitcode}); respawning")
+        try:
+            self.procs[i] = self._spawn_ready()
+        except RuntimeError as e:
+            delay = min(max(1.0, delay * 2), RESPAWN_MAX_DELAY)
+            self._respawn_at[i] = (delay, time.monotonic() + delay)
+            print(f"respawn failed: {e}; retrying in {delay:.0f}s")
+            return
+        self._respawn_at.pop(i, None)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, "_restart", True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, "_stop", True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, "_stop", True))
+
+        print(f"starting {self.workers} workers, {self.pool_size} pooled + {self.shard_pools} shard-pooled + "
+              f"{self.dedicated} dedicated connections each")
+        try:
+            for _ in range(self.workers):
+                self.procs.append(self._spawn_ready())
+            while not self._stop:
+                if self._restart:
+                    self._restart = False
+                    self.rolling_restart()
+                # Replace workers that died unexpectedly
+                for i, proc in enumerate(self.procs):
+                    if not proc.is_alive() and not self._stop:
+                        self.respawn(i)
+                time.sleep(0.5)
+        finally:
+            for proc in self.procs:
+                self._stop_proc(proc)
+            self.sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the API with multiple workers")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "5003")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--db-budget", type=int, default=int(os.environ.get("DB_CONNECTION_BUDGET", "40")),
+                        help="total Postgres connections shared by all workers")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    Supervisor(args.host, args.port, args.workers, args.db_budget, args.log_level).run()
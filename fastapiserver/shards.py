@@ -0,0 +1,197 @@
+# shards.py
+# Routing of store-scoped tables (sales, inventory, customer_traffic) across
+# several Postgres databases by supermarket_id.
+#
+# The shard map comes from SHARD_MAP, either inline JSON or a path to a JSON
+# file:
+#
+#   {"shards": {"s0": "postgresql://...:5433/supermarket",
+#               "s1": "postgresql://...:5434/supermarket"},
+#    "overrides": {"<supermarket_id>": "s1"}}
+#
+# A store lives on overrides[id] if present, otherwise on
+# shards[sorted names][crc32(id) % n]. CRM tables and `supermarkets` stay on
+# the home database (DATABASE_URL, db.get_conn). Without SHARD_MAP the home
+# database is the only shard, so every call below degrades to a plain
+# get_conn(). Each shard has its own change log (changes.py), and exports
+# (jobs.py) read the store-scoped tables from every shard.
+#
+# To try it locally, start a few Postgres instances on different ports, point
+# SHARD_MAP at them and run `python shards.py init` to create the store-scoped
+# tables on each one. Partition maintenance and archival (partitions.py,
+# tiering.py) visit every shard.
+import asyncio
+import json
+import os
+import zlib
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+import asyncpg
+from db import get_conn, DeadlineConnection, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE
+
+T = TypeVar("T")
+
+# Tables that live on the shards rather than the home database
+STORE_TABLES = ("sales", "inventory", "customer_traffic")
+
+# Per-shard pool size. By default the shards split DB_POOL_MAX_SIZE between
+# them on top of the home pool, which keeps its own DB_POOL_MAX_SIZE, so a
+# sharded worker holds up to twice that many pool connections in all;
+# serve.py halves the pool it hands each worker to stay within its budget.
+SHARD_POOL_MAX_SIZE = int(os.environ.get("SHARD_POOL_MAX_SIZE", "0"))
+
+STORE_TABLES_DDL = """
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+
+CREATE TABLE IF NOT EXISTS sales (
+  id VARCHAR PRIMARY KEY DEFAULT gen_random_uuid(),
+  supermarket_id VARCHAR NOT NULL,
+  date TIMESTAMP NOT NULL,
+  category TEXT NOT NULL,
+  product TEXT NOT NULL,
+  quantity INTEGER NOT NULL,
+  unit_price INTEGER NOT NULL,
+  total_amount INTEGER NOT NULL,
+  payment_method TEXT NOT NULL,
+  customer_age INTEGER,
+  customer_gender TEXT,
+  created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS inventory (
+  id VARCHAR PRIMARY KEY DEFAULT gen_random_uuid(),
+  supermarket_id VARCHAR NOT NULL,
+  product TEXT NOT NULL,
+  category TEXT NOT NULL,
+  current_stock INTEGER NOT NULL,
+  minimum_stock INTEGER NOT NULL,
+  last_restocked TIMESTAMP,
+  supplier TEXT NOT NULL,
+  cost_price INTEGER NOT NULL,
+  selling_price INTEGER NOT NULL,
+  created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS customer_traffic (
+  id VARCHAR PRIMARY KEY DEFAULT gen_random_uuid(),
+  supermarket_id VARCHAR NOT NULL,
+  date TIMESTAMP NOT NULL,
+  hour INTEGER NOT NULL,
+  visitor_count INTEGER NOT NULL,
+  avg_transaction_value INTEGER NOT NULL,
+  created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE UNIQUE INDEX IF NOT EXISTS customer_traffic_store_date_hour
+  ON customer_traffic (supermarket_id, date, hour);
+"""
+
+
+def load_shard_map(raw: Optional[str]) -> Optional[Dict]:
+    if not raw:
+        return None
+    if not raw.lstrip().startswith("{"):
+        with open(raw) as f:
+            raw = f.read()
+    shard_map = json.loads(raw)
+    if not shard_map.get("shards"):
+        raise ValueError("SHARD_MAP needs a non-empty 'shards' object")
+    unknown = set(shard_map.get("overrides", {}).values()) - set(shard_map["shards"])
+    if unknown:
+        raise ValueError(f"SHARD_MAP overrides point at unknown shards: {sorted(unknown)}")
+    return shard_map
+
+
+class ShardRouter:
+    def __init__(self, shard_map: Optional[Dict]):
+        self.dsns: Dict[str, str] = dict(shard_map["shards"]) if shard_map else {}
+        self.overrides: Dict[str, str] = dict(shard_map.get("overrides", {})) if shard_map else {}
+        self.names: List[str] = sorted(self.dsns)
+        self.pools: Dict[str, asyncpg.pool.Pool] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.names)
+
+    def pool_size(self) -> int:
+        if SHARD_POOL_MAX_SIZE > 0 or not self.names:
+            return SHARD_POOL_MAX_SIZE
+        return max(1, DB_POOL_MAX_SIZE // len(self.names))
+
+    async def open(self):
+        size = self.pool_size()
+        for name in self.names:
+            if name not in self.pools:
+                self.pools[name] = await asyncpg.create_pool(
+                    self.dsns[name], min_size=min(DB_POOL_MIN_SIZE, size), max_size=size,
+                    connection_class=DeadlineConnection)
+
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.close()
+        self.pools = {}
+
+    def shard_for(self, supermarket_id: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        if supermarket_id in self.overrides:
+            return self.overrides[supermarket_id]
+        return self.names[zlib.crc32(str(supermarket_id).encode()) % len(self.names)]
+
+    @asynccontextmanager
+    async def conn(self, shard: Optional[str]):
+        if shard is None:
+            async with get_conn() as conn:
+                yield conn
+            return
+        if shard not in self.pools:
+            await self.open()
+        async with self.pools[shard].acquire() as conn:
+            yield conn
+
+    def conn_for(self, supermarket_id: str):
+        """Connection to the shard that owns `supermarket_id`."""
+        return self.conn(self.shard_for(supermarket_id))
+
+    async def fan_out(self, fn: Callable[[asyncpg.Connection], Awaitable[T]]) -> List[T]:
+        """Run fn(conn) on every shard concurrently; one result per shard."""
+        if not self.enabled:
+            async with get_conn() as conn:
+                return [await fn(conn)]
+
+        async def one(name):
+            async with self.conn(name) as conn:
+                return await fn(conn)
+
+        return list(await asyncio.gather(*(one(n) for n in self.names)))
+
+    async def fetch_all(self, query: str, *args) -> List[asyncpg.Record]:
+        """Concatenate the rows of `query` from every shard."""
+        parts = await self.fan_out(lambda conn: conn.fetch(query, *args))
+        return [r for rows in parts for r in rows]
+
+    async def init_schema(self):
+        await self.open()
+        for name in self.names:
+            async with self.conn(name) as conn:
+                await conn.execute(STORE_TABLES_DDL)
+
+
+router = ShardRouter(load_shard_map(os.environ.get("SHARD_MAP")))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Shard management")
+    parser.add_argument("command", choices=["init", "show"])
+    args = parser.parse_args()
+
+    async def run():
+        if args.command == "show":
+            print(json.dumps({"shards": router.names, "overrides": router.overrides}, indent=2))
+            return
+        await router.init_schema()
+        await router.close()
+        print(f"initialised {len(router.names)} shards")
+
+    asyncio.run(run())
@@ -0,0 +1,451 @@
+# snapshot.py
+# Columnar, memory-mapped snapshots of sales and customer_traffic for
+# analytics that do not belong on the OLTP database.
+#
+#   <SNAPSHOT_DIR>/CURRENT                 name of the live generation
+#   <SNAPSHOT_DIR>/<generation>/
+#       meta.json                          row counts, build time
+#       dicts.json                         dictionaries of the encoded columns
+#       <table>.<column>.npy               one NumPy array per column
+#
+# Rows are sorted by date, so a time window is a searchsorted slice. Text
+# columns (store, category, product, payment method, gender) are stored as
+# int32 codes into dicts.json. Arrays are opened with mmap_mode="r", so every
+# worker on the box shares the same page cache instead of holding a copy.
+#
+# A build streams each table with a server-side cursor and turns every batch of
+# FETCH_BATCH rows into NumPy chunks (codes included) before fetching the next,
+# so peak memory is the arrays themselves, not a Python object per cell.
+#
+# One worker rebuilds the snapshot every SNAPSHOT_REFRESH_SECONDS (advisory
+# lock; the others only pick up the new CURRENT). A new generation is written
+# beside the old one and CURRENT is swapped atomically, so readers never see
+# a half-written snapshot. `python snapshot.py build` does the same by hand.
+#
+# All kernels below are vectorised: grouping is np.bincount over the codes,
+# percentiles come from one lexsort per call, windows from cumulative sums.
+import asyncio
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence
+import asyncpg
+import numpy as np
+from db import get_conn, DATABASE_URL
+from shards import router
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
+KEEP_GENERATIONS = 2
+FETCH_BATCH = int(os.environ.get("SNAPSHOT_FETCH_BATCH", "10000"))
+
+_BUILD_LOCK = 728_004
+
+# table -> {column: dtype}; "code" columns are dictionary-encoded
+COLUMNS = {
+    "sales": {
+        "date": "datetime64[us]",
+        "supermarket_id": "code",
+        "category": "code",
+        "product": "code",
+        "payment_method": "code",
+        "customer_gender": "code",
+        "quantity": "int32",
+        "unit_price": "int64",
+        "total_amount": "int64",
+        "customer_age": "int16",  # -1 for NULL
+    },
+    "customer_traffic": {
+        "date": "datetime64[us]",
+        "supermarket_id": "code",
+        "hour": "int8",
+        "visitor_count": "int64",
+        "avg_transaction_value": "int64",
+    },
+}
+
+AGE_GROUPS = ["under_25", "25_44", "45_64", "65_plus"]
+
+METRICS = {
+    # name -> (table, column summed per day; None counts rows)
+    "revenue": ("sales", "total_amount"),
+    "units": ("sales", "quantity"),
+    "transactions": ("sales", None),
+    "visitors": ("customer_traffic", "visitor_count"),
+}
+
+
+class SnapshotUnavailable(Exception):
+    pass
+
+
+# --- Building ---
+def _np_dtype(dtype: str) -> str:
+    return "int32" if dtype == "code" else dtype
+
+
+async def _fetch_table(conn, table: str, dicts: Dict[str, Dict]) -> Dict[str, List[np.ndarray]]:
+    cols = list(COLUMNS[table])
+    chunks: Dict[str, List[np.ndarray]] = {c: [] for c in cols}
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        cursor = await conn.cursor(f"SELECT {', '.join(cols)} FROM {table}")
+        while True:
+            rows = await cursor.fetch(FETCH_BATCH)
+            if not rows:
+                break
+            # Encoding has no await, so shards fetched concurrently share dicts safely
+            for col, a in _to_arrays(table, rows, dicts).items():
+                chunks[col].append(a)
+    return chunks
+
+
+def _encode(values: list, index: Dict) -> np.ndarray:
+    # index maps value -> code in first-seen order, so list(index) is the dictionary
+    codes = []
+    for v in values:
+        code = index.get(v)
+        if code is None:
+            code = index[v] = len(index)
+        codes.append(code)
+    return np.array(codes, dtype=np.int32)
+
+
+def _to_arrays(table: str, rows: List, dicts: Dict[str, Dict]) -> Dict[str, np.ndarray]:
+    arrays = {}
+    for i, (col, dtype) in enumerate(COLUMNS[table].items()):
+        values = [r[i] for r in rows]
+        if dtype == "code":
+            arrays[col] = _encode(values, dicts.setdefault(col, {}))
+        elif col == "customer_age":
+            arrays[col] = np.array([-1 if v is None else v for v in values], dtype=dtype)
+        else:
+            arrays[col] = np.array(values, dtype=dtype)
+    return arrays
+
+
+def _by_date(table: str, parts: List[Dict[str, List[np.ndarray]]]) -> Dict[str, np.ndarray]:
+    """Join every shard's chunks into one array per column, sorted by date."""
+    arrays = {}
+    for col, dtype in COLUMNS[table].items():
+        chunks = [a for p in parts for a in p[col]]
+        arrays[col] = np.concatenate(chunks) if chunks else np.empty(0, dtype=_np_dtype(dtype))
+    order = np.argsort(arrays["date"], kind="stable")
+    return {col: a[order] for col, a in arrays.items()}
+
+
+def _write_generation(tables: Dict[str, Dict[str, np.ndarray]], dicts: Dict, names: Dict) -> str:
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    generation = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+    path = os.path.join(SNAPSHOT_DIR, generation)
+    os.makedirs(path)
+    for table, arrays in tables.items():
+        for col, a in arrays.items():
+            np.save(os.path.join(path, f"{table}.{col}.npy"), a)
+    with open(os.path.join(path, "dicts.json"), "w") as f:
+        json.dump({"columns": dicts, "supermarket_names": names}, f)
+    meta = {"generation": generation, "built_at": datetime.now(timezone.utc).isoformat(),
+            "rows": {t: int(len(a["date"])) for t, a in tables.items()}}
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    tmp = os.path.join(SNAPSHOT_DIR, "CURRENT.tmp")
+    with open(tmp, "w") as f:
+        f.write(generation)
+    os.replace(tmp, os.path.join(SNAPSHOT_DIR, "CURRENT"))
+    _prune(generation)
+    return generation
+
+
+def _prune(current: str):
+    gens = sorted(d for d in os.listdir(SNAPSHOT_DIR)
+                  if os.path.isdir(os.path.join(SNAPSHOT_DIR, d)))
+    # Open memory maps keep unlinked files alive, so readers of an old
+    # generation finish their query undisturbed
+    for d in gens[:-KEEP_GENERATIONS]:
+        if d != current:
+            shutil.rmtree(os.path.join(SNAPSHOT_DIR, d), ignore_errors=True)
+
+
+async def build_snapshot() -> str:
+    dicts: Dict[str, Dict] = {}
+    parts: Dict[str, List[Dict[str, List[np.ndarray]]]] = {}
+    for table in COLUMNS:
+        parts[table] = await router.fan_out(lambda conn, t=table: _fetch_table(conn, t, dicts))
+    async with get_conn() as conn:
+        names = {r["id"]: r["name"] for r in await conn.fetch("SELECT id, name FROM supermarkets")}
+
+    def assemble():
+        tables = {t: _by_date(t, parts[t]) for t in COLUMNS}
+        return _write_generation(tables, {col: list(index) for col, index in dicts.items()}, names)
+
+    return await asyncio.to_thread(assemble)
+
+
+def _age_seconds() -> Optional[float]:
+    try:
+        return time.time() - os.stat(os.path.join(SNAPSHOT_DIR, "CURRENT")).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+async def refresh(interval: float) -> Optional[str]:
+    """Rebuild unless another worker did so within the interval."""
+    age = _age_seconds()
+    if age is not None and age < interval:
+        return None
+    # The lock is held on its own connection so the build can use the whole pool
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", _BUILD_LOCK):
+            return None
+        return await build_snapshot()
+    finally:
+        await conn.close()  # releases the session lock
+
+
+async def snapshot_refresh_loop(interval: float = 300.0):
+    while True:
+        try:
+            await refresh(interval)
+        except Exception as e:  # keep the loop alive; retried next interval
+            print(f"snapshot refresh failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+# --- Reading ---
+class Snapshot:
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "dicts.json")) as f:
+            d = json.load(f)
+        self.dicts: Dict[str, List] = d["columns"]
+        self.supermarket_names: Dict[str, str] = d["supermarket_names"]
+        self.columns = {
+            table: {col: np.load(os.path.join(path, f"{table}.{col}.npy"), mmap_mode="r") for col in cols}
+            for table, cols in COLUMNS.items()
+        }
+
+    def window(self, table: str, start: Optional[datetime], end: Optional[datetime],
+               supermarket_id: Optional[str] = None) -> Dict[str, np.ndarray]:
+        cols = self.columns[table]
+        dates = cols["date"]
+        lo = 0 if start is None else int(np.searchsorted(dates, _dt64(start), "left"))
+        hi = len(dates) if end is None else int(np.searchsorted(dates, _dt64(end), "left"))
+        view = {c: a[lo:hi] for c, a in cols.items()}
+        if supermarket_id is not None:
+            try:
+                code = self.dicts.get("supermarket_id", []).index(supermarket_id)
+            except ValueError:
+                code = -1
+            mask = view["supermarket_id"] == code
+            view = {c: a[mask] for c, a in view.items()}
+        return view
+
+
+def _dt64(dt: datetime) -> np.datetime64:
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(dt, "us")
+
+
+def _py(v):
+    # NumPy scalars -> JSON-friendly Python values
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, float) and v != v:
+        return None
+    return v
+
+
+def group_sum(codes: np.ndarray, n_groups: int, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    return np.bincount(codes, weights=weights, minlength=n_groups)
+
+
+def group_percentiles(codes: np.ndarray, values: np.ndarray, n_groups: int,
+                      qs: Sequence[float]) -> np.ndarray:
+    """Linear-interpolated percentiles (as percentile_cont) per group: shape (groups, len(qs))."""
+    order = np.lexsort((values, codes))
+    v = values[order].astype(np.float64)
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    out = np.full((n_groups, len(qs)), np.nan)
+    has = counts > 0
+    if not has.any():
+        return out
+    last = (starts + counts - 1)[has]
+    for j, q in enumerate(qs):
+        pos = starts[has] + (counts[has] - 1) * (q / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, last)
+        frac = pos - lo
+        out[has, j] = v[lo] * (1 - frac) + v[hi] * frac
+    return out
+
+
+def rolling_mean(series: np.ndarray, window: int) -> np.ndarray:
+    """Trailing mean over `window` points; NaN until the window is full."""
+    out = np.full(len(series), np.nan)
+    if window <= 0 or len(series) < window:
+        return out
+    c = np.cumsum(np.concatenate(([0.0], series.astype(np.float64))))
+    out[window - 1:] = (c[window:] - c[:-window]) / window
+    return out
+
+
+class SnapshotEngine:
+    def __init__(self, root: str = SNAPSHOT_DIR):
+        self.root = root
+        self._generation: Optional[str] = None
+        self._snapshot: Optional[Snapshot] = None
+
+    def current(self) -> Snapshot:
+        try:
+            with open(os.path.join(self.root, "CURRENT")) as f:
+                generation = f.read().strip()
+        except FileNotFoundError:
+            raise SnapshotUnavailable("No analytics snapshot has been built yet")
+        if generation != self._generation:
+            self._snapshot = Snapshot(os.path.join(self.root, generation))
+            self._generation = generation
+        return self._snapshot
+
+    def status(self) -> Dict:
+        return self.current().meta
+
+    # --- Equivalents of the Storage analytics queries ---
+    def _grouped_sales(self, start, end, codes, labels, key_fields) -> List[Dict]:
+        s = self.current().window("sales", start, end)
+        n = len(labels)
+        totals = group_sum(codes(s), n, s["total_amount"])
+        counts = group_sum(codes(s), n)
+        rows = [dict(zip(key_fields, labels[i]), total=int(totals[i]), count=int(counts[i]))
+                for i in np.flatnonzero(counts)]
+        return sorted(rows, key=lambda r: r["total"], reverse=True)
+
+    def sales_by_category(self, start=None, end=None) -> List[Dict]:
+        labels = [(c,) for c in self.current().dicts.get("category", [])]
+        return self._grouped_sales(start, end, lambda s: s["category"], labels, ("category",))
+
+    def sales_by_payment_method(self, start=None, end=None) -> List[Dict]:
+        labels = [(m,) for m in self.current().dicts.get("payment_method", [])]
+        return self._grouped_sales(start, end, lambda s: s["payment_method"], labels, ("method",))
+
+    def sales_by_demographic(self, start=None, end=None) -> List[Dict]:
+        genders = self.current().dicts.get("customer_gender", [])
+        labels = [(g, a) for g in genders for a in AGE_GROUPS]
+
+        def codes(s):
+            age = s["customer_age"]
+            # Same buckets as the SQL CASE; NULL (-1) falls through to 65_plus
+            bucket = np.select([(age >= 0) & (age < 25), (age >= 25) & (age <= 44), (age >= 45) & (age <= 64)],
+                               [0, 1, 2], default=3)
+            return s["customer_gender"].astype(np.int64) * len(AGE_GROUPS) + bucket
+
+        return self._grouped_sales(start, end, codes, labels, ("gender", "age_group"))
+
+    def traffic_by_hour(self, start=None, end=None) -> List[Dict]:
+        t = self.current().window("customer_traffic", start, end)
+        visitors = group_sum(t["hour"], 24, t["visitor_count"])
+        value = group_sum(t["hour"], 24, t["avg_transaction_value"])
+        n = group_sum(t["hour"], 24)
+        return [{"hour": int(h), "totalvisitors": int(visitors[h]), "avgtransaction": float(value[h] / n[h])}
+                for h in np.flatnonzero(n)]
+
+    def traffic_by_supermarket(self, start=None, end=None) -> List[Dict]:
+        snap = self.current()
+        ids = snap.dicts.get("supermarket_id", [])
+        t = snap.window("customer_traffic", start, end)
+        visitors = group_sum(t["supermarket_id"], len(ids), t["visitor_count"])
+        n = group_sum(t["supermarket_id"], len(ids))
+        rows = [{"supermarket_id": ids[i], "name": snap.supermarket_names.get(ids[i]),
+                 "totalvisitors": int(visitors[i])}
+                for i in np.flatnonzero(n) if ids[i] in snap.supermarket_names]
+        return sorted(rows, key=lambda r: r["totalvisitors"], reverse=True)
+
+    # --- Ad-hoc questions ---
+    def basket_sizes(self, start=None, end=None, supermarket_id: Optional[str] = None) -> Dict:
+        """Distribution of items per sale (quantity)."""
+        s = self.current().window("sales", start, end, supermarket_id)
+        q = s["quantity"]
+        if not len(q):
+            return {"transactions": 0, "mean": None, "p50": None, "p90": None, "histogram": []}
+        hist = np.bincount(np.clip(q, 0, None))
+        p50, p90 = np.percentile(q, [50, 90])
+        return {
+            "transactions": int(len(q)), "mean": float(q.mean()), "p50": float(p50), "p90": float(p90),
+            "histogram": [{"quantity": int(k), "transactions": int(hist[k])} for k in np.flatnonzero(hist)],
+        }
+
+    def price_elasticity(self, start=None, end=None, min_observations: int = 30) -> List[Dict]:
+        """Per product, slope of log(quantity) on log(unit_price) (constant-elasticity fit)."""
+        snap = self.current()
+        products = snap.dicts.get("product", [])
+        s = snap.window("sales", start, end)
+        ok = (s["unit_price"] > 0) & (s["quantity"] > 0)
+        codes = s["product"][ok]
+        x = np.log(s["unit_price"][ok].astype(np.float64))
+        y = np.log(s["quantity"][ok].astype(np.float64))
+        m = len(products)
+        n = group_sum(codes, m)
+        sx, sy = group_sum(codes, m, x), group_sum(codes, m, y)
+        sxx, sxy = group_sum(codes, m, x * x), group_sum(codes, m, x * y)
+        denom = n * sxx - sx * sx
+        valid = (n >= min_observations) & (denom > 1e-9)
+        slope = np.divide(n * sxy - sx * sy, denom, out=np.full(m, np.nan), where=valid)
+        rows = [{"product": products[i], "elasticity": float(slope[i]), "observations": int(n[i])}
+                for i in np.flatnonzero(valid)]
+        return sorted(rows, key=lambda r: r["observations"], reverse=True)
+
+    def spend_percentiles(self, start=None, end=None, by: str = "supermarket_id",
+                          qs: Sequence[float] = (50, 90, 99)) -> List[Dict]:
+        """Percentiles of total_amount per store / category / payment method."""
+        if by not in ("supermarket_id", "category", "payment_method"):
+            raise ValueError(f"Cannot group spend by {by!r}")
+        snap = self.current()
+        labels = snap.dicts.get(by, [])
+        s = snap.window("sales", start, end)
+        counts = group_sum(s[by], len(labels))
+        pct = group_percentiles(s[by], s["total_amount"], len(labels), qs)
+        rows = []
+        for i in np.flatnonzero(counts):
+            row = {by: labels[i], "count": int(counts[i])}
+            if by == "supermarket_id":
+                row["name"] = snap.supermarket_names.get(labels[i])
+            row.update({f"p{q:g}": _py(pct[i, j]) for j, q in enumerate(qs)})
+            rows.append(row)
+        return rows
+
+    def rolling(self, metric: str, window_days: int = 7, start=None, end=None,
+                supermarket_id: Optional[str] = None) -> List[Dict]:
+        """Daily series of `metric` with its trailing `window_days` mean."""
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric!r}")
+        table, column = METRICS[metric]
+        w = self.current().window(table, start, end, supermarket_id)
+        if not len(w["date"]):
+            return []
+        days = w["date"].astype("datetime64[D]")
+        first = days[0]
+        idx = (days - first).astype(np.int64)
+        daily = group_sum(idx, int(idx[-1]) + 1, None if column is None else w[column])
+        avg = rolling_mean(daily, window_days)
+        first_day = first.astype(datetime)
+        return [{"date": (first_day + timedelta(days=i)).isoformat(), "value": _py(daily[i]),
+                 "rolling": _py(avg[i])} for i in range(len(daily))]
+
+
+engine = SnapshotEngine()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Analytics snapshot management")
+    parser.add_argument("command", choices=["build", "show"])
+    args = parser.parse_args()
+
+    if args.command == "show":
+        print(json.dumps(engine.status(), indent=2))
+    else:
+        print(f"built {asyncio.run(build_snapshot())}")
@@ -0,0 +1,665 @@
+# sqlite_storage.py
+# Embedded storage backend for single-box deployments (small franchise
+# stores, edge boxes, local development) where running a Postgres server is
+# not worth it.
+#
+#   STORAGE_BACKEND=sqlite SQLITE_PATH=/var/lib/clientflow.db uvicorn main:app
+#
+# Implements the same methods as storage.Storage (see StorageBackend) on one
+# SQLite file in WAL mode. sqlite3 is blocking, so statements run on a thread
+# pool: readers get their own connection per thread and read concurrently
+# under WAL, while every write goes through a single writer thread, which is
+# the concurrency SQLite allows anyway. Timestamps are stored as ISO strings
+# (lexically ordered) and come back as naive datetimes, booleans as 0/1.
+#
+# Postgres-only features are not available on this backend: the change feed,
+# partitions and cold tier (include_archive is accepted and ignored),
+# background jobs, sharding and the write coalescer.
+import asyncio
+import os
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+import overview
+import bulk
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+  id TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  email TEXT NOT NULL,
+  phone TEXT,
+  company TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'active',
+  last_contact TIMESTAMP,
+  created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS follow_ups (
+  id TEXT PRIMARY KEY,
+  client_id TEXT NOT NULL REFERENCES clients(id),
+  title TEXT NOT NULL,
+  description TEXT,
+  scheduled_date TIMESTAMP NOT NULL,
+  completed BOOLEAN DEFAULT 0,
+  completed_at TIMESTAMP,
+  type TEXT NOT NULL,
+  created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS tasks (
+  id TEXT PRIMARY KEY,
+  client_id TEXT REFERENCES clients(id),
+  title TEXT NOT NULL,
+  description TEXT,
+  due_date TIMESTAMP,
+  completed BOOLEAN DEFAULT 0,
+  completed_at TIMESTAMP,
+  priority TEXT DEFAULT 'medium',
+  created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS interactions (
+  id TEXT PRIMARY KEY,
+  client_id TEXT NOT NULL REFERENCES clients(id),
+  type TEXT NOT NULL,
+  subject TEXT NOT NULL,
+  notes TEXT,
+  created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS supermarkets (
+  id TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  location TEXT NOT NULL,
+  city TEXT NOT NULL,
+  region TEXT NOT NULL,
+  size TEXT NOT NULL,
+  type TEXT NOT NULL,
+  created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS sales (
+  id TEXT PRIMARY KEY,
+  supermarket_id TEXT NOT NULL REFERENCES supermarkets(id),
+  date TIMESTAMP NOT NULL,
+  category TEXT NOT NULL,
+  product TEXT NOT NULL,
+  quantity INTEGER NOT NULL,
+  unit_price INTEGER NOT NULL,
+  total_amount INTEGER NOT NULL,
+  payment_method TEXT NOT NULL,
+  customer_age INTEGER,
+  customer_gender TEXT,
+  created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS inventory (
+  id TEXT PRIMARY KEY,
+  supermarket_id TEXT NOT NULL REFERENCES supermarkets(id),
+  product TEXT NOT NULL,
+  category TEXT NOT NULL,
+  current_stock INTEGER NOT NULL,
+  minimum_stock INTEGER NOT NULL,
+  last_restocked TIMESTAMP,
+  supplier TEXT NOT NULL,
+  cost_price INTEGER NOT NULL,
+  selling_price INTEGER NOT NULL,
+  created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS customer_traffic (
+  id TEXT PRIMARY KEY,
+  supermarket_id TEXT NOT NULL REFERENCES supermarkets(id),
+  date TIMESTAMP NOT NULL,
+  hour INTEGER NOT NULL,
+  visitor_count INTEGER NOT NULL,
+  avg_transaction_value INTEGER NOT NULL,
+  created_at TIMESTAMP
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS customer_traffic_store_date_hour
+  ON customer_traffic (supermarket_id, date, hour);
+CREATE INDEX IF NOT EXISTS sales_date ON sales (date);
+CREATE INDEX IF NOT EXISTS inventory_supermarket ON inventory (supermarket_id, product);
+CREATE INDEX IF NOT EXISTS inventory_low_stock
+  ON inventory (current_stock) WHERE current_stock <= minimum_stock;
+CREATE INDEX IF NOT EXISTS follow_ups_client ON follow_ups (client_id);
+CREATE INDEX IF NOT EXISTS tasks_client ON tasks (client_id);
+CREATE INDEX IF NOT EXISTS follow_ups_scheduled_date ON follow_ups (scheduled_date);
+CREATE INDEX IF NOT EXISTS tasks_due_date ON tasks (due_date);
+CREATE INDEX IF NOT EXISTS interactions_client ON interactions (client_id);
+DROP INDEX IF EXISTS follow_ups_client_recent;
+CREATE INDEX IF NOT EXISTS follow_ups_client_recent_key
+  ON follow_ups (client_id, COALESCE(created_at, '0001-01-01 00:00:00.000000'), id);
+DROP INDEX IF EXISTS tasks_client_recent;
+CREATE INDEX IF NOT EXISTS tasks_client_recent_key
+  ON tasks (client_id, COALESCE(created_at, '0001-01-01 00:00:00.000000'), id);
+DROP INDEX IF EXISTS interactions_client_recent;
+CREATE INDEX IF NOT EXISTS interactions_client_recent_key
+  ON interactions (client_id, COALESCE(created_at, '0001-01-01 00:00:00.000000'), id);
+"""
+
+
+# --- Type mapping ---
+def _naive_utc(dt: datetime) -> datetime:
+    # TIMESTAMP columns are zone-less, as in the Postgres schema
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _adapt_datetime(dt: datetime) -> str:
+    return _naive_utc(dt).isoformat(" ", timespec="microseconds")
+
+
+def _convert_timestamp(raw: bytes) -> datetime:
+    return _naive_utc(datetime.fromisoformat(raw.decode()))
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+sqlite3.register_converter("BOOLEAN", lambda raw: raw not in (b"0", b""))
+
+
+def _as_datetime(value) -> Any:
+    if isinstance(value, str):
+        return _naive_utc(datetime.fromisoformat(value))
+    return value
+
+
+def _rows(cur: sqlite3.Cursor) -> List[Dict]:
+    names = [d[0] for d in cur.description]
+    return [dict(zip(names, r)) for r in cur.fetchall()]
+
+
+def _one(cur: sqlite3.Cursor) -> Optional[Dict]:
+    rows = _rows(cur)
+    return rows[0] if rows else None
+
+
+def _date_range(start: Optional[datetime], end: Optional[datetime], column: str = "date"):
+    conds, args = [], []
+    if start is not None:
+        conds.append(f"{column} >= ?")
+        args.append(start)
+    if end is not None:
+        conds.append(f"{column} < ?")
+        args.append(end)
+    return ("WHERE " + " AND ".join(conds)) if conds else "", args
+
+
+class SQLiteStorage:
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = readers
+        self.coalescer = None  # write coalescing is a Postgres-pool optimisation
+        self._local = threading.local()
+        self._local_conns: List[sqlite3.Connection] = []
+        self._read_pool: Optional[ThreadPoolExecutor] = None
+        self._write_pool: Optional[ThreadPoolExecutor] = None
+        self._columns: Dict[str, set] = {}
+
+    def enable_write_coalescing(self, max_delay: float = 0.005, max_rows: int = 100):
+        pass
+
+    # --- Connections ---
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            self._local_conns.append(conn)
+        return conn
+
+    async def open(self):
+        if self._write_pool is not None:
+            return
+        self._read_pool = ThreadPoolExecutor(self.readers, thread_name_prefix="sqlite-read")
+        self._write_pool = ThreadPoolExecutor(1, thread_name_prefix="sqlite-write")
+
+        def init(conn):
+            conn.executescript(SCHEMA)
+            for table in ("clients", "follow_ups", "tasks"):
+                self._columns[table] = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+        await self._write(init)
+
+    async def close(self):
+        for pool in (self._read_pool, self._write_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        for conn in self._local_conns:
+            conn.close()
+        self._read_pool = self._write_pool = None
+        self._local_conns = []
+
+    async def _run(self, pool_name: str, fn: Callable[[sqlite3.Connection], Any]):
+        if self._write_pool is None:
+            await self.open()
+        pool = self._read_pool if pool_name == "read" else self._write_pool
+
+        def call():
+            conn = self._connect()
+            if pool_name == "read":
+                return fn(conn)
+            with conn:  # one transaction per write call
+                return fn(conn)
+
+        return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+    def _read(self, fn):
+        return self._run("read", fn)
+
+    def _write(self, fn):
+        return self._run("write", fn)
+
+    async def _fetch(self, q: str, *args) -> List[Dict]:
+        return await self._read(lambda conn: _rows(conn.execute(q, args)))
+
+    async def _fetchrow(self, q: str, *args) -> Optional[Dict]:
+        return await self._read(lambda conn: _one(conn.execute(q, args)))
+
+    async def _insert(self, table: str, values: Dict) -> Dict:
+        values = dict(values, id=str(uuid.uuid4()), created_at=datetime.now())
+        cols = ", ".join(values)
+        marks = ", ".join("?" for _ in values)
+
+        def run(conn):
+            conn.execute(f"INSERT INTO {table} ({cols}) VALUES ({marks})", tuple(values.values()))
+            return _one(conn.execute(f"SELECT * FROM {table} WHERE id = ?", (values["id"],)))
+
+        return await self._write(run)
+
+    async def _update(self, table: str, id: str, values: Dict) -> Optional[Dict]:
+        unknown = set(values) - self._columns.get(table, set(values))
+        if unknown:
+            raise ValueError(f"Unknown {table} columns: {', '.join(sorted(unknown))}")
+        set_clause = ", ".join(f"{k} = ?" for k in values)
+
+        def run(conn):
+            cur = conn.execute(f"UPDATE {table} SET {set_clause} WHERE id = ?", (*values.values(), id))
+            if cur.rowcount == 0:
+                return None
+            return _one(conn.execute(f"SELECT * FROM {table} WHERE id = ?", (id,)))
+
+        return await self._write(run)
+
+    async def _delete(self, table: str, id: str) -> bool:
+        return await self._write(
+            lambda conn: conn.execute(f"DELETE FROM {table} WHERE id = ?", (id,)).rowcount == 1)
+
+    # --- Clients ---
+    async def get_clients(self) -> List[Dict]:
+        return await self._fetch("SELECT * FROM clients ORDER BY created_at DESC")
+
+    async def get_client(self, id: str) -> Optional[Dict]:
+        return await self._fetchrow("SELECT * FROM clients WHERE id = ?", id)
+
+    async def create_client(self, payload: Dict) -> Dict:
+        return await self._insert("clients", {
+            "name": payload.get("name"), "email": payload.get("email"),
+            "phone": payload.get("phone"), "company": payload.get("company"),
+            "status": payload.get("status"), "last_contact": payload.get("lastContact"),
+        })
+
+    async def update_client(self, id: str, payload: Dict) -> Optional[Dict]:
+        if not payload:
+            return await self.get_client(id)
+        return await self._update("clients", id, payload)
+
+    async def delete_client(self, id: str) -> bool:
+        return await self._delete("clients", id)
+
+    async def search_clients(self, q: str) -> List[Dict]:
+        # LIKE is case-insensitive for ASCII in SQLite, like ILIKE
+        pattern = f"%{q}%"
+        return await self._fetch("""
+            SELECT * FROM clients
+            WHERE name LIKE ?1 OR email LIKE ?1 OR company LIKE ?1
+            ORDER BY created_at DESC
+        """, pattern)
+
+    # --- Client overview ---
+    @staticmethod
+    def _section_page(conn, table: str, id: str, limit: int, after=None) -> Dict:
+        keyset, args = (f"AND ({overview.SQLITE_SORT_KEY}, id) < (?, ?)", after) if after else ("", ())
+        rows = _rows(conn.execute(f"""
+            SELECT * FROM {table} WHERE client_id = ? {keyset}
+            ORDER BY {overview.SQLITE_SORT_KEY} DESC, id DESC LIMIT ?
+        """, (id, *args, limit + 1)))
+        return overview.page(rows, limit)
+
+    async def get_client_overview(self, id: str, limit: int = overview.DEFAULT_LIMIT) -> Optional[Dict]:
+        # All statements run back to back on one reader thread and connection
+        def run(conn):
+            client = _one(conn.execute("SELECT * FROM clients WHERE id = ?", (id,)))
+            if client is None:
+                return None
+            for t in overview.SECTIONS:
+                client[t] = self._section_page(conn, t, id, limit)
+
+            def scalar(q, *args):
+                row = conn.execute(q, (id, *args)).fetchone()
+                return row[0] if row else None
+
+            client["open_follow_ups"] = scalar(
+                "SELECT COUNT(*) FROM follow_ups WHERE client_id = ? AND completed IS NOT 1")
+            client["open_tasks"] = scalar("SELECT COUNT(*) FROM tasks WHERE client_id = ? AND completed IS NOT 1")
+            # Ordered single-column selects keep the TIMESTAMP converter (MAX() would not)
+            client["last_interaction_at"] = scalar(
+                "SELECT created_at FROM interactions WHERE client_id = ? ORDER BY created_at DESC LIMIT 1")
+            completed = [scalar(f"""SELECT completed_at FROM {t} WHERE client_id = ? AND completed_at IS NOT NULL
+                                    ORDER BY completed_at DESC LIMIT 1""") for t in ("follow_ups", "tasks")]
+            client["last_completed_at"] = max((c for c in completed if c is not None), default=None)
+            client["next_follow_up_at"] = scalar("""
+                SELECT scheduled_date FROM follow_ups
+                WHERE client_id = ? AND completed IS NOT 1 AND scheduled_date >= ?
+                ORDER BY scheduled_date LIMIT 1""", datetime.now())
+            return client
+
+        return await self._read(run)
+
+    async def get_client_section(self, id: str, section: str, cursor: Optional[str] = None,
+                                 limit: int = overview.DEFAULT_LIMIT) -> Dict:
+        if section not in overview.SECTIONS:
+            raise ValueError(f"Unknown section: {section!r}")
+        after = overview.decode_cursor(cursor)
+        return await self._read(lambda conn: self._section_page(conn, section, id, limit, after))
+
+    # --- Follow-ups ---
+    async def get_follow_ups(self) -> List[Dict]:
+        return await self._fetch("SELECT * FROM follow_ups ORDER BY scheduled_date ASC")
+
+    async def get_follow_ups_by_client(self, client_id: str) -> List[Dict]:
+        return await self._fetch(
+            "SELECT * FROM follow_ups WHERE client_id = ? ORDER BY scheduled_date ASC", client_id)
+
+    async def create_follow_up(self, payload: Dict) -> Dict:
+        return await self._insert("follow_ups", {
+            "client_id": payload.get("clientId"), "title": payload.get("title"),
+            "description": payload.get("description"), "scheduled_date": payload.get("scheduledDate"),
+            "completed": payload.get("completed", False), "completed_at": payload.get("completedAt"),
+            "type": payload.get("type"),
+        })
+
+    async def update_follow_up(self, id: str, payload: Dict) -> Optional[Dict]:
+        if not payload:
+            return await self.get_follow_up(id)
+        return await self._update("follow_ups", id, payload)
+
+    async def get_follow_up(self, id: str) -> Optional[Dict]:
+        return await self._fetchrow("SELECT * FROM follow_ups WHERE id = ?", id)
+
+    async def complete_follow_up(self, id: str) -> Optional[Dict]:
+        return await self._update("follow_ups", id, {"completed": True, "completed_at": datetime.now()})
+
+    async def delete_follow_up(self, id: str) -> bool:
+        return await self._delete("follow_ups", id)
+
+    # --- Tasks ---
+    async def get_tasks(self) -> List[Dict]:
+        return await self._fetch("SELECT * FROM tasks ORDER BY created_at DESC")
+
+    async def get_tasks_by_client(self, client_id: str) -> List[Dict]:
+        return await self._fetch("SELECT * FROM tasks WHERE client_id = ? ORDER BY created_at DESC", client_id)
+
+    async def create_task(self, payload: Dict) -> Dict:
+        return await self._insert("tasks", {
+            "client_id": payload.get("clientId"), "title": payload.get("title"),
+            "description": payload.get("description"), "due_date": payload.get("dueDate"),
+            "completed": payload.get("completed", False), "completed_at": payload.get("completedAt"),
+            "priority": payload.get("priority", "medium"),
+        })
+
+    async def update_task(self, id: str, payload: Dict) -> Optional[Dict]:
+        if not payload:
+            return await self.get_task(id)
+        return await self._update("tasks", id, payload)
+
+    async def get_task(self, id: str) -> Optional[Dict]:
+        return await self._fetchrow("SELECT * FROM tasks WHERE id = ?", id)
+
+    async def complete_task(self, id: str) -> Optional[Dict]:
+        return await self._update("tasks", id, {"completed": True, "completed_at": datetime.now()})
+
+    async def delete_task(self, id: str) -> bool:
+        return await self._delete("tasks", id)
+
+    # --- Bulk mutations ---
+    async def bulk_mutate(self, table: str, ops: Dict) -> Dict:
+        batch = bulk.Batch(table, ops)
+        cols = list(bulk.COLUMNS[table])
+
+        def existing(conn, ids):
+            found = set()
+            for i in range(0, len(ids), 500):  # stay under SQLite's bound-parameter limit
+                chunk = ids[i:i + 500]
+                marks = ", ".join("?" * len(chunk))
+                found.update(r[0] for r in conn.execute(f"SELECT id FROM {table} WHERE id IN ({marks})", chunk))
+            return found
+
+        def run(conn):
+            results: List[Dict] = []
+            ids = [str(uuid.uuid4()) for _ in batch.creates]
+            now = datetime.now()
+            conn.executemany(
+                f"INSERT INTO {table} (id, created_at, {', '.join(cols)}) VALUES ({', '.join('?' * (len(cols) + 2))})",
+                [(i, now, *row) for i, row in zip(ids, batch.creates)])
+            created = [_one(conn.execute(f"SELECT * FROM {table} WHERE id = ?", (i,))) for i in ids]
+            results += [{"op": "create", "id": i, "status": "created"} for i in ids]
+            hit = existing(conn, batch.update_ids)
+            for shape, rows in batch.updates.items():
+                sets = ", ".join(f"{c} = ?" for c in shape)
+                conn.executemany(f"UPDATE {table} SET {sets} WHERE id = ?", [(*row[1:], row[0]) for row in rows])
+            results += bulk.outcomes("update", batch.update_ids, hit)
+            hit = existing(conn, batch.complete)
+            conn.executemany(f"UPDATE {table} SET completed = 1, completed_at = ? WHERE id = ?",
+                             [(now, i) for i in batch.complete])
+            results += bulk.outcomes("complete", batch.complete, hit)
+            hit = existing(conn, batch.delete)
+            conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(i,) for i in batch.delete])
+            results += bulk.outcomes("delete", batch.delete, hit)
+            return {"created": created, "results": results}
+
+        return await self._write(run)
+
+    # --- Agenda ---
+    async def get_agenda(self, start: datetime, end: datetime, include_completed: bool = False,
+                         limit: int = 500) -> List[Dict]:
+        return await self._fetch("""
+            SELECT 'follow_up' AS kind, id, client_id, title, scheduled_date AS due_at,
+                   completed, type AS detail
+            FROM follow_ups
+            WHERE scheduled_date >= ? AND scheduled_date < ? AND (? OR completed IS NOT 1)
+            UNION ALL
+            SELECT 'task', id, client_id, title, due_date, completed, priority
+            FROM tasks
+            WHERE due_date >= ? AND due_date < ? AND (? OR completed IS NOT 1)
+            ORDER BY due_at, id
+            LIMIT ?
+        """, start, end, include_completed, start, end, include_completed, limit)
+
+    # --- Interactions ---
+    async def get_interactions(self) -> List[Dict]:
+        return await self._fetch("SELECT * FROM interactions ORDER BY created_at DESC")
+
+    async def get_interactions_by_client(self, client_id: str) -> List[Dict]:
+        return await self._fetch(
+            "SELECT * FROM interactions WHERE client_id = ? ORDER BY created_at DESC", client_id)
+
+    async def create_interaction(self, payload: Dict) -> Dict:
+        return await self._insert("interactions", {
+            "client_id": payload.get("clientId"), "type": payload.get("type"),
+            "subject": payload.get("subject"), "notes": payload.get("notes"),
+        })
+
+    # --- Supermarkets ---
+    async def get_supermarkets(self) -> List[Dict]:
+        return await self._fetch("SELECT * FROM supermarkets ORDER BY name")
+
+    async def create_supermarket(self, payload: Dict) -> Dict:
+        return await self._insert("supermarkets", {
+            k: payload.get(k) for k in ("name", "location", "city", "region", "size", "type")})
+
+    # --- Sales & analytics ---
+    # Aliases are spelled in lower case: Postgres folds unquoted aliases, SQLite keeps them.
+    async def get_sales(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                        include_archive: bool = False) -> List[Dict]:
+        where, args = _date_range(start, end)
+        return await self._fetch(f"SELECT * FROM sales {where} ORDER BY date DESC", *args)
+
+    async def get_sales_by_category(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                    include_archive: bool = False):
+        where, args = _date_range(start, end)
+        return await self._fetch(f"""
+            SELECT category, SUM(total_amount) as total, COUNT(*) as count
+            FROM sales
+            {where}
+            GROUP BY category
+            ORDER BY total DESC
+        """, *args)
+
+    async def get_sales_by_payment_method(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                          include_archive: bool = False):
+        where, args = _date_range(start, end)
+        return await self._fetch(f"""
+            SELECT payment_method as method, SUM(total_amount) as total, COUNT(*) as count
+            FROM sales
+            {where}
+            GROUP BY payment_method
+            ORDER BY total DESC
+        """, *args)
+
+    async def get_sales_by_demographic(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                       include_archive: bool = False):
+        where, args = _date_range(start, end)
+        return await self._fetch(f"""
+            SELECT
+              customer_gender as gender,
+              CASE
+                WHEN customer_age < 25 THEN 'under_25'
+                WHEN customer_age BETWEEN 25 AND 44 THEN '25_44'
+                WHEN customer_age BETWEEN 45 AND 64 THEN '45_64'
+                ELSE '65_plus'
+              END AS age_group,
+              SUM(total_amount) as total,
+              COUNT(*) as count
+            FROM sales
+            {where}
+            GROUP BY customer_gender, age_group
+            ORDER BY total DESC
+        """, *args)
+
+    async def create_sales(self, payload: Dict) -> Dict:
+        values = {
+            "id": str(uuid.uuid4()), "created_at": datetime.now(),
+            "supermarket_id": payload.get("supermarketId"), "date": payload.get("date"),
+            "category": payload.get("category"), "product": payload.get("product"),
+            "quantity": payload.get("quantity"), "unit_price": payload.get("unitPrice"),
+            "total_amount": payload.get("totalAmount"), "payment_method": payload.get("paymentMethod"),
+            "customer_age": payload.get("customerAge"), "customer_gender": payload.get("customerGender"),
+        }
+
+        def run(conn):
+            conn.execute(f"INSERT INTO sales ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+                         tuple(values.values()))
+            # There is a single writer here, so stock is charged in the same
+            # transaction instead of by inventory_engine's batch applier
+            conn.execute("""
+                UPDATE inventory SET current_stock = MAX(current_stock - ?, 0)
+                WHERE id = (SELECT id FROM inventory WHERE supermarket_id = ? AND product = ?
+                            ORDER BY created_at DESC LIMIT 1)
+            """, (values["quantity"] or 0, values["supermarket_id"], values["product"]))
+            return _one(conn.execute("SELECT * FROM sales WHERE id = ?", (values["id"],)))
+
+        return await self._write(run)
+
+    # --- Inventory ---
+    async def get_inventory(self) -> List[Dict]:
+        return await self._fetch("SELECT * FROM inventory ORDER BY product")
+
+    async def get_inventory_by_supermarket(self, supermarket_id: str) -> List[Dict]:
+        return await self._fetch(
+            "SELECT * FROM inventory WHERE supermarket_id = ? ORDER BY product", supermarket_id)
+
+    async def get_low_stock_items(self) -> List[Dict]:
+        return await self._fetch(
+            "SELECT * FROM inventory WHERE current_stock <= minimum_stock ORDER BY current_stock ASC")
+
+    async def create_inventory(self, payload: Dict) -> Dict:
+        return await self._insert("inventory", {
+            "supermarket_id": payload.get("supermarketId"), "product": payload.get("product"),
+            "category": payload.get("category"), "current_stock": payload.get("currentStock"),
+            "minimum_stock": payload.get("minimumStock"), "last_restocked": payload.get("lastRestocked"),
+            "supplier": payload.get("supplier"), "cost_price": payload.get("costPrice"),
+            "selling_price": payload.get("sellingPrice"),
+        })
+
+    # --- Customer traffic / analytics ---
+    async def get_customer_traffic(self) -> List[Dict]:
+        return await self._fetch("SELECT * FROM customer_traffic ORDER BY date DESC, hour DESC")
+
+    async def get_traffic_by_hour(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                  include_archive: bool = False):
+        where, args = _date_range(start, end)
+        return await self._fetch(f"""
+            SELECT hour, SUM(visitor_count) as totalvisitors, AVG(avg_transaction_value) as avgtransaction
+            FROM customer_traffic
+            {where}
+            GROUP BY hour
+            ORDER BY hour
+        """, *args)
+
+    async def get_traffic_by_supermarket(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                         include_archive: bool = False):
+        where, args = _date_range(start, end, "ct.date")
+        return await self._fetch(f"""
+            SELECT ct.supermarket_id, s.name, SUM(ct.visitor_count) as totalvisitors
+            FROM customer_traffic ct
+            JOIN supermarkets s ON s.id = ct.supermarket_id
+            {where}
+            GROUP BY ct.supermarket_id, s.name
+            ORDER BY totalvisitors DESC
+        """, *args)
+
+    async def create_customer_traffic(self, payload: Dict) -> Dict:
+        # One row per (store, day, hour): a repeat report adds to the existing row
+        day = _as_datetime(payload.get("date"))
+        day = _naive_utc(day).replace(hour=0, minute=0, second=0, microsecond=0)
+        key = (payload.get("supermarketId"), day, payload.get("hour"))
+        q = """
+        INSERT INTO customer_traffic AS ct
+          (id, supermarket_id, date, hour, visitor_count, avg_transaction_value, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (supermarket_id, date, hour) DO UPDATE SET
+          visitor_count = ct.visitor_count + excluded.visitor_count,
+          avg_transaction_value = CASE
+            WHEN ct.visitor_count + excluded.visitor_count > 0 THEN
+              CAST(ROUND((ct.avg_transaction_value * 1.0 * ct.visitor_count
+                          + excluded.avg_transaction_value * 1.0 * excluded.visitor_count)
+                         / (ct.visitor_count + excluded.visitor_count)) AS INTEGER)
+            ELSE excluded.avg_transaction_value
+          END
+        """
+
+        def run(conn):
+            conn.execute(q, (str(uuid.uuid4()), *key, payload.get("visitorCount"),
+                             payload.get("avgTransactionValue"), datetime.now()))
+            return _one(conn.execute(
+                "SELECT * FROM customer_traffic WHERE supermarket_id = ? AND date = ? AND hour = ?", key))
+
+        return await self._write(run)
+
+
+def from_env() -> SQLiteStorage:
+    return SQLiteStorage(os.environ.get("SQLITE_PATH", "clientflow.db"),
+                         readers=int(os.environ.get("SQLITE_READERS", "4")))
@@ -1,14 +1,139 @@
 # storage.py
-from typing import List, Optional, Dict, Any
-from datetime import datetime
+import asyncio
+import json
+import os
+from typing import List, Optional, Dict, Any, Protocol
+from datetime import datetime, timezone
 from db import get_conn
 import asyncpg
+from coalescer import WriteCoalescer
+from shards import router
+import overview
+import bulk
 
 # Helper to map asyncpg.Record -> dict
 def record_to_dict(r: asyncpg.Record) -> Dict[str, Any]:
     return dict(r)
 
+# TIMESTAMP columns are zone-less UTC; asyncpg rejects aware datetimes for them
+def naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    if dt is not None and dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+# Build "WHERE col >= $n AND col < $m" for an optional time window. The bare
+# column comparison keeps the predicate sargable so monthly partitions of
+# sales/customer_traffic are pruned to the range asked for.
+def date_range_clause(start: Optional[datetime], end: Optional[datetime],
+                      column: str = "date", first_param: int = 1):
+    conds, args = [], []
+    if start is not None:
+        args.append(naive_utc(start))
+        conds.append(f"{column} >= ${first_param + len(args) - 1}")
+    if end is not None:
+        args.append(naive_utc(end))
+        conds.append(f"{column} < ${first_param + len(args) - 1}")
+    return ("WHERE " + " AND ".join(conds)) if conds else "", args
+
+# Fold cold-tier aggregates ({key tuple: [sums]}) into grouped rows from Postgres
+def merge_rollup(rows: List[Dict], extra: Dict[tuple, List], key_fields, value_fields,
+                 sort_field: str, reverse: bool = True) -> List[Dict]:
+    merged = {tuple(r[k] for k in key_fields): r for r in rows}
+    for key, sums in extra.items():
+        row = merged.get(key)
+        if row is None:
+            row = merged[key] = dict(zip(key_fields, key), **{f: 0 for f in value_fields})
+        for f, v in zip(value_fields, sums):
+            row[f] = (row[f] or 0) + v
+    return sorted(merged.values(), key=lambda r: r[sort_field] or 0, reverse=reverse)
+
+# Combine the same GROUP BY run on every shard: rows with equal keys are summed
+def merge_shard_rows(records, key_fields, value_fields, sort_field: str,
+                     reverse: bool = True) -> List[Dict]:
+    merged: Dict[tuple, Dict] = {}
+    for r in records:
+        key = tuple(r[k] for k in key_fields)
+        row = merged.get(key)
+        if row is None:
+            merged[key] = record_to_dict(r)
+        else:
+            for f in value_fields:
+                row[f] = (row[f] or 0) + (r[f] or 0)
+    return sorted(merged.values(), key=lambda r: r[sort_field] or 0, reverse=reverse)
+
+# The interface main.py relies on. Storage (Postgres via asyncpg) is the
+# default; sqlite_storage.SQLiteStorage is the embedded alternative.
+class StorageBackend(Protocol):
+    coalescer: Any
+
+    def enable_write_coalescing(self, max_delay: float = ..., max_rows: int = ...): ...
+
+    async def get_clients(self) -> List[Dict]: ...
+    async def get_client(self, id: str) -> Optional[Dict]: ...
+    async def create_client(self, payload: Dict) -> Dict: ...
+    async def update_client(self, id: str, payload: Dict) -> Optional[Dict]: ...
+    async def delete_client(self, id: str) -> bool: ...
+    async def search_clients(self, q: str) -> List[Dict]: ...
+    async def get_client_overview(self, id: str, limit: int = overview.DEFAULT_LIMIT) -> Optional[Dict]: ...
+    async def get_client_section(self, id: str, section: str, cursor: Optional[str] = None,
+                                 limit: int = overview.DEFAULT_LIMIT) -> Dict: ...
+
+    async def get_follow_ups(self) -> List[Dict]: ...
+    async def get_follow_ups_by_client(self, client_id: str) -> List[Dict]: ...
+    async def create_follow_up(self, payload: Dict) -> Dict: ...
+    async def update_follow_up(self, id: str, payload: Dict) -> Optional[Dict]: ...
+    async def get_follow_up(self, id: str) -> Optional[Dict]: ...
+    async def complete_follow_up(self, id: str) -> Optional[Dict]: ...
+    async def delete_follow_up(self, id: str) -> bool: ...
+
+    async def get_tasks(self) -> List[Dict]: ...
+    async def get_tasks_by_client(self, client_id: str) -> List[Dict]: ...
+    async def create_task(self, payload: Dict) -> Dict: ...
+    async def update_task(self, id: str, payload: Dict) -> Optional[Dict]: ...
+    async def get_task(self, id: str) -> Optional[Dict]: ...
+    async def complete_task(self, id: str) -> Optional[Dict]: ...
+    async def delete_task(self, id: str) -> bool: ...
+    async def bulk_mutate(self, table: str, ops: Dict) -> Dict: ...
+    async def get_agenda(self, start: datetime, end: datetime, include_completed: bool = False,
+                         limit: int = 500) -> List[Dict]: ...
+
+    async def get_interactions(self) -> List[Dict]: ...
+    async def get_interactions_by_client(self, client_id: str) -> List[Dict]: ...
+    async def create_interaction(self, payload: Dict) -> Dict: ...
+
+    async def get_supermarkets(self) -> List[Dict]: ...
+    async def create_supermarket(self, payload: Dict) -> Dict: ...
+
+    async def get_sales(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                        include_archive: bool = False) -> List[Dict]: ...
+    async def get_sales_by_category(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                    include_archive: bool = False) -> List[Dict]: ...
+    async def get_sales_by_payment_method(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                          include_archive: bool = False) -> List[Dict]: ...
+    async def get_sales_by_demographic(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                       include_archive: bool = False) -> List[Dict]: ...
+    async def create_sales(self, payload: Dict) -> Dict: ...
+
+    async def get_inventory(self) -> List[Dict]: ...
+    async def get_inventory_by_supermarket(self, supermarket_id: str) -> List[Dict]: ...
+    async def get_low_stock_items(self) -> List[Dict]: ...
+    async def create_inventory(self, payload: Dict) -> Dict: ...
+
+    async def get_customer_traffic(self) -> List[Dict]: ...
+    async def get_traffic_by_hour(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                  include_archive: bool = False) -> List[Dict]: ...
+    async def get_traffic_by_supermarket(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                         include_archive: bool = False) -> List[Dict]: ...
+    async def create_customer_traffic(self, payload: Dict) -> Dict: ...
+
 class Storage:
+    def __init__(self):
+        # Opt-in micro-batching of interaction/follow-up/task inserts
+        self.coalescer: Optional[WriteCoalescer] = None
+
+    def enable_write_coalescing(self, max_delay: float = 0.005, max_rows: int = 100):
+        self.coalescer = WriteCoalescer(max_delay=max_delay, max_rows=max_rows)
+
     # --- Clients ---
     async def get_clients(self) -> List[Dict]:
         async with get_conn() as conn:
@@ -59,6 +184,46 @@ class Storage:
             """, pattern)
             return [record_to_dict(r) for r in rows]
 
+    # --- Client overview ---
+    async def get_client_overview(self, id: str, limit: int = overview.DEFAULT_LIMIT) -> Optional[Dict]:
+        sections = ",\n".join(f"""
+                  (SELECT COALESCE(json_agg(s ORDER BY COALESCE(s.created_at, '-infinity'::timestamp) DESC, s.id DESC), '[]'::json)
+                   FROM (SELECT * FROM {t} WHERE client_id = c.id
+                         ORDER BY {overview.SORT_KEY} DESC, id DESC LIMIT $2) s) AS {t}""" for t in overview.SECTIONS)
+        async with get_conn() as conn:
+            row = await conn.fetchrow(f"""
+                SELECT c.*,{sections},
+                  (SELECT COUNT(*) FROM follow_ups WHERE client_id = c.id AND completed IS NOT TRUE) AS open_follow_ups,
+                  (SELECT COUNT(*) FROM tasks WHERE client_id = c.id AND completed IS NOT TRUE) AS open_tasks,
+                  (SELECT MAX(created_at) FROM interactions WHERE client_id = c.id) AS last_interaction_at,
+                  GREATEST((SELECT MAX(completed_at) FROM follow_ups WHERE client_id = c.id),
+                           (SELECT MAX(completed_at) FROM tasks WHERE client_id = c.id)) AS last_completed_at,
+                  (SELECT MIN(scheduled_date) FROM follow_ups
+                   WHERE client_id = c.id AND completed IS NOT TRUE AND scheduled_date >= NOW()) AS next_follow_up_at
+                FROM clients c WHERE c.id = $1
+            """, id, limit + 1)
+        if row is None:
+            return None
+        out = record_to_dict(row)
+        for t in overview.SECTIONS:
+            out[t] = overview.page([overview.parse_timestamps(r) for r in json.loads(out[t])], limit)
+        return out
+
+    async def get_client_section(self, id: str, section: str, cursor: Optional[str] = None,
+                                 limit: int = overview.DEFAULT_LIMIT) -> Dict:
+        if section not in overview.SECTIONS:
+            raise ValueError(f"Unknown section: {section!r}")
+        after = overview.decode_cursor(cursor)
+        # Separate statements with and without the cursor keep both a plain
+        # index range scan (an "IS NULL OR" predicate would not be)
+        keyset, args = (f"AND ({overview.SORT_KEY}, id) < ($3, $4)", list(after)) if after else ("", [])
+        async with get_conn() as conn:
+            rows = await conn.fetch(f"""
+                SELECT * FROM {section} WHERE client_id = $1 {keyset}
+                ORDER BY {overview.SORT_KEY} DESC, id DESC LIMIT $2
+            """, id, limit + 1, *args)
+        return overview.page([record_to_dict(r) for r in rows], limit)
+
     # --- Follow-ups ---
     async def get_follow_ups(self) -> List[Dict]:
         async with get_conn() as conn:
@@ -71,6 +236,12 @@ class Storage:
             return [record_to_dict(r) for r in rows]
 
     async def create_follow_up(self, payload: Dict) -> Dict:
+        if self.coalescer:
+            return await self.coalescer.insert("follow_ups", [
+                payload.get("clientId"), payload.get("title"),
+                payload.get("description"), payload.get("scheduledDate"),
+                payload.get("completed", False), payload.get("completedAt"),
+                payload.get("type")])
         async with get_conn() as conn:
             q = """
             INSERT INTO follow_ups (client_id, title, description, scheduled_date, completed, completed_at, type)
@@ -121,6 +292,12 @@ class Storage:
             return [record_to_dict(r) for r in rows]
 
     async def create_task(self, payload: Dict) -> Dict:
+        if self.coalescer:
+            return await self.coalescer.insert("tasks", [
+                payload.get("clientId"), payload.get("title"),
+                payload.get("description"), payload.get("dueDate"),
+                payload.get("completed", False), payload.get("completedAt"),
+                payload.get("priority", "medium")])
         async with get_conn() as conn:
             q = """
             INSERT INTO tasks (client_id, title, description, due_date, completed, completed_at, priority)
@@ -159,6 +336,66 @@ class Storage:
             res = await conn.execute("DELETE FROM tasks WHERE id = $1", id)
             return res.endswith("DELETE 1")
 
+    # --- Bulk mutations ---
+    async def bulk_mutate(self, table: str, ops: Dict) -> Dict:
+        batch = bulk.Batch(table, ops)
+        types = bulk.COLUMNS[table]
+        results: List[Dict] = []
+        async with get_conn() as conn:
+            async with conn.transaction():
+                created = []
+                if batch.creates:
+                    cols = list(types)
+                    arrays = ", ".join(f"${i + 1}::{types[c]}[]" for i, c in enumerate(cols))
+                    rows = await conn.fetch(
+                        f"INSERT INTO {table} ({', '.join(cols)}) SELECT * FROM unnest({arrays}) RETURNING *",
+                        *[list(col) for col in zip(*batch.creates)])
+                    created = [record_to_dict(r) for r in rows]
+                    results += [{"op": "create", "id": r["id"], "status": "created"} for r in created]
+                hit = set()
+                for shape, rows in batch.updates.items():
+                    arrays = ", ".join(f"${i + 2}::{types[c]}[]" for i, c in enumerate(shape))
+                    sets = ", ".join(f"{c} = u.{c}" for c in shape)
+                    updated = await conn.fetch(f"""
+                        UPDATE {table} t SET {sets}
+                        FROM unnest($1::varchar[], {arrays}) AS u(id, {', '.join(shape)})
+                        WHERE t.id = u.id RETURNING t.id
+                    """, *[list(col) for col in zip(*rows)])
+                    hit.update(r["id"] for r in updated)
+                results += bulk.outcomes("update", batch.update_ids, hit)
+                if batch.complete:
+                    done = await conn.fetch(
+                        f"UPDATE {table} SET completed = TRUE, completed_at = NOW() WHERE id = ANY($1::varchar[]) RETURNING id",
+                        batch.complete)
+                    results += bulk.outcomes("complete", batch.complete, {r["id"] for r in done})
+                if batch.delete:
+                    gone = await conn.fetch(f"DELETE FROM {table} WHERE id = ANY($1::varchar[]) RETURNING id",
+                                            batch.delete)
+                    results += bulk.outcomes("delete", batch.delete, {r["id"] for r in gone})
+        return {"created": created, "results": results}
+
+    # --- Agenda ---
+    async def get_agenda(self, start: datetime, end: datetime, include_completed: bool = False,
+                         limit: int = 500) -> List[Dict]:
+        # Each branch is a range scan on its due-date index (scheduler.py);
+        # the merge only sorts what falls in the window
+        async with get_conn() as conn:
+            rows = await conn.fetch("""
+                (SELECT 'follow_up' AS kind, id, client_id, title, scheduled_date AS due_at,
+                        completed, type AS detail
+                 FROM follow_ups
+                 WHERE scheduled_date >= $1 AND scheduled_date < $2 AND ($3 OR completed IS NOT TRUE)
+                 ORDER BY scheduled_date LIMIT $4)
+                UNION ALL
+                (SELECT 'task', id, client_id, title, due_date, completed, priority
+                 FROM tasks
+                 WHERE due_date >= $1 AND due_date < $2 AND ($3 OR completed IS NOT TRUE)
+                 ORDER BY due_date LIMIT $4)
+                ORDER BY due_at, id
+                LIMIT $4
+            """, start, end, include_completed, limit)
+            return [record_to_dict(r) for r in rows]
+
     # --- Interactions ---
     async def get_interactions(self) -> List[Dict]:
         async with get_conn() as conn:
@@ -171,6 +408,10 @@ class Storage:
             return [record_to_dict(r) for r in rows]
 
     async def create_interaction(self, payload: Dict) -> Dict:
+        if self.coalescer:
+            return await self.coalescer.insert("interactions", [
+                payload.get("clientId"), payload.get("type"),
+                payload.get("subject"), payload.get("notes")])
         async with get_conn() as conn:
             q = """
             INSERT INTO interactions (client_id, type, subject, notes)
@@ -197,53 +438,84 @@ class Storage:
             return record_to_dict(row)
 
     # --- Sales & analytics ---
-    async def get_sales(self) -> List[Dict]:
-        async with get_conn() as conn:
-            rows = await conn.fetch("SELECT * FROM sales ORDER BY date DESC")
-            return [record_to_dict(r) for r in rows]
-
-    async def get_sales_by_category(self):
-        async with get_conn() as conn:
-            rows = await conn.fetch("""
-                SELECT category, SUM(total_amount) as total, COUNT(*) as count
-                FROM sales
-                GROUP BY category
-                ORDER BY total DESC
-            """)
-            return [record_to_dict(r) for r in rows]
-
-    async def get_sales_by_payment_method(self):
-        async with get_conn() as conn:
-            rows = await conn.fetch("""
-                SELECT payment_method as method, SUM(total_amount) as total, COUNT(*) as count
-                FROM sales
-                GROUP BY payment_method
-                ORDER BY total DESC
-            """)
-            return [record_to_dict(r) for r in rows]
-
-    async def get_sales_by_demographic(self):
-        async with get_conn() as conn:
-            # Age buckets example
-            rows = await conn.fetch("""
-                SELECT
-                  customer_gender as gender,
-                  CASE
-                    WHEN customer_age < 25 THEN 'under_25'
-                    WHEN customer_age BETWEEN 25 AND 44 THEN '25_44'
-                    WHEN customer_age BETWEEN 45 AND 64 THEN '45_64'
-                    ELSE '65_plus'
-                  END AS age_group,
-                  SUM(total_amount) as total,
-                  COUNT(*) as count
-                FROM sales
-                GROUP BY customer_gender, age_group
-                ORDER BY total DESC
-            """)
-            return [record_to_dict(r) for r in rows]
+    # sales, inventory and customer_traffic live on the shard that owns the
+    # store (see shards.py): writes go to that shard, table-wide reads fan out
+    # and the per-shard SUM/COUNT partials are merged here.
+    async def get_sales(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                        include_archive: bool = False) -> List[Dict]:
+        where, args = date_range_clause(start, end)
+        rows = await router.fetch_all(f"SELECT * FROM sales {where} ORDER BY date DESC", *args)
+        rows = [record_to_dict(r) for r in rows]
+        if include_archive:
+            import tiering  # cold tier is only loaded when asked for
+            rows.extend(await asyncio.to_thread(tiering.archived_rows, "sales", start, end))
+        if include_archive or len(router.names) > 1:
+            rows.sort(key=lambda r: r["date"], reverse=True)
+        return rows
+
+    async def get_sales_by_category(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                    include_archive: bool = False):
+        where, args = date_range_clause(start, end)
+        rows = await router.fetch_all(f"""
+            SELECT category, SUM(total_amount) as total, COUNT(*) as count
+            FROM sales
+            {where}
+            GROUP BY category
+            ORDER BY total DESC
+        """, *args)
+        rows = merge_shard_rows(rows, ("category",), ("total", "count"), "total")
+        if include_archive:
+            import tiering
+            extra = await asyncio.to_thread(tiering.archived_rollup, "sales", "category", start, end)
+            rows = merge_rollup(rows, extra, ("category",), ("total", "count"), "total")
+        return rows
+
+    async def get_sales_by_payment_method(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                          include_archive: bool = False):
+        where, args = date_range_clause(start, end)
+        rows = await router.fetch_all(f"""
+            SELECT payment_method as method, SUM(total_amount) as total, COUNT(*) as count
+            FROM sales
+            {where}
+            GROUP BY payment_method
+            ORDER BY total DESC
+        """, *args)
+        rows = merge_shard_rows(rows, ("method",), ("total", "count"), "total")
+        if include_archive:
+            import tiering
+            extra = await asyncio.to_thread(tiering.archived_rollup, "sales", "payment_method", start, end)
+            rows = merge_rollup(rows, extra, ("method",), ("total", "count"), "total")
+        return rows
+
+    async def get_sales_by_demographic(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                       include_archive: bool = False):
+        where, args = date_range_clause(start, end)
+        # Age buckets example
+        rows = await router.fetch_all(f"""
+            SELECT
+              customer_gender as gender,
+              CASE
+                WHEN customer_age < 25 THEN 'under_25'
+                WHEN customer_age BETWEEN 25 AND 44 THEN '25_44'
+                WHEN customer_age BETWEEN 45 AND 64 THEN '45_64'
+                ELSE '65_plus'
+              END AS age_group,
+              SUM(total_amount) as total,
+              COUNT(*) as count
+            FROM sales
+            {where}
+            GROUP BY customer_gender, age_group
+            ORDER BY total DESC
+        """, *args)
+        rows = merge_shard_rows(rows, ("gender", "age_group"), ("total", "count"), "total")
+        if include_archive:
+            import tiering
+            extra = await asyncio.to_thread(tiering.archived_rollup, "sales", "demographic", start, end)
+            rows = merge_rollup(rows, extra, ("gender", "age_group"), ("total", "count"), "total")
+        return rows
 
     async def create_sales(self, payload: Dict) -> Dict:
-        async with get_conn() as conn:
+        async with router.conn_for(payload.get("supermarketId")) as conn:
             q = """
             INSERT INTO sales (supermarket_id, date, category, product, quantity, unit_price, total_amount, payment_method, customer_age, customer_gender)
             VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
@@ -264,22 +536,28 @@ class Storage:
 
     # --- Inventory ---
     async def get_inventory(self) -> List[Dict]:
-        async with get_conn() as conn:
-            rows = await conn.fetch("SELECT * FROM inventory ORDER BY product")
-            return [record_to_dict(r) for r in rows]
+        rows = [record_to_dict(r) for r in await router.fetch_all("SELECT * FROM inventory ORDER BY product")]
+        if len(router.names) > 1:
+            rows.sort(key=lambda r: r["product"])
+        return rows
 
     async def get_inventory_by_supermarket(self, supermarket_id: str) -> List[Dict]:
-        async with get_conn() as conn:
+        async with router.conn_for(supermarket_id) as conn:
             rows = await conn.fetch("SELECT * FROM inventory WHERE supermarket_id = $1 ORDER BY product", supermarket_id)
             return [record_to_dict(r) for r in rows]
 
     async def get_low_stock_items(self) -> List[Dict]:
-        async with get_conn() as conn:
-            rows = await conn.fetch("SELECT * FROM inventory WHERE current_stock <= minimum_stock ORDER BY current_stock ASC")
-            return [record_to_dict(r) for r in rows]
+        # Served by the partial index inventory_low_stock (inventory_engine.py),
+        # which only holds the rows matching this predicate
+        rows = await router.fetch_all(
+            "SELECT * FROM inventory WHERE current_stock <= minimum_stock ORDER BY current_stock ASC")
+        rows = [record_to_dict(r) for r in rows]
+        if len(router.names) > 1:
+            rows.sort(key=lambda r: r["current_stock"])
+        return rows
 
     async def create_inventory(self, payload: Dict) -> Dict:
-        async with get_conn() as conn:
+        async with router.conn_for(payload.get("supermarketId")) as conn:
             q = """
             INSERT INTO inventory (supermarket_id, product, category, current_stock, minimum_stock, last_restocked, supplier, cost_price, selling_price)
             VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9) RETURNING *;
@@ -298,36 +576,98 @@ class Storage:
 
     # --- Customer traffic / analytics ---
     async def get_customer_traffic(self) -> List[Dict]:
-        async with get_conn() as conn:
-            rows = await conn.fetch("SELECT * FROM customer_traffic ORDER BY date DESC, hour DESC")
-            return [record_to_dict(r) for r in rows]
-
-    async def get_traffic_by_hour(self):
-        async with get_conn() as conn:
-            rows = await conn.fetch("""
-                SELECT hour, SUM(visitor_count) as totalVisitors, AVG(avg_transaction_value) as avgTransaction
+        rows = await router.fetch_all("SELECT * FROM customer_traffic ORDER BY date DESC, hour DESC")
+        rows = [record_to_dict(r) for r in rows]
+        if len(router.names) > 1:
+            rows.sort(key=lambda r: (r["date"], r["hour"]), reverse=True)
+        return rows
+
+    async def get_traffic_by_hour(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                  include_archive: bool = False):
+        where, args = date_range_clause(start, end)
+        if not include_archive and not router.enabled:
+            async with get_conn() as conn:
+                rows = await conn.fetch(f"""
+                    SELECT hour, SUM(visitor_count) as totalVisitors, AVG(avg_transaction_value) as avgTransaction
+                    FROM customer_traffic
+                    {where}
+                    GROUP BY hour
+                    ORDER BY hour
+                """, *args)
+                return [record_to_dict(r) for r in rows]
+        # Averages only merge as sum/count, so fetch those and divide after merging
+        rows = await router.fetch_all(f"""
+            SELECT hour, SUM(visitor_count) as totalVisitors,
+                   SUM(avg_transaction_value) as sumTransaction, COUNT(*) as n
+            FROM customer_traffic
+            {where}
+            GROUP BY hour
+        """, *args)
+        merged = merge_shard_rows(rows, ("hour",), ("totalvisitors", "sumtransaction", "n"),
+                                  "hour", reverse=False)
+        if include_archive:
+            import tiering
+            extra = await asyncio.to_thread(tiering.archived_rollup, "customer_traffic", "hour", start, end)
+            merged = merge_rollup(merged, extra, ("hour",),
+                                  ("totalvisitors", "sumtransaction", "n"), "hour", reverse=False)
+        return [{"hour": r["hour"], "totalvisitors": r["totalvisitors"],
+                 "avgtransaction": r["sumtransaction"] / r["n"] if r["n"] else None}
+                for r in merged]
+
+    async def get_traffic_by_supermarket(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                         include_archive: bool = False):
+        if not router.enabled:
+            where, args = date_range_clause(start, end, "ct.date")
+            async with get_conn() as conn:
+                rows = await conn.fetch(f"""
+                    SELECT ct.supermarket_id, s.name, SUM(ct.visitor_count) as totalVisitors
+                    FROM customer_traffic ct
+                    JOIN supermarkets s ON s.id = ct.supermarket_id
+                    {where}
+                    GROUP BY ct.supermarket_id, s.name
+                    ORDER BY totalVisitors DESC
+                """, *args)
+            rows = [record_to_dict(r) for r in rows]
+        else:
+            # supermarkets stays on the home database, so names are joined in afterwards
+            where, args = date_range_clause(start, end)
+            rows = await router.fetch_all(f"""
+                SELECT supermarket_id, SUM(visitor_count) as totalVisitors
                 FROM customer_traffic
-                GROUP BY hour
-                ORDER BY hour
-            """)
-            return [record_to_dict(r) for r in rows]
-
-    async def get_traffic_by_supermarket(self):
-        async with get_conn() as conn:
-            rows = await conn.fetch("""
-                SELECT ct.supermarket_id, s.name, SUM(ct.visitor_count) as totalVisitors
-                FROM customer_traffic ct
-                JOIN supermarkets s ON s.id = ct.supermarket_id
-                GROUP BY ct.supermarket_id, s.name
-                ORDER BY totalVisitors DESC
-            """)
-            return [record_to_dict(r) for r in rows]
+                {where}
+                GROUP BY supermarket_id
+            """, *args)
+            rows = merge_shard_rows(rows, ("supermarket_id",), ("totalvisitors",), "totalvisitors")
+        if include_archive:
+            import tiering
+            extra = await asyncio.to_thread(tiering.archived_rollup, "customer_traffic", "supermarket", start, end)
+            rows = merge_rollup(rows, extra, ("supermarket_id",), ("totalvisitors",), "totalvisitors")
+        missing = [r["supermarket_id"] for r in rows if "name" not in r]
+        if missing:
+            async with get_conn() as conn:
+                names = dict(await conn.fetch(
+                    "SELECT id, name FROM supermarkets WHERE id = ANY($1)", missing))
+            for r in rows:
+                if "name" not in r:
+                    r["name"] = names.get(r["supermarket_id"])
+        return rows
 
     async def create_customer_traffic(self, payload: Dict) -> Dict:
-        async with get_conn() as conn:
+        async with router.conn_for(payload.get("supermarketId")) as conn:
+            # One row per (store, day, hour): a repeat report adds to the existing row
             q = """
-            INSERT INTO customer_traffic (supermarket_id, date, hour, visitor_count, avg_transaction_value)
-            VALUES ($1,$2,$3,$4,$5) RETURNING *;
+            INSERT INTO customer_traffic AS ct (supermarket_id, date, hour, visitor_count, avg_transaction_value)
+            VALUES ($1, date_trunc('day', $2::timestamp), $3, $4, $5)
+            ON CONFLICT (supermarket_id, date, hour) DO UPDATE SET
+              visitor_count = ct.visitor_count + EXCLUDED.visitor_count,
+              avg_transaction_value = CASE
+                WHEN ct.visitor_count + EXCLUDED.visitor_count > 0 THEN
+                  ROUND((ct.avg_transaction_value::numeric * ct.visitor_count
+                         + EXCLUDED.avg_transaction_value::numeric * EXCLUDED.visitor_count)
+                        / (ct.visitor_count + EXCLUDED.visitor_count))::int
+                ELSE EXCLUDED.avg_transaction_value
+              END
+            RETURNING *;
             """
             row = await conn.fetchrow(q,
                                       payload.get("supermarketId"),
@@ -337,5 +677,11 @@ class Storage:
                                       payload.get("avgTransactionValue"))
             return record_to_dict(row)
 # create module-level instance for import
-storage = Storage()
+# STORAGE_BACKEND=sqlite runs on an embedded database file instead of Postgres
+EMBEDDED = os.environ.get("STORAGE_BACKEND", "postgres") == "sqlite"
+if EMBEDDED:
+    import sqlite_storage
+    storage: StorageBackend = sqlite_storage.from_env()
+else:
+    storage = Storage()
 
@@ -0,0 +1,358 @@
+# stream.py
+# Live dashboard updates over Server-Sent Events (/api/stream/dashboard).
+#
+# Statement-level triggers on sales, inventory, customer_traffic, follow_ups
+# and tasks NOTIFY the "dashboard" channel with the table name (Postgres
+# folds duplicates within a transaction, so a bulk insert is one
+# notification). Each worker keeps one LISTEN connection per database (home
+# plus shards) and, when tables are reported dirty, recomputes only the
+# affected sections once, diffs them against the last published values and
+# fans the changes out to its subscribers. Overdue counts also move with the
+# clock, so the CRM sections are recomputed every RECHECK_SECONDS.
+#
+# Backpressure: a subscriber never has a queue. It holds at most one pending
+# value per section; newer values overwrite older ones (low-stock
+# transitions are merged by item id), so a slow client receives fewer, more
+# up-to-date events and memory stays bounded however far behind it falls.
+# Idle streams get a comment line every HEARTBEAT_SECONDS to keep proxies and
+# load balancers from closing them.
+#
+# Due and overdue reminders from the scheduler (scheduler.py) arrive on the
+# "reminders" channel of the home database and are sent as a "reminders"
+# list; a lagging subscriber keeps the newest MAX_PENDING_REMINDERS.
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+import asyncpg
+from db import DATABASE_URL, get_conn
+from metrics import metrics
+from shards import router
+
+CHANNEL = "dashboard"
+REMINDER_CHANNEL = "reminders"
+STREAMED_TABLES = ("sales", "inventory", "customer_traffic", "follow_ups", "tasks")
+
+HEARTBEAT_SECONDS = float(os.environ.get("STREAM_HEARTBEAT_SECONDS", "15"))
+DEBOUNCE_SECONDS = float(os.environ.get("STREAM_DEBOUNCE_SECONDS", "0.5"))
+RECHECK_SECONDS = float(os.environ.get("STREAM_RECHECK_SECONDS", "60"))
+MAX_SUBSCRIBERS = int(os.environ.get("STREAM_MAX_SUBSCRIBERS", "5000"))
+MAX_PENDING_REMINDERS = int(os.environ.get("STREAM_MAX_PENDING_REMINDERS", "100"))
+
+_INSTALL_LOCK = 728_005
+
+NOTIFY_DDL = f"""
+CREATE OR REPLACE FUNCTION notify_dashboard() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# table -> sections it feeds
+SECTIONS = {
+    "sales": ("sales_today",),
+    "customer_traffic": ("traffic_today",),
+    "inventory": ("low_stock",),
+    "follow_ups": ("follow_ups",),
+    "tasks": ("tasks",),
+}
+CLOCK_SECTIONS = ("follow_ups", "tasks")
+
+
+async def install_dashboard_notify(conn):
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", _INSTALL_LOCK)
+        await conn.execute(NOTIFY_DDL)
+        for table in STREAMED_TABLES:
+            if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", table):
+                continue  # CRM tables only exist on the home database
+            await conn.execute(f"DROP TRIGGER IF EXISTS {table}_notify_dashboard ON {table}")
+            await conn.execute(f"""
+                CREATE TRIGGER {table}_notify_dashboard
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH STATEMENT EXECUTE PROCEDURE notify_dashboard()
+            """)
+
+
+async def install_all():
+    async with get_conn() as conn:
+        await install_dashboard_notify(conn)
+    for name in router.names:
+        async with router.conn(name) as conn:
+            await install_dashboard_notify(conn)
+
+
+# --- Section queries ---
+# Stored timestamps are naive UTC, so "today" is the UTC day
+def _today() -> datetime:
+    return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def _sales_today() -> Dict:
+    today = _today()
+    rows = await router.fetch_all("""
+        SELECT COALESCE(SUM(total_amount), 0) AS revenue, COUNT(*) AS transactions
+        FROM sales WHERE date >= $1 AND date < $2
+    """, today, today + timedelta(days=1))
+    revenue = sum(r["revenue"] for r in rows)
+    transactions = sum(r["transactions"] for r in rows)
+    return {"revenue": revenue, "transactions": transactions,
+            "avg_ticket": round(revenue / transactions, 2) if transactions else None}
+
+
+async def _traffic_today() -> Dict:
+    today = _today()
+    rows = await router.fetch_all("""
+        SELECT COALESCE(SUM(visitor_count), 0) AS visitors
+        FROM customer_traffic WHERE date >= $1 AND date < $2
+    """, today, today + timedelta(days=1))
+    return {"visitors": sum(r["visitors"] for r in rows)}
+
+
+async def _low_stock() -> Dict[str, Dict]:
+    rows = await router.fetch_all("""
+        SELECT id, supermarket_id, product, current_stock, minimum_stock
+        FROM inventory WHERE current_stock <= minimum_stock
+    """)
+    return {r["id"]: dict(r) for r in rows}
+
+
+async def _follow_ups() -> Dict:
+    async with get_conn() as conn:
+        row = await conn.fetchrow("""
+            SELECT COUNT(*) FILTER (WHERE scheduled_date < NOW()) AS overdue,
+                   COUNT(*) FILTER (WHERE scheduled_date >= NOW() AND scheduled_date < $1) AS due_today
+            FROM follow_ups WHERE NOT completed
+        """, _today() + timedelta(days=1))
+    return dict(row)
+
+
+async def _tasks() -> Dict:
+    async with get_conn() as conn:
+        row = await conn.fetchrow("""
+            SELECT COUNT(*) AS open, COUNT(*) FILTER (WHERE due_date < NOW()) AS overdue
+            FROM tasks WHERE NOT completed
+        """)
+    return dict(row)
+
+
+COMPUTE = {
+    "sales_today": _sales_today,
+    "traffic_today": _traffic_today,
+    "low_stock": _low_stock,
+    "follow_ups": _follow_ups,
+    "tasks": _tasks,
+}
+
+
+def _low_stock_delta(old: Dict[str, Dict], new: Dict[str, Dict]) -> Optional[Dict]:
+    entered = {i: new[i] for i in new.keys() - old.keys()}
+    changed = {i: new[i] for i in new.keys() & old.keys() if new[i] != old[i]}
+    left = sorted(old.keys() - new.keys())
+    if not (entered or changed or left):
+        return None
+    return {"count": len(new), "entered": {**entered, **changed}, "left": left}
+
+
+# --- Subscribers ---
+class Subscriber:
+    def __init__(self):
+        self.pending: Dict[str, Any] = {}
+        self.wakeup = asyncio.Event()
+
+    def offer(self, section: str, value: Any):
+        prev = self.pending.get(section)
+        if section == "low_stock" and prev is not None:
+            # Merge transitions so nothing is lost when the client lags
+            entered = {i: v for i, v in prev["entered"].items() if i not in value["left"]}
+            entered.update(value["entered"])
+            left = sorted((set(prev["left"]) - value["entered"].keys()) | set(value["left"]))
+            value = {"count": value["count"], "entered": entered, "left": left}
+            metrics.incr("stream.conflated")
+        elif section == "reminders":
+            value = ((prev or []) + value)[-MAX_PENDING_REMINDERS:]
+        elif prev is not None:
+            metrics.incr("stream.conflated")
+        self.pending[section] = value
+        self.wakeup.set()
+
+    def take(self) -> Dict[str, Any]:
+        pending, self.pending = self.pending, {}
+        self.wakeup.clear()
+        return pending
+
+
+class DashboardHub:
+    def __init__(self):
+        self.state: Dict[str, Any] = {}
+        self.version = 0
+        self.subscribers: Set[Subscriber] = set()
+        self._dirty: Set[str] = set()
+        self._dirty_event = asyncio.Event()
+        self._listeners: List[asyncpg.Connection] = []
+        self._tasks: List[asyncio.Task] = []
+        self._ready: Optional[asyncio.Future] = None
+
+    # --- Lifecycle ---
+    async def ensure_started(self):
+        if self._ready is None:
+            self._ready = asyncio.get_running_loop().create_future()
+            self._tasks = [asyncio.create_task(self._run())]
+        await asyncio.shield(self._ready)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await self._close_listeners()
+        self._tasks, self._ready = [], None
+
+    async def _close_listeners(self):
+        for conn in self._listeners:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        self._listeners = []
+
+    async def _listen(self):
+        await self._close_listeners()
+        for dsn in [DATABASE_URL] + [router.dsns[n] for n in router.names]:
+            conn = await asyncpg.connect(dsn)
+            await conn.add_listener(CHANNEL, self._on_notify)
+            if dsn == DATABASE_URL:
+                await conn.add_listener(REMINDER_CHANNEL, self._on_reminder)
+            self._listeners.append(conn)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self.mark_dirty(SECTIONS.get(payload, ()))
+
+    def _on_reminder(self, conn, pid, channel, payload):
+        try:
+            reminder = json.loads(payload)
+        except ValueError:
+            return
+        for sub in self.subscribers:
+            sub.offer("reminders", [reminder])
+        metrics.incr("stream.reminders")
+
+    def mark_dirty(self, sections):
+        self._dirty.update(sections)
+        if self._dirty:
+            self._dirty_event.set()
+
+    async def _run(self):
+        try:
+            await self._listen()
+            self.state = {s: await fn() for s, fn in COMPUTE.items()}
+            self._ready.set_result(None)
+        except Exception as e:
+            self._ready.set_exception(e)
+            self._ready = None
+            return
+        clock = asyncio.create_task(self._clock())
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._dirty_event.wait(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    await self._check_listeners()
+                    continue
+                await asyncio.sleep(DEBOUNCE_SECONDS)  # fold bursts of writes into one recompute
+                dirty, self._dirty = self._dirty, set()
+                self._dirty_event.clear()
+                try:
+                    await self._recompute(dirty)
+                except Exception as e:
+                    print(f"dashboard recompute failed: {e!r}")
+                    self.mark_dirty(dirty)
+        finally:
+            clock.cancel()
+
+    async def _clock(self):
+        while True:
+            await asyncio.sleep(RECHECK_SECONDS)
+            self.mark_dirty(CLOCK_SECTIONS)
+
+    async def _check_listeners(self):
+        # A dropped LISTEN connection loses notifications: reconnect and
+        # recompute everything that may have been missed
+        try:
+            for conn in self._listeners:
+                await conn.execute("SELECT 1")
+        except Exception:
+            metrics.incr("stream.listener_reconnects")
+            try:
+                await self._listen()
+            except Exception as e:
+                print(f"dashboard listener reconnect failed: {e!r}")
+                return
+            self.mark_dirty(COMPUTE.keys())
+
+    async def _recompute(self, sections: Set[str]):
+        deltas: Dict[str, Any] = {}
+        with metrics.timer("stream.recompute_seconds"):
+            for section in sections:
+                value = await COMPUTE[section]()
+                old = self.state.get(section)
+                if section == "low_stock":
+                    delta = _low_stock_delta(old or {}, value)
+                else:
+                    delta = value if value != old else None
+                self.state[section] = value
+                if delta is not None:
+                    deltas[section] = delta
+        if deltas:
+            self.version += 1
+            for sub in self.subscribers:
+                for section, delta in deltas.items():
+                    sub.offer(section, delta)
+            metrics.incr("stream.published")
+
+    def full_state(self) -> Dict[str, Any]:
+        state = dict(self.state)
+        low = state.get("low_stock", {})
+        state["low_stock"] = {"count": len(low), "entered": low, "left": []}
+        return state
+
+    # --- Subscriptions ---
+    def has_capacity(self) -> bool:
+        return len(self.subscribers) < MAX_SUBSCRIBERS
+
+    def subscribe(self) -> Subscriber:
+        sub = Subscriber()
+        self.subscribers.add(sub)
+        metrics.set_gauge("stream.subscribers", len(self.subscribers))
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        self.subscribers.discard(sub)
+        metrics.set_gauge("stream.subscribers", len(self.subscribers))
+
+
+def sse(event: str, data: Any, id: Optional[int] = None) -> str:
+    head = f"id: {id}\n" if id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def event_stream():
+    """SSE body: the full state once, then merged deltas and heartbeats."""
+    # Subscribing inside the generator ties the subscription to the body's
+    # lifetime: the finally runs however the stream ends
+    sub = hub.subscribe()
+    try:
+        yield "retry: 3000\n\n" + sse("snapshot", hub.full_state(), hub.version)
+        while True:
+            try:
+                await asyncio.wait_for(sub.wakeup.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            yield sse("delta", sub.take(), hub.version)
+    finally:
+        hub.unsubscribe(sub)
+
+
+hub = DashboardHub()
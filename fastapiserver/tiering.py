@@ -0,0 +1,356 @@
+# tiering.py
+# Hot/cold tiering for sales and customer_traffic.
+#
+# Whole months older than the horizon are moved out of Postgres into
+# compressed columnar files under ARCHIVE_ROOT:
+#
+#   <root>/<table>/<YYYY-MM>/part-<n>/
+#       <column>.json.gz     one gzip'd JSON array per column
+#       rollups.json         per-day pre-aggregates used by the analytics queries
+#
+# A month is archived in parts of at most ARCHIVE_BATCH rows, one short
+# transaction each (and more parts when late rows arrive after a first run).
+# partitions.py retention goes through here too, so the cold tier has one
+# format and one root. The rows are deleted in the same transaction that
+# records the part in archive_parts; the part directory is written as "<part>.tmp" first and only
+# renamed once that transaction commits, and recover() settles any leftovers
+# after a crash, so a row is never counted both hot and cold.
+#
+# Each shard (shards.py) is archived in turn, under its own lock and with its
+# own archive_parts; its parts are named part-<shard>-<n> so that recovery on
+# one shard never touches another's. Unsharded, the home database writes
+# part-<n>. Readers take every part of a month.
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import shutil
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from shards import router
+
+ARCHIVE_ROOT = os.environ.get("ARCHIVE_ROOT", "cold_storage")
+HORIZON_MONTHS = int(os.environ.get("ARCHIVE_HORIZON_MONTHS", "13"))
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH", "50000"))
+
+TIERED_TABLES = ("sales", "customer_traffic")
+
+# Rollup dimensions per table: name -> (key columns, summed columns).
+# Every measure is additive so parts and days merge by plain addition;
+# averages are kept as (sum, count).
+ROLLUPS = {
+    "sales": {
+        "category": (("category",), ("total_amount", "1")),
+        "payment_method": (("payment_method",), ("total_amount", "1")),
+        "demographic": (("customer_gender", "age_group"), ("total_amount", "1")),
+    },
+    "customer_traffic": {
+        "hour": (("hour",), ("visitor_count", "avg_transaction_value", "1")),
+        "supermarket": (("supermarket_id",), ("visitor_count",)),
+    },
+}
+
+_ARCHIVE_LOCK = 728_002
+
+ARCHIVE_PARTS_DDL = """
+CREATE TABLE IF NOT EXISTS archive_parts (
+  table_name TEXT NOT NULL,
+  month DATE NOT NULL,
+  part TEXT NOT NULL,
+  row_count INTEGER NOT NULL,
+  archived_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (table_name, month, part)
+);
+"""
+
+
+def age_group(age: Optional[int]) -> str:
+    # Mirrors the CASE in Storage.get_sales_by_demographic (NULL falls to ELSE)
+    if age is None:
+        return "65_plus"
+    if age < 25:
+        return "under_25"
+    if age <= 44:
+        return "25_44"
+    if age <= 64:
+        return "45_64"
+    return "65_plus"
+
+
+def _month_dir(table: str, month: date) -> str:
+    return os.path.join(ARCHIVE_ROOT, table, f"{month.year:04d}-{month.month:02d}")
+
+
+def _add_months(d: date, n: int) -> date:
+    m = d.month - 1 + n
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def _jsonable(v):
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    return v
+
+
+def _rollup_key_values(table: str, row: Dict, keys: Tuple[str, ...]):
+    out = []
+    for k in keys:
+        if k == "age_group":
+            out.append(age_group(row.get("customer_age")))
+        else:
+            out.append(row.get(k))
+    return out
+
+
+def build_rollups(table: str, rows: Iterable[Dict]) -> Dict:
+    """Per-day additive aggregates: {day: {dimension: [[key..., sum...], ...]}}."""
+    acc = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+    for row in rows:
+        day = row["date"].date().isoformat()
+        for dim, (keys, measures) in ROLLUPS[table].items():
+            key = json.dumps(_rollup_key_values(table, row, keys))
+            sums = acc[day][dim][key]
+            if not sums:
+                sums.extend([0] * len(measures))
+            for i, m in enumerate(measures):
+                sums[i] += 1 if m == "1" else (row.get(m) or 0)
+    return {
+        day: {dim: [json.loads(k) + v for k, v in cells.items()] for dim, cells in dims.items()}
+        for day, dims in acc.items()
+    }
+
+
+def _write_part(path: str, rows: List[Dict], table: str):
+    os.makedirs(path)
+    columns = list(rows[0].keys()) if rows else []
+    for col in columns:
+        with gzip.open(os.path.join(path, f"{col}.json.gz"), "wt") as f:
+            json.dump([_jsonable(r[col]) for r in rows], f)
+    with open(os.path.join(path, "rollups.json"), "w") as f:
+        json.dump({"columns": columns, "rows": len(rows), "days": build_rollups(table, rows)}, f)
+
+
+# --- Archival job ---
+def _part_prefix(shard: Optional[str]) -> str:
+    return "part-" if shard is None else f"part-{shard}-"
+
+
+def _is_own_part(entry: str, shard: Optional[str]) -> bool:
+    prefix = _part_prefix(shard)
+    return entry.startswith(prefix) and entry[len(prefix):].split(".")[0].isdigit()
+
+
+async def recover(conn, shard: Optional[str] = None):
+    """Promote `shard`'s committed .tmp parts and delete its uncommitted ones."""
+    await conn.execute(ARCHIVE_PARTS_DDL)
+    committed = {(r["table_name"], r["month"], r["part"])
+                 for r in await conn.fetch("SELECT table_name, month, part FROM archive_parts")}
+    for table in TIERED_TABLES:
+        base = os.path.join(ARCHIVE_ROOT, table)
+        if not os.path.isdir(base):
+            continue
+        for month_name in os.listdir(base):
+            month = datetime.strptime(month_name, "%Y-%m").date()
+            month_path = os.path.join(base, month_name)
+            for entry in os.listdir(month_path):
+                if not entry.endswith(".tmp") or not _is_own_part(entry, shard):
+                    continue
+                part = entry[:-4]
+                tmp = os.path.join(month_path, entry)
+                if (table, month, part) in committed:
+                    os.rename(tmp, os.path.join(month_path, part))
+                else:
+                    shutil.rmtree(tmp)
+
+
+async def archive_month(conn, table: str, month: date, batch_size: int = ARCHIVE_BATCH,
+                        shard: Optional[str] = None) -> int:
+    moved = 0
+    while True:
+        n = await _archive_part(conn, table, month, batch_size, shard)
+        moved += n
+        if n < batch_size:
+            return moved
+
+
+async def _archive_part(conn, table: str, month: date, batch_size: int, shard: Optional[str]) -> int:
+    lo, hi = month, _add_months(month, 1)
+    month_path = _month_dir(table, month)
+    os.makedirs(month_path, exist_ok=True)
+    existing = [p for p in os.listdir(month_path) if _is_own_part(p, shard)]
+    part = f"{_part_prefix(shard)}{len(existing)}"
+    tmp = os.path.join(month_path, part + ".tmp")
+
+    async with conn.transaction():
+        # Archived rows stay in the rollup cube (cube.py) and are not
+        # deletes for change-feed consumers (changes.py)
+        await conn.execute("SET LOCAL cube.skip = 'on'; SET LOCAL change_log.skip = 'on'")
+        rows = await conn.fetch(f"""
+            DELETE FROM {table} WHERE (id, date) IN (
+              SELECT id, date FROM {table} WHERE date >= $1 AND date < $2 LIMIT $3
+            ) RETURNING *
+        """, lo, hi, batch_size)
+        if not rows:
+            return 0
+        rows = [dict(r) for r in rows]
+        # Files are written before commit: a failure here rolls the delete back
+        await asyncio.get_running_loop().run_in_executor(None, _write_part, tmp, rows, table)
+        await conn.execute(
+            "INSERT INTO archive_parts (table_name, month, part, row_count) VALUES ($1,$2,$3,$4)",
+            table, month, part, len(rows))
+    os.rename(tmp, os.path.join(month_path, part))
+    _rollup_cache.clear()
+    return len(rows)
+
+
+async def run_archival(horizon_months: int = HORIZON_MONTHS,
+                       tables: Tuple[str, ...] = TIERED_TABLES) -> Dict[str, int]:
+    """Archive every whole month older than the horizon, on every shard.
+
+    Single runner per database via advisory lock; a shard whose lock is held
+    elsewhere is skipped this round.
+    """
+    cutoff = _add_months(date.today().replace(day=1), -horizon_months)
+    moved: Dict[str, int] = {table: 0 for table in tables}
+    # One shard after another, so their part numbers are picked one at a time
+    for shard in router.names or [None]:
+        async with router.conn(shard) as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", _ARCHIVE_LOCK):
+                continue
+            try:
+                await recover(conn, shard)
+                for table in tables:
+                    months = await conn.fetch(
+                        f"SELECT DISTINCT date_trunc('month', date)::date AS m FROM {table} "
+                        f"WHERE date < $1 ORDER BY m", cutoff)
+                    for r in months:
+                        moved[table] += await archive_month(conn, table, r["m"], shard=shard)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", _ARCHIVE_LOCK)
+    return moved
+
+
+async def archival_loop(interval: float = 24 * 3600):
+    while True:
+        try:
+            await run_archival()
+        except Exception as e:  # keep the loop alive; retried next interval
+            print(f"archival failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+# --- Reading the cold tier ---
+_rollup_cache: Dict[str, Dict] = {}
+
+
+def _naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    # Archived dates are zone-less UTC, like the TIMESTAMP columns they came from
+    if dt is not None and dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _parts(table: str, start: Optional[datetime], end: Optional[datetime]):
+    base = os.path.join(ARCHIVE_ROOT, table)
+    if not os.path.isdir(base):
+        return
+    for month_name in sorted(os.listdir(base)):
+        month = datetime.strptime(month_name, "%Y-%m")
+        next_month = datetime.combine(_add_months(month.date(), 1), datetime.min.time())
+        if (end is not None and month >= end) or (start is not None and next_month <= start):
+            continue
+        month_path = os.path.join(base, month_name)
+        for part in sorted(os.listdir(month_path)):
+            if part.startswith("part-") and not part.endswith(".tmp"):
+                yield os.path.join(month_path, part)
+
+
+def _load_rollups(path: str) -> Dict:
+    cached = _rollup_cache.get(path)
+    if cached is None:
+        with open(os.path.join(path, "rollups.json")) as f:
+            cached = _rollup_cache[path] = json.load(f)
+    return cached
+
+
+def _load_rows(path: str) -> List[Dict]:
+    meta = _load_rollups(path)
+    cols = {}
+    for col in meta["columns"]:
+        with gzip.open(os.path.join(path, f"{col}.json.gz"), "rt") as f:
+            cols[col] = json.load(f)
+    for col in ("date", "created_at"):
+        if col in cols:
+            cols[col] = [datetime.fromisoformat(v) if v else None for v in cols[col]]
+    return [dict(zip(cols.keys(), values)) for values in zip(*cols.values())]
+
+
+def archived_rows(table: str, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None) -> List[Dict]:
+    start, end = _naive_utc(start), _naive_utc(end)
+    out = []
+    for path in _parts(table, start, end):
+        for row in _load_rows(path):
+            if (start is None or row["date"] >= start) and (end is None or row["date"] < end):
+                out.append(row)
+    return out
+
+
+def archived_rollup(table: str, dimension: str, start: Optional[datetime] = None,
+                    end: Optional[datetime] = None) -> Dict[tuple, List]:
+    """Sum one rollup dimension over the cold tier within [start, end).
+
+    Days wholly inside the window come straight from the stored rollups; a
+    day cut by the window edge is re-aggregated from the column files.
+    """
+    start, end = _naive_utc(start), _naive_utc(end)
+    keys, measures = ROLLUPS[table][dimension]
+    out: Dict[tuple, List] = {}
+
+    def add(key, sums):
+        cur = out.setdefault(tuple(key), [0] * len(measures))
+        for i, v in enumerate(sums):
+            cur[i] += v
+
+    for path in _parts(table, start, end):
+        meta = _load_rollups(path)
+        edge_days = set()
+        for day, dims in meta["days"].items():
+            day_start = datetime.fromisoformat(day)
+            day_end = day_start + timedelta(days=1)
+            if (start is not None and day_end <= start) or (end is not None and day_start >= end):
+                continue
+            if (start is not None and day_start < start) or (end is not None and day_end > end):
+                edge_days.add(day)
+                continue
+            for cell in dims.get(dimension, []):
+                add(cell[:len(keys)], cell[len(keys):])
+        if edge_days:
+            rows = [r for r in _load_rows(path)
+                    if r["date"].date().isoformat() in edge_days
+                    and (start is None or r["date"] >= start)
+                    and (end is None or r["date"] < end)]
+            for day, dims in build_rollups(table, rows).items():
+                for cell in dims.get(dimension, []):
+                    add(cell[:len(keys)], cell[len(keys):])
+    return out
+
+
+if __name__ == "__main__":
+    from db import init_db_pool, close_db_pool
+
+    parser = argparse.ArgumentParser(description="Move old sales/traffic rows to the cold tier")
+    parser.add_argument("--horizon-months", type=int, default=HORIZON_MONTHS)
+    args = parser.parse_args()
+
+    async def run():
+        await init_db_pool()
+        try:
+            print(await run_archival(args.horizon_months))
+        finally:
+            await router.close()
+            await close_db_pool()
+
+    asyncio.run(run())
@@ -0,0 +1,193 @@
+# traffic_ingest.py
+# In-memory aggregation of door-counter reports before they reach
+# customer_traffic.
+#
+# Reports are folded into one cell per (supermarket_id, day, hour): visitor
+# counts are summed and avg_transaction_value is kept as a visitor-weighted
+# running mean. A periodic flush upserts the cells with
+# INSERT ... ON CONFLICT DO UPDATE, adding to whatever the row already holds,
+# so the table grows with stores x hours rather than with report volume.
+# Cells that fail to flush are merged back and retried; the shutdown hook
+# drains the buffer before the pool closes.
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+from db import get_conn
+from shards import router
+from metrics import metrics
+
+UNIQUE_INDEX = "customer_traffic_store_date_hour"
+
+_MIGRATION_LOCK = 728_003
+
+# One-time compaction of rows that would violate the (store, day, hour) key
+COMPACT_SQL = f"""
+CREATE TEMP TABLE _traffic_merge ON COMMIT DROP AS
+SELECT supermarket_id, date_trunc('day', date) AS date, hour,
+       SUM(visitor_count)::int AS visitor_count,
+       COALESCE(ROUND(SUM(avg_transaction_value::numeric * visitor_count)
+                      / NULLIF(SUM(visitor_count), 0)),
+                MAX(avg_transaction_value))::int AS avg_transaction_value,
+       MIN(created_at) AS created_at
+FROM customer_traffic
+GROUP BY 1, 2, 3
+HAVING COUNT(*) > 1 OR bool_or(date <> date_trunc('day', date));
+
+DELETE FROM customer_traffic ct USING _traffic_merge m
+WHERE ct.supermarket_id = m.supermarket_id
+  AND date_trunc('day', ct.date) = m.date
+  AND ct.hour = m.hour;
+
+INSERT INTO customer_traffic (supermarket_id, date, hour, visitor_count, avg_transaction_value, created_at)
+SELECT supermarket_id, date, hour, visitor_count, avg_transaction_value, created_at FROM _traffic_merge;
+
+CREATE UNIQUE INDEX IF NOT EXISTS {UNIQUE_INDEX} ON customer_traffic (supermarket_id, date, hour);
+"""
+
+UPSERT_SQL = """
+INSERT INTO customer_traffic AS ct (supermarket_id, date, hour, visitor_count, avg_transaction_value)
+SELECT * FROM unnest($1::varchar[], $2::timestamp[], $3::int[], $4::int[], $5::int[])
+ON CONFLICT (supermarket_id, date, hour) DO UPDATE SET
+  visitor_count = ct.visitor_count + EXCLUDED.visitor_count,
+  avg_transaction_value = CASE
+    WHEN ct.visitor_count + EXCLUDED.visitor_count > 0 THEN
+      ROUND((ct.avg_transaction_value::numeric * ct.visitor_count
+             + EXCLUDED.avg_transaction_value::numeric * EXCLUDED.visitor_count)
+            / (ct.visitor_count + EXCLUDED.visitor_count))::int
+    ELSE EXCLUDED.avg_transaction_value
+  END
+"""
+
+
+async def ensure_traffic_unique_key():
+    async with get_conn() as conn:
+        if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", UNIQUE_INDEX):
+            return
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATION_LOCK)
+            if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", UNIQUE_INDEX):
+                return
+            await conn.execute(COMPACT_SQL)
+
+
+Key = Tuple[str, datetime, int]
+
+
+class _Cell:
+    __slots__ = ("visitors", "value_weight", "last_value")
+
+    def __init__(self):
+        self.visitors = 0
+        self.value_weight = 0.0  # sum of avg_transaction_value * visitors
+        self.last_value = 0
+
+    def add(self, visitors: int, avg_value: int):
+        self.visitors += visitors
+        self.value_weight += avg_value * visitors
+        self.last_value = avg_value
+
+    def merge(self, other: "_Cell"):
+        self.visitors += other.visitors
+        self.value_weight += other.value_weight
+        self.last_value = other.last_value
+
+    @property
+    def avg_value(self) -> int:
+        if self.visitors > 0:
+            return round(self.value_weight / self.visitors)
+        return self.last_value
+
+
+class TrafficAggregator:
+    def __init__(self, flush_interval: float = 5.0):
+        self.flush_interval = flush_interval
+        self._cells: Dict[Key, _Cell] = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._stopping = asyncio.Event()
+
+    def add(self, payload: Dict):
+        """Fold one report (CustomerTrafficCreate fields) into the buffer."""
+        when = payload["date"]
+        if when.tzinfo is not None:
+            when = when.astimezone(timezone.utc).replace(tzinfo=None)
+        day = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        key = (payload["supermarketId"], day, payload["hour"])
+        cell = self._cells.get(key)
+        if cell is None:
+            cell = self._cells[key] = _Cell()
+        cell.add(payload["visitorCount"], payload["avgTransactionValue"])
+        metrics.incr("traffic.reports")
+
+    def add_many(self, payloads: Iterable[Dict]) -> int:
+        n = 0
+        for p in payloads:
+            self.add(p)
+            n += 1
+        metrics.set_gauge("traffic.buffered_cells", len(self._cells))
+        return n
+
+    async def flush(self) -> int:
+        async with self._lock:
+            cells, self._cells = self._cells, {}
+            if not cells:
+                return 0
+            by_shard: Dict[str, List[Key]] = {}
+            for k in cells:
+                by_shard.setdefault(router.shard_for(k[0]), []).append(k)
+            done: List[Key] = []
+            try:
+                with metrics.timer("traffic.flush_seconds"):
+                    for shard, keys in by_shard.items():
+                        async with router.conn(shard) as conn:
+                            async with conn.transaction():
+                                await conn.execute(
+                                    UPSERT_SQL,
+                                    [k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys],
+                                    [cells[k].visitors for k in keys],
+                                    [cells[k].avg_value for k in keys])
+                        done.extend(keys)
+            except BaseException:
+                # Merge unflushed cells back, even on cancellation, so no acknowledged report is lost
+                for key in done:
+                    del cells[key]
+                for key, cell in cells.items():
+                    existing = self._cells.get(key)
+                    if existing is None:
+                        self._cells[key] = cell
+                    else:
+                        cell.merge(existing)
+                        self._cells[key] = cell
+                metrics.incr("traffic.flush_failures")
+                raise
+            metrics.incr("traffic.flushed_cells", len(done))
+            metrics.set_gauge("traffic.buffered_cells", len(self._cells))
+            return len(done)
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+                return  # stop() does the final flush
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:  # retried on the next tick
+                print(f"traffic flush failed: {e!r}")
+
+    def start(self):
+        if self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Let an in-flight flush finish rather than cancelling it mid-write
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+traffic_aggregator = TrafficAggregator()
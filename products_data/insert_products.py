@@ -1,3 +1,4 @@
+import io
 import json
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -21,53 +22,238 @@ def load_json(filename):
     with open(filename, "r") as f:
         return json.load(f)
 
+def iter_json_array(filename, read_size=1 << 16, max_element_size=1 << 26):
+    """Yield the objects of a top-level JSON array one at a time.
+
+    Only the current read buffer and the object being decoded are held in
+    memory, so catalog files far larger than RAM can be streamed; an element
+    longer than max_element_size characters is rejected. The input is checked
+    as strictly as json.load: one "," between elements, a closing "]" and
+    nothing but whitespace after it.
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, "r") as f:
+        buf = ""
+        pos = 0
+        consumed = 0  # characters dropped from the front of buf
+        eof = False
+        state = "open"  # "open" -> "first" / "value" <-> "sep" -> "closed"
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            need_more = pos == len(buf)
+            if not need_more:
+                c = buf[pos]
+                if state == "open":
+                    if c != "[":
+                        raise ValueError(f"{filename}: expected a JSON array")
+                    state = "first"
+                    pos += 1
+                    continue
+                if state == "closed":
+                    raise ValueError(f"{filename}: extra data after the array at character {consumed + pos}")
+                if c == "]" and state in ("first", "sep"):
+                    state = "closed"
+                    pos += 1
+                    continue
+                if state == "sep":
+                    if c != ",":
+                        raise ValueError(f"{filename}: expected ',' or ']' at character {consumed + pos}")
+                    state = "value"
+                    pos += 1
+                    continue
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError as e:
+                    # Only an error at the buffer edge (or an unterminated
+                    # string) can be cured by reading more input
+                    if eof or (len(buf) - e.pos > 16 and not e.msg.startswith("Unterminated string")):
+                        raise ValueError(f"{filename}: {e.msg} at character {consumed + e.pos}") from e
+                    need_more = True
+                else:
+                    # A number cut at the buffer edge may stop short of it
+                    # ("1.5e" decodes as 1.5), so keep a little lookahead
+                    need_more = len(buf) - end < 3 and not eof
+            if need_more:
+                if eof:
+                    if state == "closed":
+                        return
+                    if state == "open":
+                        raise ValueError(f"{filename}: expected a JSON array")
+                    raise ValueError(f"{filename}: truncated JSON array")
+                buf = buf[pos:]
+                consumed += pos
+                pos = 0
+                if len(buf) > max_element_size:
+                    raise ValueError(f"{filename}: element at character {consumed} is longer than "
+                                     f"{max_element_size} characters")
+                # Read at least as much as is pending, so a long element costs
+                # a linear number of copies and decode attempts
+                chunk = f.read(max(read_size, len(buf)))
+                eof = not chunk
+                buf += chunk
+                continue
+            yield obj
+            pos = end
+            state = "sep"
+
 # ------------------------------------------------
-# Generic function: Insert rows from JSON
+# COPY helpers (text format)
 # ------------------------------------------------
-def insert_or_update_json_rows(table, rows):
-    """Insert or update multiple rows based on id using ON CONFLICT."""
-    conn = get_connection()
-    cur = conn.cursor()
+def _pg_array_literal(values):
+    items = []
+    for v in values:
+        if v is None:
+            items.append("NULL")
+        else:
+            s = str(v).replace("\\", "\\\\").replace('"', '\\"')
+            items.append(f'"{s}"')
+    return "{" + ",".join(items) + "}"
+
+def _copy_value(value):
+    """Render one value for COPY ... FROM STDIN (text format)."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        s = "t" if value else "f"
+    elif isinstance(value, (list, tuple)):
+        s = _pg_array_literal(value)
+    elif isinstance(value, dict):
+        s = json.dumps(value)
+    else:
+        s = str(value)
+    return (s.replace("\\", "\\\\")
+             .replace("\t", "\\t")
+             .replace("\n", "\\n")
+             .replace("\r", "\\r"))
 
+# ------------------------------------------------
+# Set-based upsert: COPY into staging, merge once per chunk
+# ------------------------------------------------
+def _merge_chunk(cur, table, columns, rows):
+    """COPY one chunk into the staging table and merge it into `table`.
+
+    Returns (inserted, updated, unchanged).
+    """
+    # ON CONFLICT cannot touch the same row twice in one statement: last one wins
+    by_id = {}
     for row in rows:
-        columns = list(row.keys())
-        values = [row[c] for c in columns]
-
-        # Build SQL
-        column_names = ", ".join(columns)
-        placeholders = ", ".join(["%s"] * len(values))
-
-        # Build update clause: "col = EXCLUDED.col"
-        update_clause = ", ".join(
-            [f"{col} = EXCLUDED.{col}" for col in columns if col != "id"]
-        )
-
-        sql = f"""
-            INSERT INTO {table} ({column_names})
-            VALUES ({placeholders})
-            ON CONFLICT (id)
-            DO UPDATE SET
-            {update_clause};
+        by_id[row["id"]] = row
+    rows = list(by_id.values())
+
+    stage = f"_stage_{table}"
+    cur.execute(f"TRUNCATE {stage}")
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_value(row.get(c)) for c in columns))
+        buf.write("\n")
+    buf.seek(0)
+    column_names = ", ".join(columns)
+    cur.copy_expert(f"COPY {stage} ({column_names}) FROM STDIN", buf)
+
+    non_key = [c for c in columns if c != "id"]
+    if non_key:
+        update_clause = ", ".join(f"{c} = EXCLUDED.{c}" for c in non_key)
+        target_cols = ", ".join(f"{table}.{c}" for c in non_key)
+        excluded_cols = ", ".join(f"EXCLUDED.{c}" for c in non_key)
+        # Rows whose content is identical are skipped, so they are neither
+        # rewritten (no dead tuples, no trigger/WAL churn) nor returned.
+        conflict = f"""
+            DO UPDATE SET {update_clause}
+            WHERE ROW({target_cols}) IS DISTINCT FROM ROW({excluded_cols})
         """
+    else:
+        conflict = "DO NOTHING"
 
-        cur.execute(sql, values)
+    cur.execute(f"""
+        INSERT INTO {table} ({column_names})
+        SELECT {column_names} FROM {stage}
+        ON CONFLICT (id)
+        {conflict}
+        RETURNING (xmax = 0) AS inserted;
+    """)
+    flags = [r[0] for r in cur.fetchall()]
+    inserted = sum(1 for f in flags if f)
+    updated = len(flags) - inserted
+    return inserted, updated, len(rows) - len(flags)
+
+def bulk_upsert_rows(table, rows, chunk_size=5000):
+    """Upsert an iterable of dict rows into `table` keyed on id.
+
+    Rows are staged with COPY and merged with a single
+    INSERT ... SELECT ... ON CONFLICT DO UPDATE per chunk. Consecutive rows
+    must share the same set of keys to be batched together; a change of
+    shape simply starts a new chunk.
+    """
+    if not table.replace("_", "").isalnum():
+        raise ValueError("Invalid table name")
+
+    totals = {"inserted": 0, "updated": 0, "unchanged": 0}
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS _stage_{table}
+            (LIKE {table} INCLUDING DEFAULTS)
+        """)
+
+        columns = None
+        chunk = []
+
+        def flush():
+            if not chunk:
+                return
+            ins, upd, same = _merge_chunk(cur, table, columns, chunk)
+            conn.commit()
+            totals["inserted"] += ins
+            totals["updated"] += upd
+            totals["unchanged"] += same
+            chunk.clear()
+
+        for row in rows:
+            if "id" not in row:
+                raise ValueError(f"Row without id: {row!r}")
+            keys = list(row.keys())
+            if columns is not None and keys != columns:
+                flush()
+            columns = keys
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                flush()
+        flush()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return totals
+
+# ------------------------------------------------
+# Generic function: Insert rows from JSON
+# ------------------------------------------------
+def insert_or_update_json_rows(table, rows, chunk_size=5000):
+    """Insert or update multiple rows based on id using ON CONFLICT."""
+    totals = bulk_upsert_rows(table, rows, chunk_size=chunk_size)
+    print(f"✅ Upserted into {table}: {totals['inserted']} inserted, "
+          f"{totals['updated']} updated, {totals['unchanged']} unchanged")
+    return totals
 
-    conn.commit()
-    cur.close()
-    conn.close()
-    print(f"✅ Upserted {len(rows)} rows into {table}")
+def insert_or_update_json_file(table, filename, chunk_size=5000):
+    """Stream a JSON array file into `table` without loading it whole."""
+    return insert_or_update_json_rows(table, iter_json_array(filename), chunk_size)
 
 # ------------------------------------------------
 # Specialized wrappers (optional)
 # ------------------------------------------------
 
 def insert_products():
-    rows = load_json("products.json")
-    insert_or_update_json_rows("products", rows)
+    return insert_or_update_json_file("products", "products.json")
 
 def insert_cart_items():
-    rows = load_json("cart_items.json")
-    insert_or_update_json_rows("cart_items", rows)
+    return insert_or_update_json_file("cart_items", "cart_items.json")
 
 # ------------------------------------------------
 # Example run
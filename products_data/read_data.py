@@ -1,3 +1,4 @@
+import io
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
@@ -107,16 +108,31 @@ def insert_cart_items(insert_sql):
 
 
 # -------------------------------------------------------------------
-# READ PRODUCTS
+# EXPORT TABLES (streaming)
 # -------------------------------------------------------------------
 
-import json
-from psycopg2.extras import RealDictCursor
-
-import json
+import argparse
+import csv
 import datetime
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
-from psycopg2.extras import RealDictCursor
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for --compress zstd
+    zstandard = None
+
+FORMATS = {"ndjson": "ndjson", "csv": "csv", "json": "json"}
+COMPRESSION_SUFFIX = {None: "", "gzip": ".gz", "zstd": ".zst"}
+# Column an incremental (--since) export resumes from. Only orders has a
+# created_at; order_items and cart_items are append-only with a SERIAL id.
+# products has none: insert_products.py upserts rows in place and checkout
+# updates in_stock, so an id watermark would miss changed rows. Export it in
+# full.
+INCREMENTAL_KEYS = {"orders": "created_at", "order_items": "id", "cart_items": "id"}
 
 
 # Custom JSON encoder to convert Decimal, datetime, etc.
@@ -128,40 +144,175 @@ def json_converter(o):
     return str(o)
 
 
-def export_table_to_json(table_name: str):
-    # Validate table name
-    if not table_name.replace("_", "").isalnum():
-        raise ValueError("Invalid table name")
+def _open_output(file_name, compress):
+    if compress is None:
+        return open(file_name, "w", newline="")
+    if compress == "gzip":
+        return gzip.open(file_name, "wt", newline="")
+    if compress == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the 'zstandard' package")
+        raw = open(file_name, "wb")
+        writer = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(writer, encoding="utf-8", newline="")
+    raise ValueError(f"Unknown compression: {compress}")
 
-    conn = get_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
 
-    sql = f"SELECT * FROM {table_name};"
-    cur.execute(sql)
-    rows = cur.fetchall()
+def _csv_value(v):
+    if v is None:
+        return ""
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, default=json_converter)
+    return json_converter(v) if isinstance(v, (Decimal, datetime.date)) else v
 
-    file_name = f"{table_name}.json"
 
-    with open(file_name, "w") as f:
-        json.dump(rows, f, indent=4, default=json_converter)
+def _watermark_file(out_dir, table_name):
+    return os.path.join(out_dir, f".{table_name}.watermark")
 
-    cur.close()
-    conn.close()
+
+def read_watermark(table_name, out_dir="."):
+    """Return the last exported incremental key value for `table_name`, or None."""
+    try:
+        with open(_watermark_file(out_dir, table_name)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def export_table(table_name: str, fmt="json", compress=None, since=None,
+                 out_dir=".", itersize=2000):
+    """Stream `table_name` to a file with constant memory use.
+
+    Rows are read through a named (server-side) cursor `itersize` at a time
+    and written as they arrive. With `since`, only rows whose incremental
+    key (INCREMENTAL_KEYS) is strictly greater are exported, ordered by it,
+    into a file named after the run time so earlier increments are kept, and
+    the highest value seen is recorded so the next run can resume from it.
+    """
+    # Validate table name
+    if not table_name.replace("_", "").isalnum():
+        raise ValueError("Invalid table name")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    key = INCREMENTAL_KEYS.get(table_name)
+    if since is not None and key is None:
+        raise ValueError(f"{table_name} has no incremental key; export it without --since")
+
+    stem = table_name
+    if since is not None:
+        stem += "." + datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    file_name = os.path.join(
+        out_dir, f"{stem}.{FORMATS[fmt]}{COMPRESSION_SUFFIX[compress]}")
+
+    conn = get_connection()
+    # Named cursors only live inside a transaction; keep it read-only.
+    conn.set_session(readonly=True)
+    cur = conn.cursor(name=f"export_{table_name}", cursor_factory=RealDictCursor)
+    cur.itersize = itersize
+
+    if since is not None:
+        cur.execute(
+            f"SELECT * FROM {table_name} WHERE {key} > %s ORDER BY {key}",
+            (since,))
+    else:
+        cur.execute(f"SELECT * FROM {table_name}")
+
+    count = 0
+    max_seen = None
+    try:
+        with _open_output(file_name, compress) as f:
+            writer = None
+            if fmt == "json":
+                f.write("[")
+            for row in cur:
+                if fmt == "ndjson":
+                    f.write(json.dumps(row, default=json_converter))
+                    f.write("\n")
+                elif fmt == "csv":
+                    if writer is None:
+                        writer = csv.writer(f)
+                        writer.writerow(row.keys())
+                    writer.writerow([_csv_value(v) for v in row.values()])
+                else:
+                    f.write(",\n" if count else "\n")
+                    body = json.dumps(row, indent=4, default=json_converter)
+                    f.write("    " + body.replace("\n", "\n    "))
+                count += 1
+                seen = row.get(key) if key else None
+                if seen is not None and (max_seen is None or seen > max_seen):
+                    max_seen = seen
+            if fmt == "json":
+                f.write("\n]\n" if count else "]\n")
+    finally:
+        cur.close()
+        conn.rollback()
+        conn.close()
+
+    watermark = since
+    if max_seen is not None:
+        watermark = max_seen.isoformat() if isinstance(max_seen, datetime.date) else str(max_seen)
+        with open(_watermark_file(out_dir, table_name), "w") as f:
+            f.write(watermark)
 
     return {
         "status": "success",
         "file": file_name,
-        "rows": len(rows)
+        "rows": count,
+        "watermark": watermark,
     }
 
 
+def export_tables(table_names, workers=4, **kwargs):
+    """Export several tables concurrently, one connection per table."""
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(table_names)))) as pool:
+        futures = {t: pool.submit(export_table, t, **kwargs) for t in table_names}
+        return {t: fut.result() for t, fut in futures.items()}
+
+
+def export_table_to_json(table_name: str):
+    return export_table(table_name, fmt="json")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream tables to NDJSON/CSV/JSON files")
+    parser.add_argument("tables", nargs="+")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], default=None)
+    parser.add_argument("--since", default=None,
+                        help="export rows whose incremental key (created_at for orders, id for "
+                             "order_items and cart_items) is after this value; 'last' resumes "
+                             "from the previous run's watermark")
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--itersize", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+    if args.since is not None:
+        unkeyed = [t for t in args.tables if t not in INCREMENTAL_KEYS]
+        if unkeyed:
+            parser.error(f"--since needs an incremental key; none for: {', '.join(unkeyed)}")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    common = dict(fmt=args.format, compress=args.compress,
+                  out_dir=args.out_dir, itersize=args.itersize)
+
+    if args.since == "last":
+        # Each table resumes from its own watermark; a table with none is exported in full.
+        with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(args.tables)))) as pool:
+            futures = {
+                t: pool.submit(export_table, t,
+                               since=read_watermark(t, args.out_dir), **common)
+                for t in args.tables
+            }
+            results = {t: fut.result() for t, fut in futures.items()}
+    else:
+        results = export_tables(args.tables, workers=args.workers,
+                                since=args.since, **common)
+
+    for table, result in results.items():
+        print(f"📦 {table}: {result['rows']} rows -> {result['file']}")
+    return results
 
 
 if __name__ == "__main__":
     # drop_and_create_tables()
-    table_name = "products"
-    table_name = "orders"
-    print("\n📦 PRODUCT LIST:")
-    rows = export_table_to_json(table_name)
-    for row in rows:
-        print(row)
+    main()